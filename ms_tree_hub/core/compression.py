@@ -0,0 +1,155 @@
+"""
+Сжатие ответов с выбором кодировки по Accept-Encoding: zstd (пакет zstandard), br (пакет brotli) и gzip.
+Кодировки, для которых не установлен пакет, не предлагаются. Обычные ответы сжимаются целиком, если они
+не меньше порога, потоковые (StreamingHttpResponse) - по мере отдачи, без накопления всего тела в памяти.
+
+Подключается декоратором compress_response на отдельные view (см. tree_structure/urls.py) или
+CompressionMiddleware на весь проект. Настройки в settings:
+    TREE_COMPRESSION_ENCODINGS = ('zstd', 'br', 'gzip')          # порядок предпочтения при равных q
+    TREE_COMPRESSION_LEVELS = {'zstd': 3, 'br': 4, 'gzip': 6}
+    TREE_COMPRESSION_MIN_SIZE = 1024                             # байт, меньшие ответы не сжимаются
+
+Замеры CPU и экономии трафика на типичных деревьях - команда bench_compression.
+"""
+import zlib
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.decorators import decorator_from_middleware
+
+DEFAULT_ENCODINGS = ('zstd', 'br', 'gzip')
+DEFAULT_LEVELS = {'zstd': 3, 'br': 4, 'gzip': 6}
+DEFAULT_MIN_SIZE = 1024
+
+
+class _GzipCompressor:
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+
+class _BrotliCompressor:
+    def __init__(self, level: int):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.finish()
+
+
+class _ZstdCompressor:
+    def __init__(self, level: int):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+
+COMPRESSORS = {'gzip': _GzipCompressor}
+if brotli:
+    COMPRESSORS['br'] = _BrotliCompressor
+if zstandard:
+    COMPRESSORS['zstd'] = _ZstdCompressor
+
+
+def get_compressor(encoding: str, level: int = None):
+    """Потоковый компрессор: compress(data) для очередного куска, flush() в конце"""
+    if level is None:
+        level = {**DEFAULT_LEVELS, **getattr(settings, 'TREE_COMPRESSION_LEVELS', {})}[encoding]
+    return COMPRESSORS[encoding](level)
+
+
+def choose_encoding(accept_encoding: str):
+    """Кодировка с наибольшим q из поддерживаемых, при равных q - по порядку TREE_COMPRESSION_ENCODINGS"""
+    encodings = [encoding for encoding in getattr(settings, 'TREE_COMPRESSION_ENCODINGS', DEFAULT_ENCODINGS)
+                 if encoding in COMPRESSORS]
+
+    weights = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+
+    best, best_weight = None, 0.0
+    for encoding in encodings:
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def compress_stream(compressor, chunks):
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class CompressionMiddleware:
+    """Сжатие ответа выбранной по Accept-Encoding кодировкой"""
+
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.process_response(request, self.get_response(request))
+
+    def process_response(self, request, response):
+        if response.has_header('Content-Encoding') or response.status_code != 200:
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        if not response.streaming and \
+                len(response.content) < getattr(settings, 'TREE_COMPRESSION_MIN_SIZE', DEFAULT_MIN_SIZE):
+            return response
+
+        encoding = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if not encoding:
+            return response
+
+        compressor = get_compressor(encoding)
+        if response.streaming:
+            response.streaming_content = compress_stream(compressor, response.streaming_content)
+            del response['Content-Length']
+        else:
+            response.content = compressor.compress(response.content) + compressor.flush()
+            response['Content-Length'] = str(len(response.content))
+
+        # тело изменилось, сильный ETag больше не соответствует ему побайтово
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+
+        response['Content-Encoding'] = encoding
+        return response
+
+
+compress_response = decorator_from_middleware(CompressionMiddleware)
@@ -0,0 +1,124 @@
+"""
+Маршрутизация чтения на реплики Postgres с «липкостью» к primary после записи.
+
+Подключение в settings:
+    DATABASES = {'default': {...primary...}, 'replica': {...}}
+    DATABASE_ROUTERS = ['core.db_routers.ReplicaRouter']
+    DATABASE_REPLICAS = ['replica']        # алиасы реплик, по умолчанию пусто - все запросы идут в primary
+    REPLICA_STICKY_SECONDS = 5             # сколько после записи читать ключ с primary
+    REPLICA_RETRY_SECONDS = 5              # сколько не читать с реплики после ошибки соединения с ней
+
+На реплику уходят только запросы внутри read_from_replica(key), все остальное (запись, select_for_update)
+остается на primary. После записи pin_to_primary(key) сохраняет в кеше LSN primary, и пока окно не истекло,
+ключ читается с реплики, только если она уже проиграла WAL до этого LSN. Для нескольких воркеров нужен общий
+кеш (memcached/redis), с LocMemCache липкость работает в пределах одного процесса.
+
+Перед чтением воркер открывает соединение с выбранной репликой, если оно еще не открыто. Реплика, к которой
+не удалось подключиться, исключается из выбора на REPLICA_RETRY_SECONDS, и чтение идет на другую реплику или на
+primary. Если соединение с репликой оборвалось во время чтения, это чтение завершается ошибкой, а реплика так же
+исключается из выбора.
+
+Для проверки на двух локальных Postgres (primary и реплика с потоковой репликацией) есть команда
+check_replica_routing.
+"""
+import contextlib
+import contextvars
+import hashlib
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections, DatabaseError, InterfaceError, OperationalError
+
+logger = logging.getLogger('main_info')
+
+_read_alias = contextvars.ContextVar('read_alias', default=None)
+
+# реплика -> time.monotonic(), до которого она не выбирается для чтения
+_unavailable_until = {}
+
+
+def _pin_cache_key(key: str) -> str:
+    return 'replica-pin:' + hashlib.sha1(key.encode()).hexdigest()
+
+
+def get_replicas() -> list:
+    return list(getattr(settings, 'DATABASE_REPLICAS', []))
+
+
+def pin_to_primary(key: str):
+    """Запоминает LSN primary после записи, чтобы следующие чтения ключа не увидели устаревшие данные"""
+    if not get_replicas():
+        return
+    try:
+        with connections[DEFAULT_DB_ALIAS].cursor() as cursor:
+            cursor.execute('SELECT pg_current_wal_lsn()::text')
+            lsn = cursor.fetchone()[0]
+        cache.set(_pin_cache_key(key), lsn, getattr(settings, 'REPLICA_STICKY_SECONDS', 5))
+    except Exception as e:
+        logger.error(f'unable to pin {key} to primary; {e}')
+
+
+def _mark_unavailable(alias: str, e: Exception):
+    logger.error(f'replica {alias} is unavailable; {e}')
+    _unavailable_until[alias] = time.monotonic() + getattr(settings, 'REPLICA_RETRY_SECONDS', 5)
+
+
+def _available_replicas() -> list:
+    now = time.monotonic()
+    return [alias for alias in get_replicas() if _unavailable_until.get(alias, 0) <= now]
+
+
+def choose_read_alias(key: str) -> str:
+    """
+    Алиас БД для чтения ключа: случайная доступная реплика или primary, если реплик нет, все недоступны или
+    реплика еще не догнала запись ключа
+    """
+    replicas = _available_replicas()
+    for alias in random.sample(replicas, len(replicas)):
+        try:
+            connections[alias].ensure_connection()
+            lsn = cache.get(_pin_cache_key(key))
+            if lsn is None:
+                return alias
+            with connections[alias].cursor() as cursor:
+                cursor.execute('SELECT pg_last_wal_replay_lsn() >= %s::pg_lsn', [lsn])
+                caught_up = cursor.fetchone()[0]
+        except DatabaseError as e:
+            _mark_unavailable(alias, e)
+            continue
+        return alias if caught_up else DEFAULT_DB_ALIAS
+    return DEFAULT_DB_ALIAS
+
+
+@contextlib.contextmanager
+def read_from_replica(key: str):
+    """Запросы на чтение внутри блока выполняются на реплике, выбранной для ключа"""
+    alias = choose_read_alias(key)
+    token = _read_alias.set(alias)
+    try:
+        yield
+    except (InterfaceError, OperationalError) as e:
+        # соединение с репликой потеряно во время чтения: следующие чтения идут мимо нее
+        if alias != DEFAULT_DB_ALIAS:
+            _mark_unavailable(alias, e)
+        raise
+    finally:
+        _read_alias.reset(token)
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
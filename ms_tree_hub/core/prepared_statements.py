@@ -0,0 +1,72 @@
+"""
+Кеш подготовленных на сервере запросов (PREPARE / EXECUTE) для тяжелого raw SQL.
+
+Запрос с именованными параметрами %(name)s один раз на соединение подготавливается как PREPARE name AS ... с
+параметрами $1, $2, ..., дальше выполняется EXECUTE name(...) - Postgres не разбирает и не планирует текст запроса
+заново. Подготовленные запросы живут до закрытия соединения, поэтому кеш сбрасывается при открытии нового
+соединения и после любой ошибки выполнения (например, после DISCARD ALL на стороне пулера соединений).
+
+Подключение в settings:
+    TREE_PREPARED_STATEMENTS = True    # по умолчанию включено, выключить для pgbouncer в режиме transaction pooling
+"""
+import re
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.db.backends.signals import connection_created
+
+_PARAM_RE = re.compile(r'%\((\w+)\)s|%%')
+
+
+class PreparedStatement:
+    """Текст запроса для PREPARE и порядок параметров для EXECUTE"""
+
+    def __init__(self, name: str, sql: str):
+        self.name = name
+        self.sql = sql
+        self.params_order = []
+
+        def replace(match):
+            if match.group(0) == '%%':
+                return '%'
+            param = match.group(1)
+            if param not in self.params_order:
+                self.params_order.append(param)
+            return f'${self.params_order.index(param) + 1}'
+
+        self.prepare_sql = f'PREPARE {name} AS {_PARAM_RE.sub(replace, sql)}'
+        placeholders = ', '.join(['%s'] * len(self.params_order))
+        self.execute_sql = f'EXECUTE {name}({placeholders})' if self.params_order else f'EXECUTE {name}'
+
+
+def _reset(sender=None, connection=None, **kwargs):
+    # новое соединение: на сервере нет подготовленных запросов
+    connection.prepared_statements = set()
+
+
+connection_created.connect(_reset)
+
+
+def execute(cursor, statement: PreparedStatement, params: dict):
+    """
+    Выполнение запроса через подготовленный запрос соединения курсора. Если подготовленные запросы выключены или
+    база не Postgres, запрос выполняется как обычно
+    """
+    connection = cursor.db
+    if connection.vendor != 'postgresql' or not getattr(settings, 'TREE_PREPARED_STATEMENTS', True):
+        return cursor.execute(statement.sql, params)
+
+    prepared = getattr(connection, 'prepared_statements', None)
+    try:
+        if prepared is None:
+            # после ошибки неизвестно, какие запросы остались на сервере (PREPARE не откатывается вместе
+            # с транзакцией), начинаем с чистого листа
+            cursor.execute('DEALLOCATE ALL')
+            prepared = connection.prepared_statements = set()
+        if statement.name not in prepared:
+            cursor.execute(statement.prepare_sql)
+            prepared.add(statement.name)
+        return cursor.execute(statement.execute_sql, [params[param] for param in statement.params_order])
+    except DatabaseError:
+        connection.prepared_statements = None
+        raise
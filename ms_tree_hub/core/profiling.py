@@ -0,0 +1,159 @@
+"""
+Профилирование отдельного запроса по заголовку X-Tree-Profile: cProfile на время обработки запроса и
+EXPLAIN (ANALYZE, BUFFERS) для каждого запроса к БД, который выполнил запрос (ORM, raw SQL и EXECUTE подготовленных
+запросов из core.prepared_statements).
+
+Профилируются только запросы с заголовком X-Tree-Profile, значение которого совпадает с TREE_PROFILING_TOKEN,
+или от пользователя с is_staff (если подключена аутентификация); без заголовка middleware сразу передает запрос
+дальше. Заголовок без прав игнорируется.
+
+EXPLAIN ANALYZE выполняет запрос по-настоящему, поэтому он выполняется перед самим запросом в точке сохранения
+(вне транзакции - в отдельной транзакции), которая сразу откатывается: запросы записи (например, UPDATE с CASE
+в change_inner_order_attr_node) ничего не меняют дважды. Откатываются все изменения, кроме значений
+последовательностей. Время EXPLAIN в профиль cProfile не попадает.
+
+Отчет в JSON (профиль, запросы с длительностью, числом строк и планом) пишется в файл в TREE_PROFILING_DIR,
+имя файла отдается в заголовке X-Tree-Profile-Report; если каталог не задан, отчет отдается вместо тела ответа,
+исходный статус - в поле status.
+
+Подключение в settings:
+    MIDDLEWARE = [..., 'core.profiling.ProfilingMiddleware']   # после AuthenticationMiddleware, если она есть
+    TREE_PROFILING_TOKEN = None            # по умолчанию профилирование только для is_staff
+    TREE_PROFILING_DIR = None              # каталог для отчетов, по умолчанию отчет в ответе
+    TREE_PROFILING_TOP = 40                # строк профиля cProfile в отчете
+"""
+import contextlib
+import cProfile
+import hmac
+import io
+import json
+import logging
+import os
+import pstats
+import time
+import uuid
+
+from django.conf import settings
+from django.db import connections
+from django.http import JsonResponse
+
+logger = logging.getLogger('main_info')
+
+HEADER = 'HTTP_X_TREE_PROFILE'
+DEFAULT_TOP = 40
+
+# запросы, для которых есть план; остальное (SAVEPOINT, PREPARE, SET, ...) только записывается
+EXPLAINABLE = frozenset(['SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'EXECUTE'])
+SAVEPOINT = 'tree_profile'
+
+
+def allowed(request) -> bool:
+    """Запрос с заголовком X-Tree-Profile от того, кому можно профилировать"""
+    token = getattr(settings, 'TREE_PROFILING_TOKEN', None)
+    if token and hmac.compare_digest(request.META[HEADER].encode(), token.encode()):
+        return True
+    user = getattr(request, 'user', None)
+    return bool(user and user.is_authenticated and user.is_staff)
+
+
+class _Capture:
+    """execute_wrapper: план каждого запроса перед его выполнением, длительность и число строк"""
+
+    def __init__(self, profiler: cProfile.Profile):
+        self.profiler = profiler
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        query = {'alias': context['connection'].alias, 'sql': sql, 'params': None if many else _jsonable(params)}
+        if not many and sql.lstrip().split(None, 1)[0].upper() in EXPLAINABLE:
+            self.profiler.disable()
+            try:
+                query['explain'] = self.explain(context['connection'], context['cursor'].cursor, sql, params)
+            finally:
+                self.profiler.enable()
+
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            query['duration'] = time.perf_counter() - start
+            query['rows'] = context['cursor'].rowcount
+            self.queries.append(query)
+
+    @staticmethod
+    def explain(connection, cursor, sql: str, params):
+        """EXPLAIN (ANALYZE, BUFFERS) в откатываемой точке сохранения; курсор драйвера, мимо execute_wrapper"""
+        if connection.vendor != 'postgresql':
+            return None
+        autocommit = connection.get_autocommit()
+        try:
+            cursor.execute('BEGIN' if autocommit else f'SAVEPOINT {SAVEPOINT}')
+        except Exception as e:
+            # транзакция уже прервана предыдущей ошибкой
+            return f'not explained: {e}'
+        try:
+            cursor.execute(f'EXPLAIN (ANALYZE, BUFFERS) {sql}', params)
+            return '\n'.join(row[0] for row in cursor.fetchall())
+        except Exception as e:
+            return f'not explained: {e}'
+        finally:
+            if autocommit:
+                cursor.execute('ROLLBACK')
+            else:
+                cursor.execute(f'ROLLBACK TO SAVEPOINT {SAVEPOINT}')
+                cursor.execute(f'RELEASE SAVEPOINT {SAVEPOINT}')
+
+
+def _jsonable(value):
+    return json.loads(json.dumps(value, default=str))
+
+
+class ProfilingMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if HEADER not in request.META or not allowed(request):
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        capture = _Capture(profiler)
+        with contextlib.ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(capture))
+            start = time.perf_counter()
+            profiler.enable()
+            try:
+                response = self.get_response(request)
+                if response.streaming:
+                    # тело потокового ответа формируется при отдаче, профилируем и его
+                    response.streaming_content = [b''.join(response.streaming_content)]
+            finally:
+                profiler.disable()
+                duration = time.perf_counter() - start
+
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative') \
+            .print_stats(getattr(settings, 'TREE_PROFILING_TOP', DEFAULT_TOP))
+        report = {
+            'method': request.method,
+            'path': request.get_full_path(),
+            'status': response.status_code,
+            'duration': duration,
+            'db_duration': sum(query['duration'] for query in capture.queries),
+            'queries': capture.queries,
+            'profile': stream.getvalue(),
+        }
+
+        directory = getattr(settings, 'TREE_PROFILING_DIR', None)
+        if not directory:
+            return JsonResponse(report)
+
+        os.makedirs(directory, exist_ok=True)
+        name = f'{time.strftime("%Y%m%d-%H%M%S")}-{request.method.lower()}-{uuid.uuid4().hex[:8]}.json'
+        with open(os.path.join(directory, name), 'w') as file:
+            json.dump(report, file, indent=2)
+        logger.info(f'profile of {request.method} {request.path} written to {name}')
+        response['X-Tree-Profile-Report'] = name
+        return response
@@ -0,0 +1,217 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework.renderers import BaseRenderer, JSONRenderer, BrowsableAPIRenderer
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+# списки от стольких элементов отдаются потоком (settings.TREE_STREAMING_MIN_ITEMS), по STREAMING_CHUNK_ITEMS
+# элементов или STREAMING_CHUNK_BYTES байт за кусок
+DEFAULT_STREAMING_MIN_ITEMS = 10000
+STREAMING_CHUNK_ITEMS = 1000
+STREAMING_CHUNK_BYTES = 256 * 1024
+
+
+class PreRenderedJSON:
+    """Уже закодированный JSON ответа (результат FastJSONRenderer), отдается без повторного кодирования"""
+    __slots__ = ('content', )
+
+    def __init__(self, content: bytes):
+        self.content = content
+
+    def decode(self):
+        return orjson.loads(self.content) if orjson else json.loads(self.content)
+
+
+def as_data(data):
+    """Данные ответа сервиса чтения (список или PreRenderedJSON) в виде объектов Python"""
+    return data.decode() if isinstance(data, PreRenderedJSON) else data
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSON рендерер на orjson. Для строк, целых чисел, null, bool, списков и словарей вывод побайтово совпадает
+    с JSONRenderer (компактные разделители, без ensure_ascii, экранирование U+2028/U+2029), в том числе для узлов
+    дерева. Отличия - только у float: экспонента пишется без знака и ведущих нулей (1e16 вместо 1e+16, 1e-7
+    вместо 1e-07, значение то же), NaN и Infinity кодируются как null, а JSONRenderer в строгом режиме
+    выбрасывает ValueError. Если orjson не установлен, запрошен отступ или данные содержат типы, которые orjson
+    не умеет кодировать, используется стандартный JSONRenderer
+    """
+    _ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS if orjson else 0
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+
+        renderer_context = renderer_context or {}
+        plain = not self.ensure_ascii and self.compact and not self.get_indent(accepted_media_type, renderer_context)
+        if isinstance(data, PreRenderedJSON):
+            if plain:
+                return data.content
+            data = data.decode()
+
+        if orjson is None or not plain:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        try:
+            ret = orjson.dumps(data, default=JSONEncoder().default, option=self._ORJSON_OPTIONS)
+        except TypeError:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        # JSONRenderer экранирует разделители строк, которые недопустимы в javascript
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+NODE_RENDERER_CLASSES = (FastJSONRenderer, BrowsableAPIRenderer)
+
+
+def _common_prefix(previous: str, value: str) -> int:
+    # сначала целыми сегментами path / inner_order по 10 символов, затем по символу
+    limit = min(len(previous), len(value))
+    keep = 0
+    while keep + 10 <= limit and previous[keep:keep + 10] == value[keep:keep + 10]:
+        keep += 10
+    while keep < limit and previous[keep] == value[keep]:
+        keep += 1
+    return keep
+
+
+def encode_columnar(rows: list, constant_fields: tuple = (), delta_fields: tuple = ()) -> dict:
+    """
+    Список словарей с одинаковыми ключами в виде колонок:
+        fields - порядок ключей в строке;
+        constant - поля из constant_fields, одинаковые во всех строках, передаются один раз;
+        columns - остальные поля, массив значений на поле;
+        delta - строковые поля из delta_fields: keep - сколько первых символов взять из значения предыдущей
+        строки, suffix - остаток значения
+    """
+    fields = list(rows[0]) if rows else []
+    constant = {field: rows[0][field] for field in constant_fields
+                if field in fields and all(row[field] == rows[0][field] for row in rows)}
+    columns, delta = {}, {}
+    for field in fields:
+        if field in constant:
+            continue
+        values = [row[field] for row in rows]
+        if field in delta_fields and all(type(value) is str for value in values):
+            keeps, suffixes = [], []
+            previous = ''
+            for value in values:
+                keep = _common_prefix(previous, value)
+                keeps.append(keep)
+                suffixes.append(value[keep:])
+                previous = value
+            delta[field] = {'keep': keeps, 'suffix': suffixes}
+        else:
+            columns[field] = values
+    return {'count': len(rows), 'fields': fields, 'constant': constant, 'columns': columns, 'delta': delta}
+
+
+def decode_columnar(payload: dict) -> list:
+    """Обратное преобразование encode_columnar"""
+    columns = dict(payload['columns'])
+    for field, encoded in payload['delta'].items():
+        values = []
+        previous = ''
+        for keep, suffix in zip(encoded['keep'], encoded['suffix']):
+            previous = previous[:keep] + suffix
+            values.append(previous)
+        columns[field] = values
+
+    constant = payload['constant']
+    fields = payload['fields']
+    rows = []
+    for i in range(payload['count']):
+        rows.append({field: constant[field] if field in constant else columns[field][i] for field in fields})
+    return rows
+
+
+class ColumnarJSONRenderer(FastJSONRenderer):
+    """
+    Список узлов в колоночном виде (encode_columnar): ключ дерева один раз, path и inner_order относительно
+    предыдущего узла. Выбирается параметром запроса format=columnar. Ответы, которые не являются списком
+    словарей (ошибки, сообщения), отдаются обычным JSON
+    """
+    media_type = 'application/vnd.tree.columnar+json'
+    format = 'columnar'
+    CONSTANT_FIELDS = ('project_id', 'item_type', 'item')
+    DELTA_FIELDS = ('path', 'inner_order')
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, PreRenderedJSON):
+            data = data.decode()
+        if isinstance(data, list) and all(type(row) is dict for row in data):
+            data = encode_columnar(data, self.CONSTANT_FIELDS, self.DELTA_FIELDS)
+        return super().render(data, accepted_media_type, renderer_context)
+
+
+class MessagePackRenderer(BaseRenderer):
+    """MessagePack, выбирается заголовком Accept: application/msgpack. Доступен при установленном msgpack"""
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if isinstance(data, PreRenderedJSON):
+            data = data.decode()
+        return msgpack.packb(data, default=_msgpack_default)
+
+
+def _msgpack_default(value):
+    # типы, которые JSONRenderer переводит в строки и числа (uuid, Decimal, datetime, ...)
+    return JSONEncoder().default(value)
+
+
+# рендереры эндпоинтов, которые отдают списки узлов
+NODE_LIST_RENDERER_CLASSES = NODE_RENDERER_CLASSES + (ColumnarJSONRenderer, ) + \
+    ((MessagePackRenderer, ) if msgpack else ())
+
+
+def iter_json(data, renderer: FastJSONRenderer):
+    """Тот же JSON, что renderer.render(data), кусками: список - по STREAMING_CHUNK_ITEMS элементов"""
+    if isinstance(data, PreRenderedJSON):
+        content = data.content
+        for start in range(0, len(content), STREAMING_CHUNK_BYTES):
+            yield content[start:start + STREAMING_CHUNK_BYTES]
+        return
+
+    yield b'['
+    for start in range(0, len(data), STREAMING_CHUNK_ITEMS):
+        chunk = renderer.render(data[start:start + STREAMING_CHUNK_ITEMS])
+        yield (b',' if start else b'') + chunk[1:-1]
+    yield b']'
+
+
+def json_response(request, data, status_code: int):
+    """
+    Response или, для больших списков в компактном JSON, StreamingHttpResponse с тем же телом: ответ кодируется
+    и сжимается (core.compression) по кускам, без второй копии всего тела в памяти
+    """
+    renderer = getattr(request, 'accepted_renderer', None)
+    if type(renderer) is not FastJSONRenderer or \
+            renderer.get_indent(request.accepted_media_type, {}) or renderer.ensure_ascii or not renderer.compact:
+        return Response(data, status=status_code)
+
+    min_items = getattr(settings, 'TREE_STREAMING_MIN_ITEMS', DEFAULT_STREAMING_MIN_ITEMS)
+    if isinstance(data, PreRenderedJSON):
+        large = len(data.content) > STREAMING_CHUNK_BYTES
+    else:
+        large = isinstance(data, list) and len(data) >= min_items
+    if not large:
+        return Response(data, status=status_code)
+
+    return StreamingHttpResponse(iter_json(data, renderer), status=status_code, content_type=renderer.media_type)
@@ -0,0 +1,117 @@
+"""
+Повтор пишущих транзакций после deadlock (40P01), ошибки сериализации (40001) и невозможности взять блокировку
+(55P03).
+
+Декоратор retry_transaction повторяет весь метод записи, если такая ошибка вышла из него наружу, с паузой
+случайной длины в пределах экспоненциально растущего окна. Повтор имеет смысл только для внешней транзакции:
+внутри уже открытого atomic (например, при ATOMIC_REQUESTS) транзакция после ошибки все равно прервана, поэтому
+ошибка передается дальше без повтора. Блоки except DatabaseError внутри методов записи должны пропускать такие
+ошибки наружу (см. is_retryable).
+
+Счетчики повторов и отказов по эндпоинтам хранятся в общем кеше и отдаются view transaction_metrics.
+
+Настройки в settings:
+    TREE_TRANSACTION_ATTEMPTS = 5          # всего попыток, включая первую
+    TREE_TRANSACTION_BACKOFF = 0.02        # секунд, окно паузы перед первым повтором, дальше удваивается
+    TREE_TRANSACTION_BACKOFF_MAX = 1.0     # секунд, наибольшее окно паузы
+"""
+import functools
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, DatabaseError, DEFAULT_DB_ALIAS
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+logger = logging.getLogger('main_info')
+
+RETRYABLE_SQLSTATES = frozenset(['40P01', '40001', '55P03'])
+
+DEFAULT_ATTEMPTS = 5
+DEFAULT_BACKOFF = 0.02
+DEFAULT_BACKOFF_MAX = 1.0
+
+# имена эндпоинтов, обернутых retry_transaction, для отчета по счетчикам
+endpoints = []
+
+
+class TransactionConflict(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = {'error': 'Too many concurrent changes of the tree, try again later'}
+
+
+def sqlstate(exc: Exception):
+    """SQLSTATE ошибки драйвера, на которую указывает DatabaseError Django, или None"""
+    while exc is not None:
+        code = getattr(exc, 'pgcode', None) or getattr(exc, 'sqlstate', None)
+        if code:
+            return code
+        exc = exc.__cause__
+    return None
+
+
+def is_retryable(exc: Exception) -> bool:
+    """Ошибка БД, после которой транзакцию можно повторить целиком"""
+    return sqlstate(exc) in RETRYABLE_SQLSTATES
+
+
+def _counter_key(endpoint: str, counter: str) -> str:
+    return f'tx-{counter}:{endpoint}'
+
+
+def _count(endpoint: str, counter: str):
+    key = _counter_key(endpoint, counter)
+    try:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, 0, None)
+            cache.incr(key)
+    except Exception as e:
+        logger.error(f'unable to count {counter} of {endpoint}; {e}')
+
+
+def metrics() -> dict:
+    """{эндпоинт: {'retries': число повторов, 'give_ups': число отказов после всех попыток}}"""
+    keys = {(endpoint, counter): _counter_key(endpoint, counter)
+            for endpoint in endpoints for counter in ('retries', 'give_ups')}
+    values = cache.get_many(list(keys.values()))
+    result = {}
+    for (endpoint, counter), key in keys.items():
+        result.setdefault(endpoint, {})[counter] = values.get(key, 0)
+    return result
+
+
+def retry_transaction(endpoint: str):
+    """Декоратор метода записи: повтор метода целиком после ошибок из RETRYABLE_SQLSTATES"""
+    endpoints.append(endpoint)
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+                return fn(*args, **kwargs)
+
+            attempts = getattr(settings, 'TREE_TRANSACTION_ATTEMPTS', DEFAULT_ATTEMPTS)
+            backoff = getattr(settings, 'TREE_TRANSACTION_BACKOFF', DEFAULT_BACKOFF)
+            backoff_max = getattr(settings, 'TREE_TRANSACTION_BACKOFF_MAX', DEFAULT_BACKOFF_MAX)
+            for attempt in range(1, attempts + 1):
+                try:
+                    return fn(*args, **kwargs)
+                except DatabaseError as e:
+                    if not is_retryable(e):
+                        raise
+                    if attempt == attempts:
+                        _count(endpoint, 'give_ups')
+                        logger.error(f'{endpoint}: giving up after {attempts} attempts, SQLSTATE {sqlstate(e)}')
+                        raise TransactionConflict()
+                    _count(endpoint, 'retries')
+                    logger.info(f'{endpoint}: retrying after SQLSTATE {sqlstate(e)}, attempt {attempt}')
+                    time.sleep(random.uniform(0, min(backoff_max, backoff * 2 ** (attempt - 1))))
+
+        return inner
+
+    return decorator
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path, include
 
@@ -8,4 +9,5 @@ urlpatterns = [
     path('api/', include('tree_structure.urls')),
 ]
 
-urlpatterns += doc_urls
+if getattr(settings, 'TREE_API_DOCS', True):
+    urlpatterns += doc_urls
@@ -1,24 +1,94 @@
-from django.urls import path
-from rest_framework import permissions
-from drf_yasg.views import get_schema_view
-from drf_yasg import openapi
+"""
+Документация API (drf_yasg). drf_yasg и генератор схемы импортируются при первом обращении к документации,
+а не при старте воркера.
 
+Схема OpenAPI заранее собирается командой build_openapi_schema в каталог TREE_OPENAPI_SCHEMA_DIR (openapi.json
+и openapi.yaml) и отдается файлом - здесь или веб-сервером из того же каталога. Если файла нет, схема собирается
+по запросу и кешируется на TREE_API_DOCS_CACHE_TIMEOUT секунд.
 
+Настройки в settings:
+    TREE_API_DOCS = True                      # по умолчанию включено, False - без маршрутов документации
+    TREE_OPENAPI_SCHEMA_DIR = '/srv/static/openapi'    # по умолчанию start_project/openapi
+    TREE_API_DOCS_CACHE_TIMEOUT = 3600        # секунд, для схемы, собранной по запросу
+"""
+import functools
+import os
 
-schema_view = get_schema_view(
-   openapi.Info(
-      title="Cloveri API",
-      default_version='v1',
-      description="Test description",
-      license=openapi.License(name="BSD License"),
-   ),
-   public=True,
-   permission_classes=(permissions.AllowAny,),
-)
+from django.conf import settings
+from django.http import FileResponse
+from django.urls import path, re_path
+
+DEFAULT_SCHEMA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'openapi')
+DEFAULT_CACHE_TIMEOUT = 3600
+
+# формат из адреса: (файл схемы, Content-Type)
+SCHEMA_FILES = {
+    '.json': ('openapi.json', 'application/json'),
+    '.yaml': ('openapi.yaml', 'application/yaml'),
+}
+
+
+def api_info():
+    from drf_yasg import openapi
+
+    return openapi.Info(
+        title="Cloveri API",
+        default_version='v1',
+        description="Test description",
+        license=openapi.License(name="BSD License"),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def schema_view():
+    from rest_framework import permissions
+    from drf_yasg.views import get_schema_view
+
+    return get_schema_view(
+        api_info(),
+        public=True,
+        permission_classes=(permissions.AllowAny,),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _view(renderer: str = None):
+    cache_timeout = getattr(settings, 'TREE_API_DOCS_CACHE_TIMEOUT', DEFAULT_CACHE_TIMEOUT)
+    if renderer is None:
+        return schema_view().without_ui(cache_timeout=cache_timeout)
+    return schema_view().with_ui(renderer, cache_timeout=cache_timeout)
+
+
+def schema_file(format: str) -> str:
+    """Путь к заранее собранной схеме формата '.json' / '.yaml'"""
+    return os.path.join(getattr(settings, 'TREE_OPENAPI_SCHEMA_DIR', DEFAULT_SCHEMA_DIR), SCHEMA_FILES[format][0])
+
+
+def _prebuilt(format: str):
+    file_path = schema_file(format)
+    if os.path.isfile(file_path):
+        return FileResponse(open(file_path, 'rb'), content_type=SCHEMA_FILES[format][1])
+    return None
+
+
+def schema(request, format):
+    return _prebuilt(format) or _view()(request, format=format)
+
+
+def ui(renderer: str):
+    def view(request, *args, **kwargs):
+        # страница документации загружает схему с того же адреса с ?format=openapi
+        if request.GET.get('format') == 'openapi':
+            response = _prebuilt('.json')
+            if response:
+                return response
+        return _view(renderer)(request, *args, **kwargs)
+
+    return view
 
 
 urlpatterns = [
-   path('swagger(?P<format>\.json|\.yaml)', schema_view.without_ui(cache_timeout=0), name='schema-json'),
-   path('swagger/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
-   path('redoc/', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
-]
\ No newline at end of file
+    re_path(r'^swagger(?P<format>\.json|\.yaml)$', schema, name='schema-json'),
+    path('swagger/', ui('swagger'), name='schema-swagger-ui'),
+    path('redoc/', ui('redoc'), name='schema-redoc'),
+]
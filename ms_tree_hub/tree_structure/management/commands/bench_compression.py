@@ -0,0 +1,56 @@
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core import compression
+from core.renderers import FastJSONRenderer, iter_json
+from tree_structure.management.seeding import node_rows
+from tree_structure.serializers import serialize_node_rows
+
+LEVELS = {'gzip': (1, 6, 9), 'br': (1, 4, 6), 'zstd': (1, 3, 9)}
+
+
+class Command(BaseCommand):
+    help = 'CPU на сжатие ответа get_tree и сэкономленные байты для gzip / br / zstd (без обращения к БД)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nodes', type=int, default=100000)
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        renderer = FastJSONRenderer()
+        nodes = serialize_node_rows(node_rows(options['nodes'], str(uuid.uuid4())))
+        content = renderer.render(nodes)
+        if b''.join(iter_json(nodes, renderer)) != content:
+            raise CommandError('Streamed output differs from FastJSONRenderer')
+
+        start = time.process_time()
+        renderer.render(nodes)
+        render_cpu = time.process_time() - start
+        self.stdout.write(f'{options["nodes"]} nodes, {len(content) / 2 ** 20:.1f}MB of JSON, '
+                          f'rendered in {render_cpu * 1000:.0f}ms CPU')
+
+        for encoding in compression.COMPRESSORS:
+            for level in LEVELS[encoding]:
+                for mode in ('whole', 'streamed'):  # streamed - вместе с кодированием JSON по кускам
+                    timings = []
+                    for _ in range(options['repeat']):
+                        compressor = compression.get_compressor(encoding, level)
+                        start = time.process_time()
+                        if mode == 'whole':
+                            compressed = compressor.compress(content) + compressor.flush()
+                        else:
+                            compressed = b''.join(compression.compress_stream(compressor, iter_json(nodes, renderer)))
+                        timings.append(time.process_time() - start)
+                    cpu = min(timings)
+                    saved = len(content) - len(compressed)
+                    self.stdout.write(
+                        f'{encoding:>4} level {level} {mode:>8}: {len(compressed) / 2 ** 20:6.2f}MB '
+                        f'(x{len(content) / len(compressed):4.1f}), {cpu * 1000:6.0f}ms CPU, '
+                        f'{cpu * 1000 / (saved / 2 ** 20):5.1f}ms per MB saved'
+                    )
+
+        missing = [encoding for encoding in LEVELS if encoding not in compression.COMPRESSORS]
+        if missing:
+            self.stdout.write(f'not installed: {", ".join(missing)}')
@@ -0,0 +1,59 @@
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from core.renderers import FastJSONRenderer
+from tree_structure.models import Node
+from tree_structure.serializers import NodeSerializer, NODE_FIELDS, serialize_node_rows
+
+
+class Command(BaseCommand):
+    help = 'Сравнение NodeSerializer + JSONRenderer с быстрым путем сериализации (без обращения к БД)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000)
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        rows_count = options['rows']
+        project_id = uuid.uuid4()
+
+        instances = []
+        for i in range(1, rows_count + 1):
+            # дерево с ветвлением 10: путь и порядок строятся из id предков
+            chain = []
+            node_id = i
+            while node_id:
+                chain.append(node_id)
+                node_id //= 10
+            path = ''.join(str(x).zfill(10) for x in reversed(chain))
+            inner_order = ''.join(str(x % 10 + 1).zfill(10) for x in reversed(chain))
+            instances.append(Node(id=i, path=path, project_id=project_id, item_type='document', item='item',
+                                  inner_order=inner_order, attributes='{"name": "node %d"}' % i,
+                                  depth=len(chain)))
+
+        rows = [tuple(getattr(obj, field) for field in NODE_FIELDS[:-1]) + (obj.depth,)
+                for obj in instances]
+
+        def drf_path():
+            return JSONRenderer().render(NodeSerializer(instances, many=True).data)
+
+        def fast_path():
+            return FastJSONRenderer().render(serialize_node_rows(rows))
+
+        if drf_path() != fast_path():
+            raise CommandError('Output of the fast path differs from NodeSerializer')
+
+        results = {}
+        for name, fn in (('NodeSerializer', drf_path), ('fast path', fast_path)):
+            timings = []
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                fn()
+                timings.append(time.perf_counter() - start)
+            results[name] = min(timings)
+            self.stdout.write(f'{name}: {results[name]:.3f}s for {rows_count} rows')
+
+        self.stdout.write(f"speedup: x{results['NodeSerializer'] / results['fast path']:.1f}, output is byte-identical")
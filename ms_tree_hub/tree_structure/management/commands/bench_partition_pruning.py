@@ -0,0 +1,80 @@
+import json
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from tree_structure.management.seeding import seed_tree
+from tree_structure.models import Node
+from tree_structure.services import partitioning
+from tree_structure.services.methods_model import TREE_CONDITION, tree_params
+
+
+class Command(BaseCommand):
+    help = 'Проверка отсечения секций tree_structure_node на многоарендных данных'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--projects', type=int, default=32)
+        parser.add_argument('--nodes', type=int, default=2000, help='узлов в дереве каждого проекта')
+        parser.add_argument('--keep', action='store_true', help='не удалять созданные данные')
+
+    def handle(self, *args, **options):
+        if not partitioning.is_partitioned(connection):
+            self.stdout.write(self.style.WARNING('tree_structure_node is not partitioned, nothing will be pruned'))
+
+        projects = [uuid.uuid4() for _ in range(options['projects'])]
+        start = time.perf_counter()
+        seeded = {project_id: seed_tree(project_id, 'document', 'bench', options['nodes']) for project_id in projects}
+        self.stdout.write(f'seeded {len(projects)} x {options["nodes"]} nodes in {time.perf_counter() - start:.1f}s')
+
+        try:
+            project_id = projects[0]
+            root_id, child_id = seeded[project_id][:2]
+            data = {'project_id': project_id, 'item_type': 'document', 'item': 'bench'}
+            tree = Node.objects.filter(**data)
+            root = tree.get(id=root_id)
+            child = tree.get(id=child_id)
+
+            queries = (
+                ('get_tree', *tree.exclude(hidden=True).order_by('inner_order').query.sql_with_params()),
+                ('get_descendants depth=1',
+                 *tree.filter(parent_id=root.id).exclude(hidden=True).order_by('inner_order').query.sql_with_params()),
+                ('get_descendants',
+                 *tree.filter(path__startswith=root.path, depth__gt=root.depth).query.sql_with_params()),
+                ('raw UPDATE of a subtree',
+                 f"UPDATE tree_structure_node SET inner_order = inner_order "
+                 f"WHERE {TREE_CONDITION} AND path LIKE %(path)s",
+                 dict(tree_params(data), path=child.path + '%')),
+            )
+
+            failed = False
+            for name, sql, params in queries:
+                relations = self.explain_relations(sql, params)
+                partitions = sorted(r for r in relations if r.startswith(f'{partitioning.TABLE}_p'))
+                self.stdout.write(f'{name}: scans {", ".join(sorted(relations))}')
+                if partitioning.is_partitioned(connection) and len(partitions) != 1:
+                    failed = True
+            if failed:
+                raise CommandError('Some queries are not pruned to a single partition')
+        finally:
+            if not options['keep']:
+                Node.objects.filter(project_id__in=projects).delete()
+
+    @staticmethod
+    def explain_relations(sql: str, params) -> set:
+        """Имена таблиц, которые читает план запроса"""
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+
+        relations = set()
+        stack = [plan[0]['Plan']]
+        while stack:
+            node = stack.pop()
+            if 'Relation Name' in node:
+                relations.add(node['Relation Name'])
+            stack.extend(node.get('Plans', []))
+        return relations
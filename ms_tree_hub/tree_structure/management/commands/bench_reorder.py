@@ -0,0 +1,53 @@
+import random
+import statistics
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from tree_structure.management.seeding import seed_tree
+from tree_structure.models import Node
+from tree_structure.services import methods_model
+
+
+class Command(BaseCommand):
+    help = 'Время перестановки узла среди соседей (change_inner_order_attr_node) с подготовленными запросами и без них'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nodes', type=int, default=10000)
+        parser.add_argument('--moves', type=int, default=500)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        data = {'project_id': str(uuid.uuid4()), 'item_type': 'document', 'item': 'bench'}
+        seed_tree(data['project_id'], data['item_type'], data['item'], options['nodes'])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE tree_structure_node')
+
+        # группы соседей, в которых есть что переставлять
+        siblings = {}
+        for node_id, parent_id in Node.objects.filter(project_id=data['project_id']).values_list('id', 'parent_id'):
+            siblings.setdefault(parent_id, []).append(node_id)
+        groups = [ids for ids in siblings.values() if len(ids) > 1]
+
+        try:
+            for prepared in (False, True):
+                rnd = random.Random(options['seed'])
+                durations = []
+                with override_settings(TREE_PREPARED_STATEMENTS=prepared):
+                    for _ in range(options['moves']):
+                        movable_id, destination_id = rnd.sample(rnd.choice(groups), 2)
+                        start = time.perf_counter()
+                        methods_model.change_inner_order_attr_node(
+                            dict(data, destination_node_id=destination_id), movable_id)
+                        durations.append(time.perf_counter() - start)
+
+                durations.sort()
+                self.stdout.write(f'prepared statements {"on" if prepared else "off"}: {len(durations)} moves, '
+                                  f'mean {statistics.mean(durations) * 1000:.2f}ms, '
+                                  f'p50 {durations[len(durations) // 2] * 1000:.2f}ms, '
+                                  f'p99 {durations[int(len(durations) * 0.99) - 1] * 1000:.2f}ms')
+        finally:
+            Node.objects.filter(project_id=data['project_id']).delete()
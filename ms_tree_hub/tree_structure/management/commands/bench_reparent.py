@@ -0,0 +1,61 @@
+import random
+import statistics
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from tree_structure.management.seeding import seed_tree
+from tree_structure.models import Node
+from tree_structure.services import methods_model
+
+# замер с --append на 10000 узлах, 200 перемещений. До однопроходного UPDATE (перемещение узла в конец соседей
+# через change_inner_order_attr_node, затем UPDATE поддерева): 9.9 запроса на перемещение, транзакция в среднем
+# 41.8ms, p99 69.8ms. После: 4.0 запроса, 17.0ms, p99 31.9ms
+
+
+class Command(BaseCommand):
+    help = 'Число запросов и время транзакции (время удержания блокировок) при перемещении узлов к новому родителю'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nodes', type=int, default=10000)
+        parser.add_argument('--moves', type=int, default=200)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--append', action='store_true',
+                            help='только перемещение в конец детей, без before_node_id (как до user-032)')
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options['seed'])
+        data = {'project_id': str(uuid.uuid4()), 'item_type': 'document', 'item': 'bench'}
+        ids = seed_tree(data['project_id'], data['item_type'], data['item'], options['nodes'])
+
+        statements, durations = [], []
+        try:
+            for _ in range(options['moves']):
+                movable_id, new_parent_id = rnd.sample(ids[1:], 2)
+                nodes = Node.objects.in_bulk([movable_id, new_parent_id])
+                movable, new_parent = nodes[movable_id], nodes[new_parent_id]
+                if new_parent.path.startswith(movable.path) or movable.parent_id == new_parent.id:
+                    continue
+
+                request = dict(data, new_parent_id=new_parent.id)
+                siblings = list(Node.objects.filter(parent_id=new_parent.id).values_list('id', flat=True)[:5])
+                if siblings and not options['append'] and rnd.random() < 0.5:
+                    request['before_node_id'] = rnd.choice(siblings)
+
+                with CaptureQueriesContext(connection) as queries:
+                    start = time.perf_counter()
+                    methods_model.change_parent_node(request, movable.id)
+                    durations.append(time.perf_counter() - start)
+                statements.append(len([q for q in queries.captured_queries
+                                       if q['sql'] not in ('BEGIN', 'COMMIT') and 'SAVEPOINT' not in q['sql']]))
+        finally:
+            Node.objects.filter(project_id=data['project_id']).delete()
+
+        durations.sort()
+        self.stdout.write(f'{len(durations)} moves in a tree of {options["nodes"]} nodes')
+        self.stdout.write(f'statements per move: {statistics.mean(statements):.1f}')
+        self.stdout.write(f'transaction time: mean {statistics.mean(durations) * 1000:.1f}ms, '
+                          f'p99 {durations[int(len(durations) * 0.99) - 1] * 1000:.1f}ms')
@@ -0,0 +1,53 @@
+import gzip
+import json
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.renderers import ColumnarJSONRenderer, FastJSONRenderer, MessagePackRenderer, decode_columnar, msgpack
+from tree_structure.management.seeding import node_rows
+from tree_structure.serializers import serialize_node_rows
+
+
+class Command(BaseCommand):
+    help = 'Размер ответа get_tree и время его разбора клиентом: JSON, format=columnar и MessagePack'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nodes', type=int, default=100000)
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        nodes = serialize_node_rows(node_rows(options['nodes'], str(uuid.uuid4())))
+
+        formats = [
+            ('json', FastJSONRenderer(), json.loads),
+            ('columnar', ColumnarJSONRenderer(), lambda content: decode_columnar(json.loads(content))),
+        ]
+        if msgpack:
+            formats.append(('msgpack', MessagePackRenderer(), msgpack.unpackb))
+        else:
+            self.stdout.write('msgpack is not installed')
+
+        baseline = None
+        for name, renderer, parse in formats:
+            content = renderer.render(nodes)
+            if parse(content) != nodes:
+                raise CommandError(f'{name} does not round-trip')
+
+            render_timings, parse_timings = [], []
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                renderer.render(nodes)
+                render_timings.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                parse(content)
+                parse_timings.append(time.perf_counter() - start)
+
+            compressed = len(gzip.compress(content, 6))
+            baseline = baseline or (len(content), compressed)
+            self.stdout.write(
+                f'{name:>8}: {len(content) / 2 ** 20:6.2f}MB ({len(content) / baseline[0]:4.0%}), '
+                f'gzip {compressed / 2 ** 20:5.2f}MB ({compressed / baseline[1]:4.0%}), '
+                f'render {min(render_timings) * 1000:5.0f}ms, parse {min(parse_timings) * 1000:5.0f}ms'
+            )
@@ -0,0 +1,78 @@
+import threading
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from tree_structure.management.seeding import seed_tree
+from tree_structure.models import Node
+from tree_structure.services import methods_model
+
+
+class Command(BaseCommand):
+    help = ('Наплыв одинаковых get_tree / get_descendants из потоков одного процесса: число чтений узлов из БД '
+            'и время волны с объединением чтений и без него')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nodes', type=int, default=20000)
+        parser.add_argument('--threads', type=int, default=32)
+        parser.add_argument('--waves', type=int, default=5)
+
+    def handle(self, *args, **options):
+        data = {'project_id': str(uuid.uuid4()), 'item_type': 'document', 'item': 'bench'}
+        ids = seed_tree(data['project_id'], data['item_type'], data['item'], options['nodes'])
+        reads = (
+            ('get_tree', lambda: methods_model.get_tree(dict(data))),
+            ('get_descendants', lambda: methods_model.get_descendants(dict(data), ids[1])),
+        )
+
+        try:
+            for name, read in reads:
+                for enabled in (False, True):
+                    with override_settings(TREE_SINGLE_FLIGHT=enabled):
+                        selects, elapsed = self.herd(read, options['threads'], options['waves'])
+                    self.stdout.write(
+                        f'{name} single flight {"on" if enabled else "off"}: '
+                        f'{selects / options["waves"]:.1f} node reads per wave of {options["threads"]}, '
+                        f'{elapsed / options["waves"] * 1000:.0f}ms per wave'
+                    )
+        finally:
+            Node.objects.filter(project_id=data['project_id']).delete()
+
+    def herd(self, read, threads: int, waves: int):
+        """Волны одновременных чтений: число запросов к tree_structure_node и общее время"""
+        lock = threading.Lock()
+        selects = 0
+        barrier = threading.Barrier(threads + 1)
+
+        def count(execute, sql, params, many, context):
+            nonlocal selects
+            if sql.lstrip().upper().startswith('SELECT') and 'tree_structure_node' in sql:
+                with lock:
+                    selects += 1
+            return execute(sql, params, many, context)
+
+        def client():
+            try:
+                with connection.execute_wrapper(count):
+                    for _ in range(waves):
+                        barrier.wait()
+                        read()
+                        barrier.wait()
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=client) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        elapsed = 0
+        for _ in range(waves):
+            barrier.wait()
+            start = time.perf_counter()
+            barrier.wait()
+            elapsed += time.perf_counter() - start
+        for worker in workers:
+            worker.join()
+        return selects, elapsed
@@ -0,0 +1,66 @@
+import statistics
+import time
+import tracemalloc
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from core.renderers import as_data
+from tree_structure.management.seeding import seed_tree
+from tree_structure.models import Node
+from tree_structure.services import methods_model, tree_index
+
+
+class Command(BaseCommand):
+    help = 'Время get_tree / get_descendants из БД и из индекса в памяти, память индекса на узел'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nodes', type=int, default=100000)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        data = {'project_id': str(uuid.uuid4()), 'item_type': 'document', 'item': 'bench'}
+        ids = seed_tree(data['project_id'], data['item_type'], data['item'], options['nodes'])
+        # узел второго уровня: поддерево примерно из десятой части дерева
+        subtree_root = ids[1]
+
+        reads = (
+            ('get_tree', lambda: methods_model.get_tree(dict(data))),
+            ('get_descendants', lambda: methods_model.get_descendants(dict(data), subtree_root)),
+            ('get_descendants depth=1', lambda: methods_model.get_descendants(dict(data, depth=1), subtree_root)),
+        )
+
+        try:
+            with override_settings(TREE_INDEX_ENABLED=True, TREE_INDEX_MAX_NODES=options['nodes']):
+                tree_index.indexes.clear()
+                start = time.perf_counter()
+                methods_model.get_tree(dict(data))
+                self.stdout.write(f'index built in {(time.perf_counter() - start) * 1000:.0f}ms')
+
+                tree_index.indexes.clear()
+                tracemalloc.start()
+                methods_model.get_tree(dict(data))
+                memory = tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+                self.stdout.write(f'memory after build: {memory / options["nodes"]:.0f} bytes per node')
+                index = tree_index.indexes.get(methods_model.tree_key(methods_model.GET_TREE_VALIDATION(data)))
+                arrays = sum(getattr(index, name).itemsize * len(getattr(index, name))
+                             for name in ('ids', 'parents', 'segments', 'depths', 'ends', 'sorted_ids',
+                                          'sorted_positions'))
+                arrays += len(index.hidden) + 8 * len(index.attributes)
+                self.stdout.write(f'index arrays: {arrays / index.size:.0f} bytes per node')
+
+            for name, read in reads:
+                for enabled in (False, True):
+                    with override_settings(TREE_INDEX_ENABLED=enabled):
+                        durations = []
+                        for _ in range(options['repeat']):
+                            start = time.perf_counter()
+                            rows = as_data(read())
+                            durations.append(time.perf_counter() - start)
+                    self.stdout.write(f'{name} ({len(rows)} rows) index {"on" if enabled else "off"}: '
+                                      f'median {statistics.median(durations) * 1000:.1f}ms')
+        finally:
+            tree_index.indexes.clear()
+            Node.objects.filter(project_id=data['project_id']).delete()
@@ -0,0 +1,43 @@
+import timeit
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.http import QueryDict
+
+from tree_structure.services import methods_model
+from tree_structure.services.validate_fields_model import Validate
+
+
+class Command(BaseCommand):
+    help = 'Сравнение затрат на валидацию запроса: Validate против скомпилированных ValidationPlan'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=100000)
+
+    def handle(self, *args, **options):
+        number = options['number']
+        tree = {'project_id': str(uuid.uuid4()), 'item_type': 'document', 'item': 'item'}
+
+        def query(**params):
+            # GET-запросы приходят в виде QueryDict, тело PATCH/POST - в виде dict
+            result = QueryDict(mutable=True)
+            result.update(dict(tree, **params))
+            return result
+
+        cases = (
+            ('get_tree', query(sort_by_id='true'), None,
+             lambda data, pk: Validate(data)(fields_allowed=['sort_by_id', ]),
+             methods_model.GET_TREE_VALIDATION),
+            ('get_descendants', query(depth='2'), 10,
+             lambda data, pk: Validate(data, pk=pk)(fields_allowed=['sort_by_id', 'depth', ]),
+             methods_model.GET_DESCENDANTS_VALIDATION),
+            ('change_attributes', dict(tree, attributes='{"name": "node", "tags": [1, 2, 3]}'), 10,
+             lambda data, pk: Validate(data, pk=pk)(fields_required=['attributes', ]),
+             methods_model.CHANGE_ATTRIBUTES_VALIDATION),
+        )
+
+        for name, data, pk, legacy, plan in cases:
+            legacy_time = timeit.timeit(lambda: legacy(data, pk), number=number) / number
+            plan_time = timeit.timeit(lambda: plan(data, pk), number=number) / number
+            self.stdout.write(f'{name}: Validate {legacy_time * 1e6:.2f}us, ValidationPlan {plan_time * 1e6:.2f}us, '
+                              f'x{legacy_time / plan_time:.1f}')
@@ -0,0 +1,26 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from start_project import yasg
+
+
+class Command(BaseCommand):
+    help = ('Сборка схемы OpenAPI при сборке образа: openapi.json и openapi.yaml в TREE_OPENAPI_SCHEMA_DIR, '
+            'отдаются вместо схемы, собираемой по запросу')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='адрес API в схеме, например https://api.example.com')
+
+    def handle(self, *args, **options):
+        from drf_yasg.codecs import OpenAPICodecJson, OpenAPICodecYaml
+        from drf_yasg.generators import OpenAPISchemaGenerator
+
+        schema = OpenAPISchemaGenerator(yasg.api_info(), url=options['url']).get_schema(request=None, public=True)
+        for format, codec in (('.json', OpenAPICodecJson), ('.yaml', OpenAPICodecYaml)):
+            file_path = yasg.schema_file(format)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            content = codec(validators=[]).encode(schema)
+            with open(file_path, 'wb') as file:
+                file.write(content)
+            self.stdout.write(f'{file_path}: {len(content)} bytes')
@@ -0,0 +1,43 @@
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.db_routers import choose_read_alias, get_replicas
+from core.renderers import as_data
+from tree_structure.models import Node
+from tree_structure.services import methods_model
+
+
+class Command(BaseCommand):
+    help = 'Проверка чтения с реплик и read-your-writes на primary + реплике (см. core/db_routers.py)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writes', type=int, default=20)
+
+    def handle(self, *args, **options):
+        if not get_replicas():
+            raise CommandError('settings.DATABASE_REPLICAS is empty')
+
+        data = {'project_id': str(uuid.uuid4()), 'item_type': 'document', 'item': 'replica-check'}
+        key = methods_model.tree_key(methods_model.GET_TREE_VALIDATION(data))
+        created = []
+        try:
+            for _ in range(options['writes']):
+                node = methods_model.create_node(dict(data), None)
+                created.append(node['id'])
+                # сразу после записи дерево читается с primary или с догнавшей реплики и содержит новый узел
+                alias = choose_read_alias(key)
+                tree_ids = [row['id'] for row in as_data(methods_model.get_tree(dict(data)))]
+                if node['id'] not in tree_ids:
+                    raise CommandError(f'node {node["id"]} is missing right after the write (read from {alias})')
+                self.stdout.write(f'node {node["id"]}: read after write from {alias}')
+
+            time.sleep(getattr(settings, 'REPLICA_STICKY_SECONDS', 5) + 1)
+            alias = choose_read_alias(key)
+            self.stdout.write(f'after the sticky window reads go to {alias}')
+            if alias not in get_replicas():
+                raise CommandError('reads are still pinned to primary after the sticky window')
+        finally:
+            Node.objects.filter(id__in=created).delete()
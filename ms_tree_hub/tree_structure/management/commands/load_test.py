@@ -0,0 +1,278 @@
+import collections
+import random
+import threading
+import time
+import uuid
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from tree_structure.management.seeding import seed_tree
+from tree_structure.models import Node
+
+BRANCHING = 10
+DEFAULT_MIX = 'tree=25,descendants=30,create=15,reorder=10,reparent=10,hidden=10'
+
+LOCK_WAITS_SQL = """
+SELECT count(*), COALESCE(MAX(EXTRACT(EPOCH FROM now() - locks.waitstart)), 0)
+    FROM pg_locks AS locks
+    JOIN pg_stat_activity AS activity ON activity.pid = locks.pid
+    WHERE NOT locks.granted AND activity.datname = current_database();
+"""
+
+WAIT_EVENTS_SQL = """
+SELECT wait_event, count(*) FROM pg_stat_activity
+    WHERE wait_event_type = 'Lock' AND datname = current_database()
+    GROUP BY wait_event;
+"""
+
+DATABASE_STATS_SQL = """
+SELECT deadlocks, xact_rollback FROM pg_stat_database WHERE datname = current_database();
+"""
+
+
+class TreeState:
+    """Что клиенты нагрузки знают о дереве: родитель каждого узла. Обновляется по успешным ответам"""
+
+    def __init__(self, data: dict, ids: list):
+        self.data = data
+        self.lock = threading.Lock()
+        self.parents = {node_id: ids[(i - 1) // BRANCHING] if i else None for i, node_id in enumerate(ids)}
+        self.children = collections.defaultdict(set)
+        for node_id, parent_id in self.parents.items():
+            self.children[parent_id].add(node_id)
+
+    def random_node(self) -> int:
+        with self.lock:
+            return random.choice(list(self.parents))
+
+    def random_siblings(self):
+        """Два соседа с общим родителем или None"""
+        with self.lock:
+            node_id = random.choice(list(self.parents))
+            siblings = self.children[self.parents[node_id]] - {node_id}
+            return (node_id, random.choice(list(siblings))) if siblings else None
+
+    def random_move(self):
+        """Узел и новый родитель не из его поддерева или None"""
+        with self.lock:
+            node_id = random.choice(list(self.parents))
+            new_parent_id = random.choice(list(self.parents))
+            ancestor = new_parent_id
+            while ancestor is not None:
+                if ancestor == node_id:
+                    return None
+                ancestor = self.parents[ancestor]
+            if self.parents[node_id] in (None, new_parent_id):
+                return None
+            return node_id, new_parent_id
+
+    def add(self, node_id: int, parent_id: int):
+        with self.lock:
+            self.parents[node_id] = parent_id
+            self.children[parent_id].add(node_id)
+
+    def move(self, node_id: int, new_parent_id: int):
+        with self.lock:
+            self.children[self.parents[node_id]].discard(node_id)
+            self.parents[node_id] = new_parent_id
+            self.children[new_parent_id].add(node_id)
+
+
+class Stats:
+    """Длительности и статусы ответов по эндпоинтам"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = collections.defaultdict(list)
+        self.statuses = collections.defaultdict(collections.Counter)
+
+    def add(self, endpoint: str, duration: float, status):
+        with self.lock:
+            self.durations[endpoint].append(duration)
+            self.statuses[endpoint][status] += 1
+
+
+def percentile(values: list, share: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+class Command(BaseCommand):
+    help = ('Смешанная нагрузка чтениями и записями на запущенный сервер (деревья заполняются в БД из settings, '
+            'сервер должен работать с той же БД): req/s, p50/p99 по эндпоинтам, ожидания блокировок, deadlock\'и')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000/api/', help='адрес API сервера')
+        parser.add_argument('--clients', type=int, default=16)
+        parser.add_argument('--duration', type=float, default=30, help='секунд')
+        parser.add_argument('--mix', default=DEFAULT_MIX,
+                            help=f'веса операций, по умолчанию {DEFAULT_MIX}')
+        parser.add_argument('--hot-trees', type=int, default=2)
+        parser.add_argument('--hot-nodes', type=int, default=5000)
+        parser.add_argument('--hot-share', type=float, default=0.8, help='доля операций над горячими деревьями')
+        parser.add_argument('--cold-trees', type=int, default=20)
+        parser.add_argument('--cold-nodes', type=int, default=300)
+        parser.add_argument('--sample-interval', type=float, default=0.2, help='период опроса pg_locks, секунд')
+        parser.add_argument('--keep', action='store_true', help='не удалять деревья после прогона')
+
+    def handle(self, *args, **options):
+        try:
+            mix = {name: float(weight) for name, weight in
+                   (item.split('=') for item in options['mix'].split(','))}
+        except ValueError:
+            raise CommandError(f'wrong --mix format, expected {DEFAULT_MIX}')
+        unknown = set(mix) - set(self.operations())
+        if unknown:
+            raise CommandError(f'unknown operations: {", ".join(sorted(unknown))}')
+
+        self.base_url = options['url'].rstrip('/') + '/'
+        project_id = str(uuid.uuid4())
+        hot, cold = [], []
+        for trees, count, nodes, prefix in ((hot, options['hot_trees'], options['hot_nodes'], 'hot'),
+                                            (cold, options['cold_trees'], options['cold_nodes'], 'cold')):
+            for i in range(count):
+                data = {'project_id': project_id, 'item_type': 'document', 'item': f'load-{prefix}-{i}'}
+                trees.append(TreeState(data, seed_tree(project_id, data['item_type'], data['item'], nodes)))
+        self.stdout.write(f'seeded {len(hot)} hot trees x {options["hot_nodes"]} nodes, '
+                          f'{len(cold)} cold trees x {options["cold_nodes"]} nodes, project {project_id}')
+
+        stats = Stats()
+        stop = threading.Event()
+        lock_samples = []
+        try:
+            deadlocks_before, rollbacks_before = self.database_stats()
+            threads = [threading.Thread(target=self.client, args=(stats, stop, mix, hot, cold, options))
+                       for _ in range(options['clients'])]
+            sampler = threading.Thread(target=self.sample_locks, args=(stop, options['sample_interval'], lock_samples))
+            started = time.perf_counter()
+            for thread in threads + [sampler]:
+                thread.start()
+            time.sleep(options['duration'])
+            stop.set()
+            for thread in threads + [sampler]:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            deadlocks_after, rollbacks_after = self.database_stats()
+        finally:
+            if not options['keep']:
+                Node.objects.filter(project_id=project_id).delete()
+
+        self.report(stats, elapsed, lock_samples, options['sample_interval'],
+                    deadlocks_after - deadlocks_before, rollbacks_after - rollbacks_before)
+
+    def operations(self) -> dict:
+        return {
+            'tree': self.op_tree,
+            'descendants': self.op_descendants,
+            'create': self.op_create,
+            'reorder': self.op_reorder,
+            'reparent': self.op_reparent,
+            'hidden': self.op_hidden,
+        }
+
+    def client(self, stats: Stats, stop: threading.Event, mix: dict, hot: list, cold: list, options: dict):
+        session = requests.Session()
+        operations = self.operations()
+        names = list(mix)
+        weights = [mix[name] for name in names]
+        while not stop.is_set():
+            trees = hot if hot and (not cold or random.random() < options['hot_share']) else cold
+            operations[random.choices(names, weights)[0]](session, stats, random.choice(trees))
+
+    def request(self, session, stats: Stats, endpoint: str, method: str, url: str, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = session.request(method, self.base_url + url, timeout=60, **kwargs)
+            status = response.status_code
+        except requests.RequestException:
+            response, status = None, 'error'
+        stats.add(endpoint, time.perf_counter() - start, status)
+        return response if status in (200, 201) else None
+
+    def op_tree(self, session, stats, tree: TreeState):
+        self.request(session, stats, 'get_tree', 'GET', 'v1/nodes/', params=tree.data)
+
+    def op_descendants(self, session, stats, tree: TreeState):
+        self.request(session, stats, 'get_descendants', 'GET', f'v1/nodes/{tree.random_node()}/',
+                     params=dict(tree.data, depth=random.choice([1, 2, 3])))
+
+    def op_create(self, session, stats, tree: TreeState):
+        parent_id = tree.random_node()
+        response = self.request(session, stats, 'create', 'POST', f'v1/node/{parent_id}/',
+                                json=dict(tree.data, attributes='{"name": "load"}'))
+        if response is not None:
+            tree.add(response.json()['id'], parent_id)
+
+    def op_reorder(self, session, stats, tree: TreeState):
+        siblings = tree.random_siblings()
+        if siblings:
+            self.request(session, stats, 'reorder', 'PATCH', f'v1/node/{siblings[0]}/order/',
+                         json=dict(tree.data, destination_node_id=siblings[1]))
+
+    def op_reparent(self, session, stats, tree: TreeState):
+        move = tree.random_move()
+        if move:
+            response = self.request(session, stats, 'reparent', 'PATCH', f'v1/node/{move[0]}/parent/',
+                                    json=dict(tree.data, new_parent_id=move[1]))
+            if response is not None:
+                tree.move(*move)
+
+    def op_hidden(self, session, stats, tree: TreeState):
+        node_id = tree.random_node()
+        if self.request(session, stats, 'hide', 'PATCH', f'v1/node/{node_id}/hidden/',
+                        json=dict(tree.data, hidden=True)) is not None:
+            self.request(session, stats, 'restore', 'PATCH', f'v1/node/{node_id}/hidden/',
+                         json=dict(tree.data, hidden=None))
+
+    def database_stats(self):
+        with connection.cursor() as cursor:
+            cursor.execute(DATABASE_STATS_SQL)
+            return cursor.fetchone()
+
+    def sample_locks(self, stop: threading.Event, interval: float, samples: list):
+        """Раз в interval: число ожидающих блокировку, самое долгое текущее ожидание, события ожидания"""
+        try:
+            with connection.cursor() as cursor:
+                while not stop.wait(interval):
+                    cursor.execute(LOCK_WAITS_SQL)
+                    waiting, longest = cursor.fetchone()
+                    cursor.execute(WAIT_EVENTS_SQL)
+                    samples.append((waiting, float(longest), dict(cursor.fetchall())))
+        finally:
+            connection.close()
+
+    def report(self, stats: Stats, elapsed: float, lock_samples: list, interval: float, deadlocks: int,
+               rollbacks: int):
+        total = sum(len(durations) for durations in stats.durations.values())
+        self.stdout.write(f'{total} requests in {elapsed:.1f}s, {total / elapsed:.0f} req/s')
+        self.stdout.write(f'{"endpoint":>16} {"count":>7} {"req/s":>7} {"p50 ms":>8} {"p99 ms":>8} '
+                          f'{"4xx":>6} {"5xx":>6} {"failed":>6}')
+        for endpoint in sorted(stats.durations):
+            durations = stats.durations[endpoint]
+            statuses = stats.statuses[endpoint]
+            count = len(durations)
+            client_errors = sum(n for status, n in statuses.items() if status != 'error' and 400 <= status < 500)
+            server_errors = sum(n for status, n in statuses.items() if status != 'error' and status >= 500)
+            self.stdout.write(
+                f'{endpoint:>16} {count:>7} {count / elapsed:>7.1f} {percentile(durations, 0.5) * 1000:>8.1f} '
+                f'{percentile(durations, 0.99) * 1000:>8.1f} {client_errors / count:>6.1%} '
+                f'{server_errors / count:>6.1%} {statuses["error"] / count:>6.1%}'
+            )
+
+        # интеграл числа ожидающих по времени: примерная суммарная длительность ожиданий блокировок
+        lock_wait = sum(waiting for waiting, _, _ in lock_samples) * interval
+        longest = max((longest for _, longest, _ in lock_samples), default=0)
+        busiest = max((waiting for waiting, _, _ in lock_samples), default=0)
+        events = collections.Counter()
+        for _, _, sample_events in lock_samples:
+            events.update(sample_events)
+        self.stdout.write(f'lock waits: ~{lock_wait:.1f}s total, longest {longest * 1000:.0f}ms, '
+                          f'up to {busiest} waiting at once, '
+                          f'{sum(1 for waiting, _, _ in lock_samples if waiting) / max(len(lock_samples), 1):.0%} '
+                          f'of samples with waiters')
+        if events:
+            self.stdout.write('wait events (sampled): ' +
+                              ', '.join(f'{event} {count}' for event, count in events.most_common()))
+        self.stdout.write(f'deadlocks: {deadlocks}, rolled back transactions: {rollbacks}')
@@ -0,0 +1,58 @@
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+# холодный старт воркера: приложение WSGI и загрузка urlconf, как при первом запросе
+CHILD = """
+import resource, sys, time
+start = time.perf_counter()
+from django.core.wsgi import get_wsgi_application
+application = get_wsgi_application()
+from django.urls import get_resolver
+get_resolver().resolve(sys.argv[1])
+print(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+      int('drf_yasg.generators' in sys.modules))
+"""
+
+
+class Command(BaseCommand):
+    help = ('Холодный старт воркера в отдельных процессах: время до готовности обрабатывать запросы и RSS, '
+            'с проверкой бюджета (ненулевой код выхода при превышении)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5)
+        parser.add_argument('--path', default='/api/v1/nodes/', help='адрес первого запроса')
+        parser.add_argument('--max-seconds', type=float, help='бюджет медианы времени старта, секунд')
+        parser.add_argument('--max-rss-mb', type=float, help='бюджет наибольшего RSS, МБ')
+
+    def handle(self, *args, **options):
+        ready, total, rss, docs = [], [], [], False
+        for _ in range(options['runs']):
+            start = time.perf_counter()
+            result = subprocess.run([sys.executable, '-c', CHILD, options['path']], capture_output=True, text=True,
+                                    env=os.environ.copy())
+            total.append(time.perf_counter() - start)
+            if result.returncode:
+                raise CommandError(f'worker failed to start:\n{result.stderr}')
+            seconds, max_rss, docs_loaded = result.stdout.split()
+            ready.append(float(seconds))
+            # ru_maxrss в Linux - в КБ
+            rss.append(int(max_rss) / 1024)
+            docs = docs or docs_loaded == '1'
+
+        self.stdout.write(f'{options["runs"]} cold starts: django ready in median '
+                          f'{statistics.median(ready) * 1000:.0f}ms (max {max(ready) * 1000:.0f}ms), '
+                          f'process {statistics.median(total) * 1000:.0f}ms with interpreter, '
+                          f'RSS up to {max(rss):.1f}MB, schema generator {"loaded" if docs else "not loaded"}')
+
+        exceeded = []
+        if options['max_seconds'] is not None and statistics.median(ready) > options['max_seconds']:
+            exceeded.append(f'startup {statistics.median(ready):.2f}s > {options["max_seconds"]}s')
+        if options['max_rss_mb'] is not None and max(rss) > options['max_rss_mb']:
+            exceeded.append(f'RSS {max(rss):.1f}MB > {options["max_rss_mb"]}MB')
+        if exceeded:
+            raise CommandError('startup budget exceeded: ' + ', '.join(exceeded))
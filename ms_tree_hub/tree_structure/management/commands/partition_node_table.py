@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from tree_structure.services import partitioning
+
+
+class Command(BaseCommand):
+    help = 'Перенос tree_structure_node в таблицу, секционированную по хешу project_id ' \
+           '(порядок шагов описан в tree_structure/services/partitioning.py)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('step', choices=['prepare', 'copy', 'swap', 'all'])
+        parser.add_argument('--partitions', type=int, default=16)
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        if connection.vendor != 'postgresql':
+            raise CommandError('Partitioning is supported only on PostgreSQL')
+        if partitioning.is_partitioned(connection):
+            self.stdout.write('tree_structure_node is already partitioned')
+            return
+
+        step = options['step']
+        if step in ('prepare', 'all'):
+            partitioning.prepare(connection, options['partitions'])
+        if step == 'copy':
+            copied = partitioning.copy(connection, options['batch_size'])
+            self.stdout.write(f'{copied} nodes copied')
+        if step in ('swap', 'all'):
+            partitioning.swap(connection, options['batch_size'])
+            self.stdout.write('tree_structure_node is partitioned')
@@ -0,0 +1,44 @@
+import multiprocessing
+import os
+import signal
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from tree_structure.services import jobs
+
+
+def _work(stop, once: bool):
+    # соединения родителя закрыты перед fork, каждый процесс открывает свое
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        jobs.work(stop, once)
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Воркеры фоновых заданий (см. tree_structure/services/jobs.py): пул процессов, очередь в Postgres'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count())
+        parser.add_argument('--once', action='store_true', help='выполнить задания из очереди и завершиться')
+
+    def handle(self, *args, **options):
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        stop = context.Event()
+        processes = [context.Process(target=_work, args=(stop, options['once']), daemon=True)
+                     for _ in range(options['processes'])]
+
+        def shutdown(signum, frame):
+            # текущие задания доделываются, новые не забираются
+            stop.set()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+        for process in processes:
+            process.start()
+        self.stdout.write(f'{len(processes)} job worker(s) started')
+        for process in processes:
+            process.join()
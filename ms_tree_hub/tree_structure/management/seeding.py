@@ -0,0 +1,59 @@
+from django.db import connection
+
+from tree_structure.models import Node
+
+
+def pad(value: int) -> str:
+    return '0' * (10 - len(str(value))) + str(value)
+
+
+def seed_tree(project_id, item_type: str, item: str, nodes: int, branching: int = 10, attributes=None) -> list:
+    """
+    Заполнение дерева для нагрузочных проверок: один корень и полное дерево с ветвлением branching.
+    id заранее берутся из последовательности, узлы вставляются через bulk_create. Возвращает id в порядке вставки
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT nextval(pg_get_serial_sequence('tree_structure_node', 'id')) "
+                       "FROM generate_series(1, %s)", [nodes])
+        ids = [row[0] for row in cursor.fetchall()]
+
+    objs = []
+    for i, node_id in enumerate(ids):
+        if i == 0:
+            parent = None
+            path, inner_order, depth = pad(node_id), pad(1), 1
+        else:
+            parent = objs[(i - 1) // branching]
+            path = parent.path + pad(node_id)
+            inner_order = parent.inner_order + pad((i - 1) % branching + 1)
+            depth = parent.depth + 1
+        objs.append(Node(id=node_id, path=path, project_id=project_id, item_type=item_type, item=item,
+                         inner_order=inner_order, attributes=attributes, depth=depth,
+                         parent_id=parent.id if parent else None))
+
+    Node.objects.bulk_create(objs, batch_size=5000)
+    return ids
+
+
+ATTRIBUTE_WORDS = ('section', 'chapter', 'draft', 'review', 'final', 'appendix', 'table', 'figure')
+
+
+def node_rows(nodes: int, project_id: str, item_type: str = 'document', item: str = 'item') -> list:
+    """
+    Строки узлов без обращения к БД в формате values_nodes: дерево с ветвлением 10 (path и inner_order строятся
+    из id предков) и attributes, похожими на настоящие
+    """
+    words = ATTRIBUTE_WORDS
+    rows = []
+    for i in range(1, nodes + 1):
+        chain = []
+        node_id = i
+        while node_id:
+            chain.append(node_id)
+            node_id //= 10
+        path = ''.join(pad(x) for x in reversed(chain))
+        inner_order = ''.join(pad(x % 10 + 1) for x in reversed(chain))
+        attributes = '{"name": "%s %d", "status": "%s", "weight": %d}' % (
+            words[i * 7 % len(words)], i, words[i * 3 % len(words)], i * 37 % 1000)
+        rows.append((i, path, project_id, item_type, item, inner_order, attributes, len(chain)))
+    return rows
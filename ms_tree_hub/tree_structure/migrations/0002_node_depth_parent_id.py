@@ -0,0 +1,42 @@
+# Generated by Django 4.1.7 on 2026-10-19 02:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_structure', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='node',
+            name='depth',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='node',
+            name='parent_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        # заполняем depth и parent_id существующих узлов из path
+        migrations.RunSQL(
+            sql="""
+UPDATE tree_structure_node
+    SET depth = LENGTH(path) / 10,
+        parent_id = CASE
+            WHEN LENGTH(path) > 10 THEN CAST(SUBSTR(path, LENGTH(path) - 19, 10) AS BIGINT)
+        END;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='node',
+            index=models.Index(fields=['project_id', 'item_type', 'item', 'parent_id'], name='tree_node_parent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='node',
+            index=models.Index(fields=['project_id', 'item_type', 'item', 'depth'], name='tree_node_depth_idx'),
+        ),
+    ]
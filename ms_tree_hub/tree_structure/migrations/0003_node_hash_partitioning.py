@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.db import migrations
+
+from tree_structure.services import partitioning
+
+
+def partition_node_table(apps, schema_editor):
+    """
+    Секционирование tree_structure_node по хешу project_id, выполняется только на Postgres и только если
+    задан settings.TREE_NODE_HASH_PARTITIONS. Большие таблицы лучше перенести заранее командой
+    partition_node_table, тогда миграция ничего не делает
+    """
+    partitions = getattr(settings, 'TREE_NODE_HASH_PARTITIONS', None)
+    if not partitions or schema_editor.connection.vendor != 'postgresql':
+        return
+    partitioning.partition_node_table(schema_editor.connection, partitions)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_structure', '0002_node_depth_parent_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_node_table, migrations.RunPython.noop),
+    ]
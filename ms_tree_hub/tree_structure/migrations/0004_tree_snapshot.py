@@ -0,0 +1,31 @@
+# Generated by Django 4.1.7 on 2026-10-19 03:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_structure', '0003_node_hash_partitioning'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TreeSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('project_id', models.UUIDField()),
+                ('item_type', models.TextField()),
+                ('item', models.TextField()),
+                ('sort_by', models.TextField()),
+                ('generation', models.BigIntegerField(default=0)),
+                ('payload_generation', models.BigIntegerField(blank=True, null=True)),
+                ('payload', models.TextField(blank=True, null=True)),
+                ('changed_attributes', models.JSONField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'tree_structure_treesnapshot',
+                'unique_together': {('project_id', 'item_type', 'item', 'sort_by')},
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+from django.db import migrations
+
+# JSON merge patch (RFC 7386): ключи со значением null удаляются, объекты сливаются рекурсивно, остальные значения
+# заменяются. Функция рекурсивная, поэтому plpgsql: тело sql функции проверяется при создании, когда ее самой
+# еще нет
+CREATE_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION jsonb_merge_patch(target jsonb, patch jsonb) RETURNS jsonb
+    LANGUAGE plpgsql IMMUTABLE AS $$
+BEGIN
+    IF patch IS NULL OR jsonb_typeof(patch) <> 'object' THEN
+        RETURN patch;
+    END IF;
+    IF target IS NULL OR jsonb_typeof(target) <> 'object' THEN
+        target := '{}'::jsonb;
+    END IF;
+    RETURN (target - ARRAY(SELECT key FROM jsonb_each(patch) WHERE jsonb_typeof(value) = 'null'))
+        || COALESCE(
+            (SELECT jsonb_object_agg(key, jsonb_merge_patch(target -> key, value))
+                FROM jsonb_each(patch) WHERE jsonb_typeof(value) <> 'null'),
+            '{}'::jsonb
+        );
+END
+$$;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_structure', '0004_tree_snapshot'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=CREATE_FUNCTION_SQL,
+            reverse_sql='DROP FUNCTION IF EXISTS jsonb_merge_patch(jsonb, jsonb);',
+        ),
+    ]
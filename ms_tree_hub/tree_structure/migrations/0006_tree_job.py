@@ -0,0 +1,47 @@
+# Generated by Django 4.1.7 on 2026-10-19 03:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_structure', '0005_jsonb_merge_patch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TreeJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('project_id', models.UUIDField()),
+                ('item_type', models.TextField()),
+                ('item', models.TextField()),
+                ('operation', models.TextField()),
+                ('node_id', models.BigIntegerField(blank=True, null=True)),
+                ('params', models.JSONField()),
+                ('status', models.TextField(default='queued')),
+                ('worker', models.TextField(blank=True, null=True)),
+                ('rows_touched', models.BigIntegerField(default=0)),
+                ('statements', models.IntegerField(default=0)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('error', models.JSONField(blank=True, null=True)),
+                ('error_status', models.IntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'tree_structure_treejob',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='treejob',
+            index=models.Index(fields=['status', 'id'], name='tree_job_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='treejob',
+            index=models.Index(fields=['project_id', 'item_type', 'item', 'status'], name='tree_job_tree_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.1.7 on 2026-10-19 03:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_structure', '0006_tree_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='treejob',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='treejob',
+            name='target_item',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='treejob',
+            name='target_item_type',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='treejob',
+            name='target_project_id',
+            field=models.UUIDField(blank=True, null=True),
+        ),
+    ]
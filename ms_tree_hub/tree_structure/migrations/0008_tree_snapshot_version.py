@@ -0,0 +1,30 @@
+# Generated by Django 4.1.7 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tree_structure', '0007_tree_job_target_attempts'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='treesnapshot',
+            name='changed_attributes',
+        ),
+        migrations.RemoveField(
+            model_name='treesnapshot',
+            name='generation',
+        ),
+        migrations.RemoveField(
+            model_name='treesnapshot',
+            name='payload_generation',
+        ),
+        migrations.AddField(
+            model_name='treesnapshot',
+            name='payload_version',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
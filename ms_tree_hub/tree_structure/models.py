@@ -1,5 +1,4 @@
 from django.db import models
-from rest_framework.exceptions import ValidationError
 
 
 class Node(models.Model):
@@ -11,13 +10,12 @@ class Node(models.Model):
     inner_order = models.TextField()
     attributes = models.JSONField(blank=True, null=True)
     hidden = models.BooleanField(blank=True, null=True)
+    # уровень вложенности узла (len(path) // 10) и id родителя, поддерживаются всеми методами записи
+    depth = models.PositiveIntegerField(default=1)
+    parent_id = models.BigIntegerField(blank=True, null=True)
 
     def get_level_node(self):
-        if len(self.path) % 10 == 0:
-            return len(self.path) // 10
-        else:
-            raise ValidationError(f"For object id {self.id} value field 'path' not a multiple of 10. "
-                                  f"Field 'path' generation error.")
+        return self.depth
 
     def __str__(self):
         return f'{self.id}'
@@ -25,3 +23,72 @@ class Node(models.Model):
     class Meta:
         db_table = 'tree_structure_node'
         unique_together = (('path', 'id'), ('id', 'project_id', 'item_type', 'item'),)
+        indexes = [
+            models.Index(fields=['project_id', 'item_type', 'item', 'parent_id'], name='tree_node_parent_idx'),
+            models.Index(fields=['project_id', 'item_type', 'item', 'depth'], name='tree_node_depth_idx'),
+        ]
+
+
+class TreeSnapshot(models.Model):
+    """
+    Готовый ответ get_tree для дерева и режима сортировки, собранный по версии дерева payload_version
+    (tree_versions)
+    """
+    project_id = models.UUIDField()
+    item_type = models.TextField()
+    item = models.TextField()
+    sort_by = models.TextField()
+    payload_version = models.BigIntegerField(blank=True, null=True)
+    payload = models.TextField(blank=True, null=True)
+
+    def __str__(self):
+        return f'{self.project_id}/{self.item_type}/{self.item}/{self.sort_by}'
+
+    class Meta:
+        db_table = 'tree_structure_treesnapshot'
+        unique_together = (('project_id', 'item_type', 'item', 'sort_by'),)
+
+
+class TreeJob(models.Model):
+    """
+    Тяжелая операция над деревом, выполняемая фоновым воркером (команда run_jobs). Задания одного дерева
+    выполняются по очереди в порядке id, дерево-приемник target_* (clone_subtree в другое дерево) учитывается
+    наравне с исходным. attempts - сколько раз задание забирали воркеры. rows_touched и statements обновляются
+    во время выполнения
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    project_id = models.UUIDField()
+    item_type = models.TextField()
+    item = models.TextField()
+    target_project_id = models.UUIDField(blank=True, null=True)
+    target_item_type = models.TextField(blank=True, null=True)
+    target_item = models.TextField(blank=True, null=True)
+    operation = models.TextField()
+    node_id = models.BigIntegerField(blank=True, null=True)
+    params = models.JSONField()
+    status = models.TextField(default=QUEUED)
+    worker = models.TextField(blank=True, null=True)
+    attempts = models.IntegerField(default=0)
+    rows_touched = models.BigIntegerField(default=0)
+    statements = models.IntegerField(default=0)
+    result = models.JSONField(blank=True, null=True)
+    error = models.JSONField(blank=True, null=True)
+    error_status = models.IntegerField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    heartbeat_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f'{self.id} {self.operation} {self.status}'
+
+    class Meta:
+        db_table = 'tree_structure_treejob'
+        indexes = [
+            models.Index(fields=['status', 'id'], name='tree_job_status_idx'),
+            models.Index(fields=['project_id', 'item_type', 'item', 'status'], name='tree_job_tree_idx'),
+        ]
@@ -35,3 +35,38 @@ class DeleteNodeSerializer(serializers.ModelSerializer):
     class Meta:
         model = Node
         fields = ('project_id', 'item_type', 'item', 'hidden')
+
+
+# Быстрый путь сериализации узлов в обход ModelSerializer.
+# Результат совпадает с NodeSerializer(...).data, но строится из кортежей .values_list()
+
+NODE_FIELDS = NodeSerializer.Meta.fields
+
+
+def values_nodes(queryset):
+    """Выборка узлов кортежами в порядке NODE_FIELDS, level_node берется из поля depth"""
+    return queryset.values_list(*NODE_FIELDS[:-1], 'depth')
+
+
+# uuid.UUID из БД в выдаче - строка
+_PROJECT_ID_INDEX = NODE_FIELDS.index('project_id')
+
+
+def serialize_node_rows(rows) -> list:
+    """Сериализация кортежей, полученных из values_nodes"""
+    fields, index = NODE_FIELDS, _PROJECT_ID_INDEX
+    return [dict(zip(fields, (*row[:index], str(row[index]), *row[index + 1:]))) for row in rows]
+
+
+def serialize_node(instance: Node) -> dict:
+    """Сериализация одного объекта Node, замена NodeSerializer, NewNodeSerializer, UpdateNodeSerializer"""
+    return {
+        'id': instance.id,
+        'path': instance.path,
+        'project_id': str(instance.project_id),
+        'item_type': instance.item_type,
+        'item': instance.item,
+        'inner_order': instance.inner_order,
+        'attributes': instance.attributes,
+        'level_node': instance.get_level_node(),
+    }
@@ -0,0 +1,288 @@
+"""
+Фоновое выполнение тяжелых операций над поддеревьями через таблицу заданий tree_structure_treejob (модель TreeJob).
+
+Эндпоинт с параметром run_async=true проверяет формат запроса, создает задание и отвечает 202 с id задания,
+статус читается через GET v1/jobs/<id>/. Задания выполняют процессы команды run_jobs:
+ - задание забирается запросом с FOR UPDATE SKIP LOCKED, задание не берется, пока в одном из его деревьев (исходном
+   или дереве-приемнике clone_subtree) есть более раннее незавершенное задание, поэтому задания одного дерева
+   выполняются по очереди;
+ - операция и отметка о завершении выполняются в одной транзакции: после падения воркера изменения операции
+   откатываются, а задание без heartbeat дольше TREE_JOBS_STALE_SECONDS забирает другой воркер. Задание, которое
+   забирали TREE_JOBS_MAX_ATTEMPTS раз, после очередного падения воркера помечается failed;
+ - во время выполнения отдельное соединение раз в TREE_JOBS_HEARTBEAT_SECONDS записывает heartbeat и прогресс:
+   число выполненных запросов и затронутых ими строк (считаются через connection.execute_wrapper).
+
+Настройки в settings:
+    TREE_JOBS_POLL_INTERVAL = 0.5          # секунд, пауза воркера при пустой очереди
+    TREE_JOBS_HEARTBEAT_SECONDS = 1
+    TREE_JOBS_STALE_SECONDS = 60
+    TREE_JOBS_MAX_ATTEMPTS = 3
+"""
+import json
+import logging
+import os
+import socket
+import threading
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from core import transactions
+from ..models import TreeJob
+from . import methods_model
+from .validate_fields_model import ValidateError
+
+logger = logging.getLogger('main_info')
+
+DEFAULT_POLL_INTERVAL = 0.5
+DEFAULT_HEARTBEAT_SECONDS = 1
+DEFAULT_STALE_SECONDS = 60
+DEFAULT_MAX_ATTEMPTS = 3
+
+# операция: (метод записи, план валидации для проверки при постановке в очередь)
+OPERATIONS = {
+    'change_parent': (methods_model.change_parent_node, methods_model.CHANGE_PARENT_VALIDATION),
+    'change_hidden': (methods_model.change_hidden_attr_node, methods_model.CHANGE_HIDDEN_VALIDATION),
+    'change_hidden_batch': (methods_model.change_hidden_attr_nodes, methods_model.CHANGE_HIDDEN_BATCH_VALIDATION),
+    'clone_subtree': (methods_model.clone_subtree, methods_model.CLONE_SUBTREE_VALIDATION),
+    'change_attributes_batch': (methods_model.change_attributes_attr_nodes,
+                                methods_model.CHANGE_ATTRIBUTES_BATCH_VALIDATION),
+}
+
+# деревья задания: исходное и дерево-приемник (null, если задание пишет только в исходное дерево)
+_SAME_TREE_SQL = """(({other}.project_id, {other}.item_type, {other}.item)
+                    IN ((job.project_id, job.item_type, job.item),
+                        (job.target_project_id, job.target_item_type, job.target_item))
+                OR ({other}.target_project_id, {other}.target_item_type, {other}.target_item)
+                    IN ((job.project_id, job.item_type, job.item),
+                        (job.target_project_id, job.target_item_type, job.target_item)))"""
+
+CLAIM_SQL = f"""
+UPDATE tree_structure_treejob
+    SET status = 'running', worker = %(worker)s, started_at = now(), heartbeat_at = now(), rows_touched = 0,
+        statements = 0, attempts = attempts + 1
+    WHERE id = (
+        SELECT id FROM tree_structure_treejob AS job
+        WHERE (status = 'queued'
+                OR status = 'running' AND heartbeat_at < now() - %(stale)s * INTERVAL '1 second'
+                    AND attempts < %(max_attempts)s)
+            AND NOT EXISTS (
+                SELECT 1 FROM tree_structure_treejob AS earlier
+                WHERE earlier.status IN ('queued', 'running')
+                    AND earlier.id < job.id
+                    AND {_SAME_TREE_SQL.format(other='earlier')}
+            )
+        ORDER BY id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id;
+"""
+
+# задания, воркеры которых падали на каждой из TREE_JOBS_MAX_ATTEMPTS попыток
+GIVE_UP_SQL = """
+UPDATE tree_structure_treejob
+    SET status = 'failed', error = %(error)s::jsonb, error_status = 500, finished_at = now()
+    WHERE status = 'running' AND heartbeat_at < now() - %(stale)s * INTERVAL '1 second'
+        AND attempts >= %(max_attempts)s
+    RETURNING id;
+"""
+
+
+def run_async_requested(request_data) -> bool:
+    value = request_data.get('run_async')
+    return value is True or isinstance(value, str) and value.lower() == 'true'
+
+
+def without_run_async(request_data):
+    """Данные запроса для синхронного выполнения: run_async не входит в поля планов валидации"""
+    return {key: request_data.get(key) for key in request_data if key != 'run_async'}
+
+
+def submit(operation: str, request_data, pk: int = None) -> dict:
+    """Проверка формата запроса и постановка операции в очередь"""
+    params = without_run_async(request_data)
+    plan = OPERATIONS[operation][1]
+    data = plan(params, pk) if plan.with_pk else plan(params)
+
+    # clone_subtree в другое дерево пишет и в него
+    target = [data.get(field) for field in methods_model.TARGET_TREE_FIELDS]
+    job = TreeJob.objects.create(
+        project_id=data['project_id'],
+        item_type=data['item_type'],
+        item=data['item'],
+        target_project_id=target[0],
+        target_item_type=target[1],
+        target_item=target[2],
+        operation=operation,
+        node_id=pk,
+        params=params,
+    )
+    logger.info(f'job {job.id} {operation} queued')
+    return {'job_id': job.id, 'status': job.status}
+
+
+def get_job(job_id: int) -> dict:
+    job = TreeJob.objects.filter(id=job_id).first()
+    if not job:
+        logger.info(f'{ValidateError.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=job_id)}')
+        raise ValidateError({'error': ValidateError.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=job_id)},
+                            status=status.HTTP_404_NOT_FOUND)
+
+    end = job.finished_at or (timezone.now() if job.status == TreeJob.RUNNING else None)
+    return {
+        'job_id': job.id,
+        'operation': job.operation,
+        'node_id': job.node_id,
+        'status': job.status,
+        'attempts': job.attempts,
+        'rows_touched': job.rows_touched,
+        'statements': job.statements,
+        'result': job.result,
+        'error': job.error,
+        'error_status': job.error_status,
+        'created_at': job.created_at,
+        'started_at': job.started_at,
+        'finished_at': job.finished_at,
+        'duration': (end - job.started_at).total_seconds() if end and job.started_at else None,
+    }
+
+
+def worker_name() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def claim(worker: str):
+    """id забранного задания или None, если выполнять нечего"""
+    params = {
+        'worker': worker,
+        'stale': getattr(settings, 'TREE_JOBS_STALE_SECONDS', DEFAULT_STALE_SECONDS),
+        'max_attempts': getattr(settings, 'TREE_JOBS_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS),
+        'error': json.dumps({'error': 'Job workers crashed on every attempt, giving up'}),
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(GIVE_UP_SQL, params)
+        for job_id, in cursor.fetchall():
+            logger.error(f'job {job_id} failed after {params["max_attempts"]} attempts')
+        cursor.execute(CLAIM_SQL, params)
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+class _Progress:
+    """execute_wrapper: число запросов задания и строк, которые изменили запросы записи"""
+
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        result = execute(sql, params, many, context)
+        self.statements += 1
+        rowcount = context['cursor'].rowcount
+        if rowcount > 0 and not sql.lstrip()[:6].upper() == 'SELECT':
+            self.rows += rowcount
+        return result
+
+
+class _Heartbeat(threading.Thread):
+    """Запись heartbeat и прогресса задания из отдельного потока (и соединения), пока задание выполняется"""
+
+    def __init__(self, job_id: int, worker: str, progress: _Progress):
+        super().__init__(daemon=True)
+        self.job_id = job_id
+        self.worker = worker
+        self.progress = progress
+        self.stopped = threading.Event()
+
+    def run(self):
+        interval = getattr(settings, 'TREE_JOBS_HEARTBEAT_SECONDS', DEFAULT_HEARTBEAT_SECONDS)
+        try:
+            while not self.stopped.wait(interval):
+                TreeJob.objects.filter(id=self.job_id, worker=self.worker, status=TreeJob.RUNNING).update(
+                    heartbeat_at=timezone.now(),
+                    rows_touched=self.progress.rows,
+                    statements=self.progress.statements,
+                )
+        except Exception as e:
+            logger.error(f'job {self.job_id}: heartbeat failed; {e}')
+        finally:
+            connection.close()
+
+
+class _JobLost(Exception):
+    """Задание забрал другой воркер (heartbeat устарел), изменения этого воркера откатываются"""
+
+
+def _jsonable(value):
+    return json.loads(json.dumps(value, default=str))
+
+
+@transactions.retry_transaction('run_job')
+def _execute(job: TreeJob, worker: str, progress: _Progress):
+    progress.statements = progress.rows = 0
+    function, plan = OPERATIONS[job.operation]
+    with transaction.atomic():
+        result = function(dict(job.params), job.node_id) if plan.with_pk else function(dict(job.params))
+        finished = TreeJob.objects.filter(id=job.id, worker=worker, status=TreeJob.RUNNING).update(
+            status=TreeJob.DONE,
+            result=_jsonable(result),
+            rows_touched=progress.rows,
+            statements=progress.statements,
+            finished_at=timezone.now(),
+        )
+        if not finished:
+            raise _JobLost()
+
+
+def _fail(job: TreeJob, worker: str, progress: _Progress, error, error_status: int):
+    TreeJob.objects.filter(id=job.id, worker=worker, status=TreeJob.RUNNING).update(
+        status=TreeJob.FAILED,
+        error=_jsonable(error),
+        error_status=error_status,
+        rows_touched=progress.rows,
+        statements=progress.statements,
+        finished_at=timezone.now(),
+    )
+
+
+def run(job_id: int, worker: str):
+    """Выполнение забранного задания"""
+    job = TreeJob.objects.get(id=job_id)
+    progress = _Progress()
+    heartbeat = _Heartbeat(job.id, worker, progress)
+    heartbeat.start()
+    try:
+        with connection.execute_wrapper(progress):
+            _execute(job, worker, progress)
+        logger.info(f'job {job.id} {job.operation} done, {progress.rows} row(s) touched')
+    except _JobLost:
+        logger.error(f'job {job.id} was taken over by another worker')
+    except APIException as e:
+        logger.info(f'job {job.id} {job.operation} failed; {e.detail}')
+        _fail(job, worker, progress, e.detail, e.status_code)
+    except Exception as e:
+        logger.error(f'job {job.id} {job.operation} failed; {e}', exc_info=True)
+        _fail(job, worker, progress, {'error': 'Something went wrong, please contact the dev'},
+              status.HTTP_500_INTERNAL_SERVER_ERROR)
+    finally:
+        heartbeat.stopped.set()
+        heartbeat.join()
+
+
+def work(stop: threading.Event = None, once: bool = False):
+    """Цикл воркера: забрать задание, выполнить, при пустой очереди подождать. once - до опустошения очереди"""
+    stop = stop or threading.Event()
+    worker = worker_name()
+    poll_interval = getattr(settings, 'TREE_JOBS_POLL_INTERVAL', DEFAULT_POLL_INTERVAL)
+    while not stop.is_set():
+        job_id = claim(worker)
+        if job_id is None:
+            if once:
+                return
+            stop.wait(poll_interval)
+            continue
+        run(job_id, worker)
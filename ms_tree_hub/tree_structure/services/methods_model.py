@@ -1,42 +1,301 @@
+import json
 import logging
+from typing import Union
 
-from django.db import transaction, DatabaseError, connection
-from django.db.models.functions import Length
+from django.db import transaction, DatabaseError, connection, DEFAULT_DB_ALIAS
+from django.db.models import Count, Max
 from rest_framework import status
 from rest_framework.exceptions import ValidationError
 
+from core import prepared_statements, transactions
+from core.db_routers import read_from_replica, pin_to_primary
+from core.renderers import PreRenderedJSON
 from ..models import Node
-from ..serializers import NodeSerializer, NewNodeSerializer, UpdateNodeSerializer
-from .validate_fields_model import Validate, ValidateError
+from ..serializers import values_nodes, serialize_node_rows, serialize_node
+from . import single_flight, snapshots, tree_index, tree_versions
+from .validate_fields_model import ValidationPlan, ValidateError, validate_value_fields_for_create_child
 
 
 logger = logging.getLogger('main_info')
 
+# правила валидации эндпоинтов, компилируются один раз при импорте
+# format - выбор рендерера ответа (format=columnar), обрабатывается DRF
+GET_NODE_VALIDATION = ValidationPlan(fields_allowed=['with_children', ], with_pk=True)
+GET_TREE_VALIDATION = ValidationPlan(fields_allowed=['sort_by_id', 'format', 'with_children', ])
+GET_DESCENDANTS_VALIDATION = ValidationPlan(fields_allowed=['sort_by_id', 'depth', 'format', 'with_children', ],
+                                            with_pk=True)
+CREATE_ROOT_NODE_VALIDATION = ValidationPlan(fields_allowed=['attributes', ])
+CREATE_CHILD_NODE_VALIDATION = ValidationPlan(fields_allowed=['attributes', ], with_pk=True)
+CHANGE_INNER_ORDER_VALIDATION = ValidationPlan(fields_required=['destination_node_id', ], with_pk=True)
+CHANGE_ATTRIBUTES_VALIDATION = ValidationPlan(fields_required=['attributes', ], fields_allowed=['merge_patch', ],
+                                              with_pk=True)
+CHANGE_ATTRIBUTES_BATCH_VALIDATION = ValidationPlan(fields_required=['attributes', ],
+                                                    fields_allowed=['node_ids', 'path', ])
+CHANGE_HIDDEN_VALIDATION = ValidationPlan(fields_required=['hidden', ], fields_allowed=['affect_descendants', ],
+                                          with_pk=True)
+CHANGE_HIDDEN_BATCH_VALIDATION = ValidationPlan(fields_required=['node_ids', 'hidden', ],
+                                                fields_allowed=['affect_descendants', ])
+CHANGE_PARENT_VALIDATION = ValidationPlan(fields_required=['new_parent_id', ],
+                                          fields_allowed=['before_node_id', 'after_node_id', ], with_pk=True)
+CLONE_SUBTREE_VALIDATION = ValidationPlan(fields_allowed=['new_parent_id', 'target_project_id', 'target_item_type',
+                                                          'target_item', ], with_pk=True)
+TARGET_TREE_FIELDS = ('target_project_id', 'target_item_type', 'target_item')
+
+# условие на дерево для raw SQL: project_id - ключ секционирования таблицы, без него Postgres не отсекает секции
+TREE_CONDITION = "project_id = %(project_id)s AND item_type = %(item_type)s AND item = %(item)s"
+
+
+# Фрагменты SQL для сдвига номера узла среди соседей. Номер - 10 символов inner_order, начиная с offset (длина
+# inner_order родителя). Длина inner_order при сдвиге не меняется, поэтому сдвиги на разных уровнях можно применять
+# к одной строке последовательно
+IN_OLD_SIBLINGS_SQL = """(
+    path LIKE %(old_parent_path)s || '%%'
+    AND LENGTH(path) > %(old_parent_path_length)s
+    AND CAST(SUBSTR(inner_order, %(old_offset)s + 1, 10) AS BIGINT) > %(old_position)s
+)"""
+IN_NEW_SIBLINGS_SQL = """(
+    path LIKE %(new_parent_path)s || '%%'
+    AND LENGTH(path) > %(new_parent_path_length)s
+    AND CAST(SUBSTR(inner_order, %(new_offset)s + 1, 10) AS BIGINT) >= %(new_position)s
+)"""
+COMPACT_OLD_SIBLINGS_SQL = f"""CASE WHEN {IN_OLD_SIBLINGS_SQL}
+    THEN OVERLAY(inner_order PLACING
+        LPAD(CAST(CAST(SUBSTR(inner_order, %(old_offset)s + 1, 10) AS BIGINT) - 1 AS TEXT), 10, '0')
+        FROM %(old_offset)s + 1 FOR 10)
+    ELSE inner_order
+END"""
+
+# перемещение узла к новому родителю: бывшие соседи после узла сдвигаются на одно место вверх, новые соседи начиная
+# с new_position - на одно место вниз, поддерево получает новые path, inner_order, depth
+CHANGE_PARENT_SQL = f"""
+UPDATE tree_structure_node
+    SET path = CASE
+            WHEN path LIKE %(movable_path)s || '%%'
+            THEN %(new_parent_path)s || SUBSTR(path, %(old_parent_path_length)s + 1)
+            ELSE path
+        END,
+        inner_order = CASE
+            WHEN path LIKE %(movable_path)s || '%%'
+            THEN %(new_inner_order)s || SUBSTR(inner_order, %(movable_inner_order_length)s + 1)
+            WHEN {IN_NEW_SIBLINGS_SQL}
+            THEN OVERLAY(({COMPACT_OLD_SIBLINGS_SQL}) PLACING
+                LPAD(CAST(CAST(SUBSTR(inner_order, %(new_offset)s + 1, 10) AS BIGINT) + 1 AS TEXT), 10, '0')
+                FROM %(new_offset)s + 1 FOR 10)
+            ELSE {COMPACT_OLD_SIBLINGS_SQL}
+        END,
+        depth = CASE WHEN path LIKE %(movable_path)s || '%%' THEN depth + %(depth_delta)s ELSE depth END,
+        parent_id = CASE WHEN id = %(movable_id)s THEN %(new_parent_id)s ELSE parent_id END
+    WHERE {TREE_CONDITION}
+        AND (path LIKE %(movable_path)s || '%%' OR {IN_OLD_SIBLINGS_SQL} OR {IN_NEW_SIBLINGS_SQL});
+"""
+
+# перестановка узла среди соседей: узел со всем поддеревом встает на new_position, соседи с номерами от
+# first_shifted до last_shifted сдвигаются на shift. Заодно узлу (и потомкам, если affect_descendants) выставляется
+# hidden; строки поддерева, у которых не меняются ни номер, ни hidden, не обновляются
+HIDDEN_TARGET_SQL = "(id = %(movable_id)s OR %(affect_descendants)s AND path LIKE %(movable_path)s || '%%')"
+MOVE_AMONG_SIBLINGS_SQL = f"""
+UPDATE tree_structure_node
+    SET inner_order = CASE
+            WHEN path LIKE %(movable_path)s || '%%'
+            THEN OVERLAY(inner_order PLACING %(new_segment)s FROM %(offset)s + 1 FOR 10)
+            ELSE OVERLAY(inner_order PLACING
+                LPAD(CAST(CAST(SUBSTR(inner_order, %(offset)s + 1, 10) AS BIGINT) + %(shift)s AS TEXT), 10, '0')
+                FROM %(offset)s + 1 FOR 10)
+        END,
+        hidden = CASE WHEN {HIDDEN_TARGET_SQL} THEN %(hidden)s ELSE hidden END
+    WHERE {TREE_CONDITION}
+        AND (
+            path LIKE %(movable_path)s || '%%'
+                AND (%(old_position)s != %(new_position)s
+                    OR {HIDDEN_TARGET_SQL} AND hidden IS DISTINCT FROM %(hidden)s)
+            OR path LIKE %(parent_path)s || '%%'
+                AND LENGTH(path) > %(parent_path_length)s
+                AND CAST(SUBSTR(inner_order, %(offset)s + 1, 10) AS BIGINT)
+                    BETWEEN %(first_shifted)s AND %(last_shifted)s
+        );
+"""
+
+# копирование поддерева: id копий берутся из последовательности одним запросом, path собирается из новых id
+# по сегментам старого path. Скрытые узлы не копируются, поэтому номера соседей внутри копии назначаются заново
+# подряд с 1 в прежнем порядке, inner_order собирается из новых номеров по тем же сегментам. Возвращает id копии
+# узла и число созданных узлов
+CLONE_SUBTREE_SQL = f"""
+WITH source AS (
+    SELECT node.*, ROW_NUMBER() OVER (ORDER BY node.path) AS rn
+    FROM tree_structure_node AS node
+    WHERE {TREE_CONDITION}
+        AND path LIKE %(source_path)s || '%%'
+        AND NOT EXISTS (
+            SELECT 1 FROM tree_structure_node AS hidden_node
+            WHERE hidden_node.project_id = node.project_id
+                AND hidden_node.item_type = node.item_type
+                AND hidden_node.item = node.item
+                AND hidden_node.hidden
+                AND hidden_node.path LIKE %(source_path)s || '%%'
+                AND node.path LIKE hidden_node.path || '%%'
+        )
+),
+positions AS (
+    SELECT id, LPAD(CAST(ROW_NUMBER() OVER (PARTITION BY parent_id ORDER BY inner_order) AS TEXT), 10, '0')
+        AS position
+    FROM source
+    WHERE id != %(source_id)s
+),
+new_ids AS (
+    SELECT nextval(pg_get_serial_sequence('tree_structure_node', 'id')) AS new_id, rn
+    FROM generate_series(1, (SELECT COUNT(*) FROM source)) AS rn
+),
+id_map AS (
+    SELECT source.id AS old_id, new_ids.new_id
+    FROM source JOIN new_ids USING (rn)
+),
+new_paths AS (
+    SELECT source.id,
+           STRING_AGG(LPAD(CAST(id_map.new_id AS TEXT), 10, '0'), '' ORDER BY segment) AS path,
+           COALESCE(STRING_AGG(positions.position, '' ORDER BY segment), '') AS inner_order
+    FROM source
+    CROSS JOIN LATERAL generate_series(0, (LENGTH(source.path) - %(source_parent_path_length)s) / 10 - 1) AS segment
+    JOIN id_map
+        ON id_map.old_id = CAST(SUBSTR(source.path, %(source_parent_path_length)s + segment * 10 + 1, 10) AS BIGINT)
+    LEFT JOIN positions ON positions.id = id_map.old_id
+    GROUP BY source.id
+),
+inserted AS (
+    INSERT INTO tree_structure_node (id, path, project_id, item_type, item, inner_order, attributes, hidden, depth,
+                                     parent_id)
+    SELECT id_map.new_id,
+           %(new_parent_path)s || new_paths.path,
+           %(target_project_id)s,
+           %(target_item_type)s,
+           %(target_item)s,
+           %(new_inner_order)s || new_paths.inner_order,
+           source.attributes,
+           NULL,
+           source.depth + %(depth_delta)s,
+           CASE WHEN source.id = %(source_id)s THEN %(new_parent_id)s ELSE parent_map.new_id END
+    FROM source
+    JOIN id_map ON id_map.old_id = source.id
+    JOIN new_paths ON new_paths.id = source.id
+    LEFT JOIN id_map AS parent_map ON parent_map.old_id = source.parent_id
+    RETURNING id, path
+)
+SELECT MIN(id) FILTER (WHERE LENGTH(path) = LENGTH(%(new_parent_path)s) + 10), COUNT(*) FROM inserted;
+"""
+
+# JSON merge patch (функция jsonb_merge_patch из миграции 0005) к attributes нескрытых узлов. attributes хранятся
+# строкой json внутри jsonb: строка разбирается, патчится и записывается обратно строкой. Обновляются только узлы,
+# у которых attributes изменились по содержанию
+MERGE_ATTRIBUTES_SQL = """
+UPDATE tree_structure_node AS node
+    SET attributes = to_jsonb(patched.attributes::text)
+    FROM (
+        SELECT id, project_id, jsonb_merge_patch(current, %(patch)s::jsonb) AS attributes, current
+        FROM (
+            SELECT id, project_id,
+                CASE jsonb_typeof(attributes)
+                    WHEN 'string' THEN (attributes #>> '{{}}')::jsonb
+                    WHEN 'object' THEN attributes
+                END AS current
+            FROM tree_structure_node
+            WHERE {TREE_CONDITION} AND hidden IS NOT TRUE AND {nodes_condition}
+        ) AS source
+    ) AS patched
+    WHERE node.id = patched.id AND node.project_id = patched.project_id
+        AND patched.attributes IS DISTINCT FROM patched.current
+    RETURNING node.id, patched.attributes::text;
+"""
+
+# подготовленные на сервере запросы, см. core.prepared_statements
+CHANGE_PARENT_STATEMENT = prepared_statements.PreparedStatement('tree_change_parent', CHANGE_PARENT_SQL)
+MOVE_AMONG_SIBLINGS_STATEMENT = prepared_statements.PreparedStatement('tree_move_among_siblings',
+                                                                      MOVE_AMONG_SIBLINGS_SQL)
+CLONE_SUBTREE_STATEMENT = prepared_statements.PreparedStatement('tree_clone_subtree', CLONE_SUBTREE_SQL)
+MERGE_ATTRIBUTES_BY_IDS_STATEMENT = prepared_statements.PreparedStatement(
+    'tree_merge_attributes_by_ids',
+    MERGE_ATTRIBUTES_SQL.format(TREE_CONDITION=TREE_CONDITION, nodes_condition='id = ANY(%(node_ids)s)'),
+)
+# поддерево - диапазон path, а не LIKE: в общем плане подготовленного запроса префикс неизвестен при планировании,
+# и LIKE не использует индекс. path состоит из цифр, граница - префикс с буквой: в C, glibc и ICU буквы сортируются
+# после цифр (знаки препинания, например ':', в glibc-локалях при сравнении пропускаются)
+MERGE_ATTRIBUTES_BY_PATH_STATEMENT = prepared_statements.PreparedStatement(
+    'tree_merge_attributes_by_path',
+    MERGE_ATTRIBUTES_SQL.format(TREE_CONDITION=TREE_CONDITION,
+                                nodes_condition="path >= %(path)s AND path < %(path)s || 'a'"),
+)
+
+# если изменилось больше узлов, снимки и индексы деревьев собираются заново, а не патчатся по списку id
+MAX_CHANGED_ATTRIBUTES = 1000
+
+
+def tree_key(data: dict) -> str:
+    """Ключ дерева для маршрутизации чтения и отметок об изменениях"""
+    return f"{data['project_id']}/{data['item_type']}/{data['item']}"
+
+
+def tree_changed(data: dict, changed_attributes: list = None):
+    """
+    Вызывается методами записи внутри транзакции: после коммита увеличивается версия дерева (устаревают снимки
+    и индексы дерева), а чтения дерева временно закрепляются за primary. changed_attributes - id узлов, если
+    запись изменила только их attributes
+    """
+    key = tree_key(data)
+
+    def on_commit():
+        tree_versions.bump_version(key, changed_attributes)
+        pin_to_primary(key)
+
+    transaction.on_commit(on_commit)
+
+
+def tree_params(data: dict) -> dict:
+    """Параметры для TREE_CONDITION"""
+    return {'project_id': data['project_id'], 'item_type': data['item_type'], 'item': data['item']}
+
+
+def add_children_counts(nodes: list, children) -> list:
+    """
+    Добавляет узлам выдачи has_children и child_count (число нескрытых детей). children - queryset нескрытых узлов,
+    среди которых есть все дети узлов выдачи, считается одним запросом с группировкой по parent_id
+    """
+    counts = dict(children.order_by().values('parent_id').annotate(count=Count('id')).values_list('parent_id', 'count'))
+    for node in nodes:
+        count = counts.get(node['id'], 0)
+        node['has_children'] = count > 0
+        node['child_count'] = count
+    return nodes
+
+
 def get_node(data: dict, pk: int) -> dict:
     """Функция получения узла из модели Node"""
 
-    validate = Validate(data, pk=pk)
-    validate()
+    data = GET_NODE_VALIDATION(data, pk)
 
-    instance = Node.objects.filter(
-        pk=pk,
-        project_id=data.get('project_id'),
-        item_type=data.get('item_type'),
-        item=data.get('item'),
-    ) \
-        .exclude(hidden=True) \
-        .first()
+    with read_from_replica(tree_key(data)):
+        instance = Node.objects.filter(
+            pk=pk,
+            project_id=data.get('project_id'),
+            item_type=data.get('item_type'),
+            item=data.get('item'),
+        ) \
+            .exclude(hidden=True) \
+            .first()
+
+        if instance and data.get('with_children'):
+            children = Node.objects.filter(**tree_params(data), parent_id=instance.id).exclude(hidden=True)
+            return add_children_counts([serialize_node(instance)], children)[0]
 
     if not instance:
-        logger.info(f'{validate.ERR_DOES_NOT_EXIST_OBJ}')
-        raise ValidateError({'error': validate.ERR_DOES_NOT_EXIST_OBJ}, status=status.HTTP_404_NOT_FOUND)
+        logger.info(f'{ValidateError.ERR_DOES_NOT_EXIST_OBJ}')
+        raise ValidateError({'error': ValidateError.ERR_DOES_NOT_EXIST_OBJ}, status=status.HTTP_404_NOT_FOUND)
 
-    serializer = NodeSerializer(instance, many=False).data
-    return serializer
+    return serialize_node(instance)
 
 
-def get_nodes(data: dict, pk: int) -> dict:
-    """Функция вывода узлов дерева из модели Node"""
+def get_nodes(data: dict, pk: int) -> Union[list, PreRenderedJSON]:
+    """
+    Функция вывода узлов дерева из модели Node. Результат get_tree / get_descendants - список узлов или уже
+    закодированный JSON (снимок, результат другого воркера), для разбора - core.renderers.as_data
+    """
     if not pk:
         result = get_tree(data)
         return result
@@ -45,13 +304,14 @@ def get_nodes(data: dict, pk: int) -> dict:
         return result
 
 
-def get_tree(data: dict) -> dict:
+def get_tree(data: dict) -> Union[list, PreRenderedJSON]:
     """Функция вывода всех узлов дерева из модели Node"""
 
-    fields_allowed = ['sort_by_id', ]
-    validate = Validate(data)
-    validate(fields_allowed=fields_allowed)
+    data = GET_TREE_VALIDATION(data)
+    return single_flight.coalesce('get_tree', tree_key(data), data, None, lambda: _get_tree(data))
 
+
+def _get_tree(data: dict) -> Union[list, PreRenderedJSON]:
     sort_by_id = data.get('sort_by_id', False)
     sort_by = 'id' if sort_by_id else 'inner_order'
 
@@ -63,53 +323,92 @@ def get_tree(data: dict) -> dict:
         .exclude(hidden=True) \
         .order_by(sort_by)
 
-    result = NodeSerializer(instance, many=True).data
+    if data.get('with_children'):
+        # в снимках и индексе счетчиков детей нет
+        with read_from_replica(tree_key(data)):
+            return add_children_counts(serialize_node_rows(values_nodes(instance)), instance)
+
+    with read_from_replica(tree_key(data)):
+        # снимок собирается по primary, чтобы совпасть с версией дерева
+        snapshot = snapshots.get_tree(tree_key(data), data, sort_by,
+                                      lambda: serialize_node_rows(values_nodes(instance.using(DEFAULT_DB_ALIAS))))
+    if snapshot:
+        return snapshot
+
+    index = tree_index.get_index(tree_key(data), data)
+    if index:
+        return index.tree(bool(sort_by_id))
+
+    with read_from_replica(tree_key(data)):
+        result = serialize_node_rows(values_nodes(instance))
     return result
 
 
-def get_descendants(data: dict, pk: int) -> dict:
+def get_descendants(data: dict, pk: int) -> Union[list, PreRenderedJSON]:
     """Функция вывода всех дочерних узлов из модели Node"""
 
-    fields_allowed = ['sort_by_id', 'depth', ]
-    validate = Validate(data, pk=pk)
-    validate(fields_allowed=fields_allowed)
-
-    instance = Node.objects.filter(
-        pk=pk,
-        project_id=data['project_id'],
-        item_type=data['item_type'],
-        item=data['item'],
-    ) \
-        .exclude(hidden=True) \
-        .first()
+    data = GET_DESCENDANTS_VALIDATION(data, pk)
+    return single_flight.coalesce('get_descendants', tree_key(data), data, pk, lambda: _get_descendants(data, pk))
 
-    if not instance:
-        logger.info(f'{validate.ERR_DOES_NOT_EXIST_OBJ}')
-        raise ValidateError({'error': validate.ERR_DOES_NOT_EXIST_OBJ}, status=status.HTTP_404_NOT_FOUND)
 
-    # получаем path родителя
-    path = instance.path
-    # формируем path дочерних узлов
-    path += '0' * (10 - len(str(instance.id))) + str(instance.id)
+def _get_descendants(data: dict, pk: int) -> list:
+    # в индексе счетчиков детей нет
+    index = tree_index.get_index(tree_key(data), data) if not data.get('with_children') else None
+    if index:
+        result = index.descendants(pk, data.get('depth'), bool(data.get('sort_by_id', False)))
+        if result is None:
+            logger.info(f'{ValidateError.ERR_DOES_NOT_EXIST_OBJ}')
+            raise ValidateError({'error': ValidateError.ERR_DOES_NOT_EXIST_OBJ}, status=status.HTTP_404_NOT_FOUND)
+        return result
 
-    sort_by_id = data.get('sort_by_id', False)
-    sort_by = 'id' if sort_by_id else 'inner_order'
+    with read_from_replica(tree_key(data)):
+        instance = Node.objects.filter(
+            pk=pk,
+            project_id=data['project_id'],
+            item_type=data['item_type'],
+            item=data['item'],
+        ) \
+            .exclude(hidden=True) \
+            .first()
+
+        if not instance:
+            logger.info(f'{ValidateError.ERR_DOES_NOT_EXIST_OBJ}')
+            raise ValidateError({'error': ValidateError.ERR_DOES_NOT_EXIST_OBJ}, status=status.HTTP_404_NOT_FOUND)
+
+        sort_by_id = data.get('sort_by_id', False)
+        sort_by = 'id' if sort_by_id else 'inner_order'
+
+        depth = data.get('depth')
+
+        descendants = Node.objects.filter(
+            project_id=data['project_id'],
+            item_type=data['item_type'],
+            item=data['item']
+        )
+
+        if depth == 1:
+            # только дети узла - поиск по индексу parent_id
+            descendants = descendants.filter(parent_id=instance.id)
+        elif depth:
+            descendants = descendants.filter(path__startswith=instance.path,
+                                             depth__gt=instance.depth,
+                                             depth__lte=instance.depth + depth)
+        else:
+            descendants = descendants.filter(path__startswith=instance.path, depth__gt=instance.depth)
 
-    depth = int(data.get('depth')) if data.get('depth') else 9999999999
+        nodes = descendants \
+            .exclude(hidden=True) \
+            .order_by(sort_by)
 
-    instance = Node.objects.filter(
-        path__startswith=path[:-10],
-        project_id=data['project_id'],
-        item_type=data['item_type'],
-        item=data['item']
-    ) \
-        .annotate(path_len=Length('path')) \
-        .exclude(path=instance.path) \
-        .exclude(hidden=True) \
-        .filter(path_len__lt=(len(instance.path) + 1 + 10 * depth)) \
-        .order_by(sort_by)
+        result = serialize_node_rows(values_nodes(nodes))
 
-    result = NodeSerializer(instance, many=True).data
+        if data.get('with_children'):
+            # дети узлов выдачи - нескрытые потомки instance на один уровень глубже выдачи
+            children = Node.objects.filter(**tree_params(data), path__startswith=instance.path,
+                                           depth__gt=instance.depth + 1)
+            if depth:
+                children = children.filter(depth__lte=instance.depth + depth + 1)
+            add_children_counts(result, children.exclude(hidden=True))
     return result
 
 
@@ -120,9 +419,9 @@ def create_root_node(data: dict, path: str) -> object:
                 project_id=data['project_id'],
                 item_type=data['item_type'],
                 item=data['item'],
+                depth=1,
             ) \
-                .annotate(path_len=Length('path')) \
-                .filter(path_len__lt=11).count()
+                .count()
 
             inner_order = '0' * (10 - len(str(amount_nodes + 1))) + str(amount_nodes + 1)
 
@@ -137,51 +436,56 @@ def create_root_node(data: dict, path: str) -> object:
 
             path = '0' * (10 - len(str(node_new.id))) + str(node_new.id)
             node_new.path = path
-            node_new.save()
+            # обновление с ключом секционирования project_id, чтобы не перебирать все секции таблицы
+            Node.objects.filter(id=node_new.id, project_id=node_new.project_id).update(path=node_new.path)
 
     except DatabaseError as e:
+        if transactions.is_retryable(e):
+            raise
         logger.error(f'{e}')
         raise ValidateError({'error': e}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     return node_new
 
 
-def create_child_node(data: dict, path: str, parent_inner_order: str) -> object:
+def create_child_node(data: dict, parent: Node) -> object:
     try:
         with transaction.atomic():
             amount_nodes = Node.objects.select_for_update().filter(
-                path__startswith=path,
                 project_id=data['project_id'],
                 item_type=data['item_type'],
                 item=data['item'],
+                parent_id=parent.id,
             ) \
-                .annotate(path_len=Length('path')) \
-                .exclude(path=path) \
-                .filter(path_len__lt=len(path) + 11) \
                 .count()
 
-            inner_order = parent_inner_order + ('0' * (10 - len(str(amount_nodes + 1))) + str(amount_nodes + 1))
+            inner_order = parent.inner_order + ('0' * (10 - len(str(amount_nodes + 1))) + str(amount_nodes + 1))
 
             node_new = Node.objects.create(
-                path=path,
+                path=parent.path,
                 project_id=data['project_id'],
                 item_type=data['item_type'],
                 item=data['item'],
                 inner_order=inner_order,
                 attributes=data.get('attributes'),
+                depth=parent.depth + 1,
+                parent_id=parent.id,
             )
 
             path = '0' * (10 - len(str(node_new.id))) + str(node_new.id)
             node_new.path += path
-            node_new.save()
+            Node.objects.filter(id=node_new.id, project_id=node_new.project_id).update(path=node_new.path)
 
     except DatabaseError as e:
+        if transactions.is_retryable(e):
+            raise
         logger.error(f'{e}')
         raise ValidationError({'error': e})
 
     return node_new
 
 
+@transactions.retry_transaction('create_node')
 def create_node(data: dict, pk: int):
     """Метод создания нового узла в модели Node
     Если в url запроса передается <id>,
@@ -190,13 +494,10 @@ def create_node(data: dict, pk: int):
     то будет создан корневой узел.
     """
 
-    fields_allowed = ['attributes']
-
     try:
         with transaction.atomic():
             if pk:
-                validate = Validate(data, pk=pk)
-                validate(fields_allowed=fields_allowed)
+                data = CREATE_CHILD_NODE_VALIDATION(data, pk)
 
                 instance = Node.objects.select_for_update().filter(
                     pk=pk,
@@ -209,8 +510,8 @@ def create_node(data: dict, pk: int):
                     .first()
 
                 if not instance:
-                    logger.info(f'{validate.ERR_OBJ_NOT_RECEIVED}')
-                    raise ValidateError({'error': validate.ERR_OBJ_NOT_RECEIVED},
+                    logger.info(f'{ValidateError.ERR_OBJ_NOT_RECEIVED}')
+                    raise ValidateError({'error': ValidateError.ERR_OBJ_NOT_RECEIVED},
                                         status=status.HTTP_404_NOT_FOUND)
 
                 kwargs = {
@@ -220,58 +521,42 @@ def create_node(data: dict, pk: int):
                     'path': instance.path,
                     'id': instance.id
                 }
-                validate.validate_value_fields_for_create_child(**kwargs)
+                validate_value_fields_for_create_child(data, **kwargs)
 
-                node_new = create_child_node(data, instance.path, instance.inner_order)
+                node_new = create_child_node(data, instance)
             else:
-                validate = Validate(data)
-                validate(fields_allowed=fields_allowed)
+                data = CREATE_ROOT_NODE_VALIDATION(data)
 
                 node_new = create_root_node(data, "9999999999")
+
+            tree_changed(data)
     except DatabaseError as e:
+        if transactions.is_retryable(e):
+            raise
         logger.error(f'{e}')
         raise ValidationError({'error': e})
 
-    return NewNodeSerializer(node_new).data
+    return serialize_node(node_new)
 
 
-def change_inner_order_attr_node(data: dict, pk: int, internal_use: bool = False):
-    """Функция смены inner_order"""
+@transactions.retry_transaction('change_inner_order')
+def change_inner_order_attr_node(data: dict, pk: int):
+    """
+    Функция смены inner_order: узел встает на место destination_node_id, соседи между ними сдвигаются на одно
+    место. Перестановка выполняется одним UPDATE
+    """
 
-    fields_required = [*data.keys()] if internal_use else ['destination_node_id', ]
-    validate = Validate(data, pk=pk)
-    validate(fields_required=fields_required)
+    data = CHANGE_INNER_ORDER_VALIDATION(data, pk)
 
-    # проверяем наличие поля destination_node_id, если internal_use = True, то устанавливаем в destination_node_id
-    # последний узел
+    # проверяем наличие поля destination_node_id
     if not data.get('destination_node_id'):
-        if internal_use:
-            parent_path = Node.objects.filter(id=pk).first().path[:-10]
-            destination_node_id = Node.objects.filter(
-                path__startswith=parent_path,
-                project_id=data['project_id'],
-                item_type=data['item_type'],
-                item=data['item']
-            ) \
-                .annotate(path_len=Length('path')) \
-                .exclude(path=parent_path) \
-                .exclude(hidden=True) \
-                .filter(path_len__lt=len(parent_path) + 11) \
-                .order_by('inner_order') \
-                .last() \
-                .id
-
-            data.update({
-                'destination_node_id': destination_node_id
-            })
-        else:
-            logger.info(f'{validate.ERR_DESTINATION_ID_NOT_NONE}')
-            raise ValidateError({'error': validate.ERR_DESTINATION_ID_NOT_NONE},
-                                status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        logger.info(f'{ValidateError.ERR_DESTINATION_ID_NOT_NONE}')
+        raise ValidateError({'error': ValidateError.ERR_DESTINATION_ID_NOT_NONE},
+                            status=status.HTTP_422_UNPROCESSABLE_ENTITY)
 
-    if pk == int(data.get("destination_node_id")) and not internal_use:
-        logger.info(f'{validate.ERR_MOVE_ID_NOT_EQUAL_DESTINATION_ID}')
-        raise ValidateError({'error': validate.ERR_MOVE_ID_NOT_EQUAL_DESTINATION_ID},
+    if pk == int(data.get("destination_node_id")):
+        logger.info(f'{ValidateError.ERR_MOVE_ID_NOT_EQUAL_DESTINATION_ID}')
+        raise ValidateError({'error': ValidateError.ERR_MOVE_ID_NOT_EQUAL_DESTINATION_ID},
                             status=status.HTTP_400_BAD_REQUEST)
 
     try:
@@ -287,8 +572,8 @@ def change_inner_order_attr_node(data: dict, pk: int, internal_use: bool = False
                 .first()
 
             if not movable_instance:
-                logger.info(f'{validate.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=pk)}')
-                raise ValidateError({'error': validate.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=pk)},
+                logger.info(f'{ValidateError.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=pk)}')
+                raise ValidateError({'error': ValidateError.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=pk)},
                                     status=status.HTTP_404_NOT_FOUND)
 
             # получаем узел, на место которого двигаем
@@ -302,139 +587,58 @@ def change_inner_order_attr_node(data: dict, pk: int, internal_use: bool = False
                 .first()
 
             if not destination_instance:
-                logger.info(f'{validate.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=data.get("destination_node_id"))}')
+                logger.info(f'{ValidateError.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=data.get("destination_node_id"))}')
                 raise ValidateError(
                     {
-                        'error': validate.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=data.get("destination_node_id"))
+                        'error': ValidateError.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=data.get("destination_node_id"))
                     },
                     status=status.HTTP_404_NOT_FOUND
                 )
 
             if movable_instance.path[:-10] != destination_instance.path[:-10]:
-                logger.info(f'{validate.ERR_OBJ_NOT_BELONG_PARENT.format(destination_obj=data.get("destination_node_id"), parent_obj=pk)}')
+                logger.info(f'{ValidateError.ERR_OBJ_NOT_BELONG_PARENT.format(destination_obj=data.get("destination_node_id"), parent_obj=pk)}')
                 raise ValidateError(
                     {
-                        'error': validate.ERR_OBJ_NOT_BELONG_PARENT.format(
+                        'error': ValidateError.ERR_OBJ_NOT_BELONG_PARENT.format(
                             destination_obj=data.get("destination_node_id"), parent_obj=pk)
                     },
                     status=status.HTTP_422_UNPROCESSABLE_ENTITY
                 )
 
-            parent_path = destination_instance.path[:-10]
-
-            # если двигаем узел вниз
-            if int(movable_instance.inner_order[-10:]) < int(destination_instance.inner_order[-10:]):
-
-                with connection.cursor() as cursor:
-
-                    sql_params = f"""
-UPDATE tree_structure_node
-    SET inner_order = CASE
-        WHEN 
-            LENGTH(CAST(CAST(SUBSTR(inner_order, LENGTH('{destination_instance.inner_order}') - 9, 10) 
-            AS INTEGER) AS TEXT)) >
-            LENGTH(CAST(CAST(SUBSTR(inner_order, LENGTH('{destination_instance.inner_order}') - 9, 10) 
-            AS INTEGER) - 1 AS TEXT))
-        THEN
-            LEFT(inner_order, LENGTH('{destination_instance.inner_order}') - 
-            LENGTH(CAST(CAST(SUBSTR(inner_order, LENGTH('{destination_instance.inner_order}') - 9, 10) 
-            AS INTEGER) AS TEXT)))||'0'||
-            CAST(CAST(SUBSTR(inner_order, LENGTH('{destination_instance.inner_order}') - 9, 10) 
-            AS INTEGER) - 1 AS TEXT)||
-            RIGHT(inner_order, -LENGTH('{destination_instance.inner_order}'))
-        ELSE
-            LEFT(inner_order, LENGTH('{destination_instance.inner_order}') - 
-            LENGTH(CAST(CAST(SUBSTR(inner_order, LENGTH('{destination_instance.inner_order}') - 9, 10)
-            AS INTEGER) - 1 AS TEXT)))||
-            CAST(CAST(SUBSTR(inner_order, LENGTH('{destination_instance.inner_order}') - 9, 10) 
-            AS INTEGER) - 1 AS TEXT)||
-            RIGHT(inner_order, -LENGTH('{destination_instance.inner_order}'))
-        END
-    WHERE path LIKE '{parent_path}%' 
-        AND path != '{parent_path}'
-        AND (hidden IS NULL OR hidden = false)
-        AND inner_order BETWEEN '{movable_instance.inner_order}' AND '{destination_instance.inner_order}'
-        OR inner_order LIKE '{destination_instance.inner_order}%';
+            old_position = int(movable_instance.inner_order[-10:])
+            new_position = int(destination_instance.inner_order[-10:])
 
+            # если двигаем узел вниз, соседи до места назначения поднимаются на одно место
+            if old_position < new_position:
+                first_shifted, last_shifted, shift = old_position + 1, new_position, -1
 
-UPDATE tree_structure_node
-    SET inner_order = '{destination_instance.inner_order}'||RIGHT(inner_order, -LENGTH('{movable_instance.inner_order}'))
-    WHERE path LIKE '{movable_instance.path}%'
-    RETURNING *;
-                    """
-
-                    cursor.execute(sql_params)
-
-                    columns = [col[0] for col in cursor.description]
-                    result = [dict(zip(columns, row)) for row in cursor.fetchall()]
-
-            # если двигаем узел вверх
-            elif int(movable_instance.inner_order[-10:]) > int(destination_instance.inner_order[-10:]):
-
-                with connection.cursor() as cursor:
-
-                    sql_params = f"""
-UPDATE tree_structure_node
-    SET inner_order = CASE
-        WHEN 
-            LENGTH(CAST(CAST(SUBSTR(inner_order, LENGTH('{destination_instance.inner_order}') - 9, 10) 
-            AS INTEGER) AS TEXT)) <
-            LENGTH(CAST(CAST(SUBSTR(inner_order, LENGTH('{destination_instance.inner_order}') - 9, 10) 
-            AS INTEGER) + 1 AS TEXT))
-        THEN
-            LEFT(inner_order, LENGTH('{destination_instance.inner_order}') - 
-            LENGTH(CAST(CAST(SUBSTR(inner_order, LENGTH('{destination_instance.inner_order}') - 9, 10) 
-            AS INTEGER) AS TEXT)) - 1)||
-            CAST(CAST(SUBSTR(inner_order, LENGTH('{destination_instance.inner_order}') - 9, 10) 
-            AS INTEGER) + 1 AS TEXT)||
-            RIGHT(inner_order, -LENGTH('{destination_instance.inner_order}'))
-        ELSE
-            LEFT(inner_order, LENGTH('{destination_instance.inner_order}') - 
-            LENGTH(CAST(CAST(SUBSTR(inner_order, LENGTH('{destination_instance.inner_order}') - 9, 10) 
-            AS INTEGER) AS TEXT)))||
-            CAST(CAST(SUBSTR(inner_order, LENGTH('{destination_instance.inner_order}') - 9, 10) 
-            AS INTEGER) + 1 AS TEXT)||
-            RIGHT(inner_order, -LENGTH('{destination_instance.inner_order}'))
-        END
-    WHERE path LIKE '{parent_path}%' 
-        AND path != '{parent_path}'
-        AND (hidden IS NULL OR hidden = false)
-        AND inner_order BETWEEN '{destination_instance.inner_order}' AND '{movable_instance.inner_order}'
-        OR inner_order LIKE '{destination_instance.inner_order}%';
-
-
-UPDATE tree_structure_node
-    SET inner_order = '{destination_instance.inner_order}'||
-        RIGHT(inner_order, -LENGTH('{movable_instance.inner_order}'))
-    WHERE path LIKE '{movable_instance.path}%'
-    RETURNING *;
-                                        """
-
-                    cursor.execute(sql_params)
+            # если двигаем узел вверх, соседи начиная с места назначения опускаются на одно место
+            elif old_position > new_position:
+                first_shifted, last_shifted, shift = new_position, old_position - 1, 1
 
-                    columns = [col[0] for col in cursor.description]
-                    result = [dict(zip(columns, row)) for row in cursor.fetchall()]
-
-            elif not internal_use:
-                logger.info(f'{validate.ERR_MOVE_ORDER_NOT_EQUAL_DESTINATION_ORDER}')
-                raise ValidateError({'error': validate.ERR_MOVE_ORDER_NOT_EQUAL_DESTINATION_ORDER},
+            else:
+                logger.info(f'{ValidateError.ERR_MOVE_ORDER_NOT_EQUAL_DESTINATION_ORDER}')
+                raise ValidateError({'error': ValidateError.ERR_MOVE_ORDER_NOT_EQUAL_DESTINATION_ORDER},
                                     status=status.HTTP_422_UNPROCESSABLE_ENTITY)
 
-            else:
-                return None
+            _move_among_siblings(data, movable_instance, new_position, first_shifted, last_shifted, shift,
+                                 hidden=movable_instance.hidden, affect_descendants=False)
+
+            tree_changed(data)
     except DatabaseError as e:
+        if transactions.is_retryable(e):
+            raise
         logger.error(f'{e}')
         raise ValidateError({'error': e}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     return f'Node {movable_instance.id} moved on node\'s {destination_instance.id} position'
 
 
+@transactions.retry_transaction('change_attributes')
 def change_attributes_attr_node(data: dict, pk: int):
     """Функция изменения значения поля attributes в модели Node"""
 
-    fields_required = ['attributes', ]
-    validate = Validate(data, pk=pk)
-    validate(fields_required=fields_required)
+    data = CHANGE_ATTRIBUTES_VALIDATION(data, pk)
 
     try:
         with transaction.atomic():
@@ -448,24 +652,89 @@ def change_attributes_attr_node(data: dict, pk: int):
                 .first()
 
             if not instance:
-                logger.info(f'{validate.ERR_DOES_NOT_EXIST_OBJ}')
-                raise ValidateError({'error': validate.ERR_DOES_NOT_EXIST_OBJ},
+                logger.info(f'{ValidateError.ERR_DOES_NOT_EXIST_OBJ}')
+                raise ValidateError({'error': ValidateError.ERR_DOES_NOT_EXIST_OBJ},
                                     status=status.HTTP_404_NOT_FOUND)
 
-            instance.attributes = data.get('attributes')
-            instance.save(update_fields=['attributes'])
+            if data.get('merge_patch'):
+                _check_merge_patch(data)
+                changed = _merge_attributes(data, MERGE_ATTRIBUTES_BY_IDS_STATEMENT, {'node_ids': [instance.id]})
+                if not changed:
+                    return serialize_node(instance)
+                instance.attributes = changed[instance.id]
+            else:
+                instance.attributes = data.get('attributes')
+                Node.objects.filter(id=instance.id, project_id=instance.project_id) \
+                    .update(attributes=instance.attributes)
+
+            tree_changed(data, changed_attributes=[instance.id])
+    except DatabaseError as e:
+        if transactions.is_retryable(e):
+            raise
+        logger.error(f'{e}')
+        raise ValidateError({'error': e}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    return serialize_node(instance)
+
+
+@transactions.retry_transaction('change_attributes_batch')
+def change_attributes_attr_nodes(data: dict):
+    """
+    JSON merge patch (RFC 7386) из attributes ко всем нескрытым узлам из node_ids или к поддереву узла с path
+    (включая сам узел) одним UPDATE. Возвращает id узлов, у которых attributes изменились
+    """
+    data = CHANGE_ATTRIBUTES_BATCH_VALIDATION(data)
+
+    if ('node_ids' in data) == ('path' in data):
+        logger.info('one of node_ids or path is required')
+        raise ValidateError({'errors': ['one of node_ids or path is required']},
+                            status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    _check_merge_patch(data)
+
+    try:
+        with transaction.atomic():
+            if 'node_ids' in data:
+                changed = _merge_attributes(data, MERGE_ATTRIBUTES_BY_IDS_STATEMENT, {'node_ids': data['node_ids']})
+            else:
+                changed = _merge_attributes(data, MERGE_ATTRIBUTES_BY_PATH_STATEMENT, {'path': data['path']})
+
+            if changed:
+                tree_changed(data, changed_attributes=list(changed) if len(changed) <= MAX_CHANGED_ATTRIBUTES else None)
     except DatabaseError as e:
+        if transactions.is_retryable(e):
+            raise
         logger.error(f'{e}')
         raise ValidateError({'error': e}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    return UpdateNodeSerializer(instance).data
+    return {'changed_ids': sorted(changed)}
+
+
+def _check_merge_patch(data: dict):
+    """Патч attributes - json объект: null или пустая строка в merge patch заменили бы attributes целиком"""
+    if data.decoded_attributes is None:
+        error = ValidateError.ERR_WRONG_FORMAT_FIELD.format(field='attributes', format='json')
+        logger.info(error)
+        raise ValidateError({'errors': [error]}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+
+def _merge_attributes(data: dict, statement, params: dict) -> dict:
+    """Выполнение MERGE_ATTRIBUTES_SQL, {id: новые attributes} измененных узлов"""
+    with connection.cursor() as cursor:
+        prepared_statements.execute(cursor, statement, {
+            **tree_params(data),
+            **params,
+            'patch': json.dumps(data.decoded_attributes),
+        })
+        return dict(cursor.fetchall())
 
 
+@transactions.retry_transaction('change_hidden')
 def change_hidden_attr_node(data: dict, pk: int):
-    fields_allowed = ['affect_descendants', ]
-    fields_required = ['hidden', ]
-    validate = Validate(data, pk=pk)
-    validate(fields_required=fields_required, fields_allowed=fields_allowed)
+    """
+    Функция удаления (скрытия) и восстановления узла. Узел становится последним из нескрытых соседей, сдвиг
+    соседей и установка hidden выполняются одним UPDATE
+    """
+    data = CHANGE_HIDDEN_VALIDATION(data, pk)
 
     hidden = data.get('hidden')
 
@@ -482,35 +751,20 @@ def change_hidden_attr_node(data: dict, pk: int):
             ).first()
 
             if not instance:
-                logger.info(f'{validate.ERR_DOES_NOT_EXIST_OBJ}')
-                raise ValidateError({'error': validate.ERR_DOES_NOT_EXIST_OBJ}, status=status.HTTP_404_NOT_FOUND)
+                logger.info(f'{ValidateError.ERR_DOES_NOT_EXIST_OBJ}')
+                raise ValidateError({'error': ValidateError.ERR_DOES_NOT_EXIST_OBJ}, status=status.HTTP_404_NOT_FOUND)
 
             if instance.hidden == hidden:
                 logger.info(f'hidden is already set to {instance.hidden}')
                 raise ValidateError({'error': f'hidden is already set to {instance.hidden}'},
                                     status=status.HTTP_422_UNPROCESSABLE_ENTITY)
-            else:
-                # перед удалением помещаем узел в конец
-                if hidden:
-                    change_inner_order_attr_node(data, pk, internal_use=True)
-
-                # проверяем, надо ли влиять на потомков
-                if affect_descendants:
-                    Node.objects.filter(
-                        path__startswith=instance.path,
-                        project_id=data['project_id'],
-                        item_type=data['item_type'],
-                        item=data['item']
-                    ) \
-                        .update(hidden=hidden)
-                else:
-                    instance.hidden = hidden
-                    instance.save()
-
-                # после восстановления помещаем узел в конец
-                if hidden is None:
-                    change_inner_order_attr_node(data, pk, internal_use=True)
+
+            _set_hidden(data, instance, hidden, affect_descendants)
+
+            tree_changed(data)
     except DatabaseError as e:
+        if transactions.is_retryable(e):
+            raise
         logger.error(f'{e}')
         raise ValidateError({'error': e}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -520,10 +774,121 @@ def change_hidden_attr_node(data: dict, pk: int):
         return 'Node(s) restored'
 
 
+@transactions.retry_transaction('change_hidden_batch')
+def change_hidden_attr_nodes(data: dict):
+    """
+    Функция удаления (скрытия) и восстановления нескольких узлов в одной транзакции. Узлы обрабатываются в порядке
+    node_ids, узлы, у которых hidden уже имеет нужное значение (в том числе скрытые вместе с предком из этого же
+    запроса), пропускаются
+    """
+    data = CHANGE_HIDDEN_BATCH_VALIDATION(data)
+
+    hidden = data.get('hidden')
+    affect_descendants = data.get('affect_descendants', True)
+    node_ids = data['node_ids']
+
+    try:
+        with transaction.atomic():
+            # блокируем узлы в порядке id, чтобы параллельные запросы не попадали во взаимоблокировку
+            locked_ids = set(Node.objects.select_for_update().filter(
+                id__in=node_ids,
+                project_id=data['project_id'],
+                item_type=data['item_type'],
+                item=data['item']
+            ) \
+                .order_by('id') \
+                .values_list('id', flat=True))
+
+            missing_ids = [node_id for node_id in node_ids if node_id not in locked_ids]
+            if missing_ids:
+                logger.info(f'{ValidateError.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=missing_ids[0])}')
+                raise ValidateError({'error': ValidateError.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=missing_ids[0])},
+                                    status=status.HTTP_404_NOT_FOUND)
+
+            rows_updated = 0
+            for node_id in node_ids:
+                # path и inner_order могли измениться при обработке предыдущих узлов, перечитываем узел
+                instance = Node.objects.filter(id=node_id, project_id=data['project_id']).first()
+                if instance.hidden == hidden:
+                    continue
+                rows_updated += _set_hidden(data, instance, hidden, affect_descendants)
+
+            tree_changed(data)
+    except DatabaseError as e:
+        if transactions.is_retryable(e):
+            raise
+        logger.error(f'{e}')
+        raise ValidateError({'error': e}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    if hidden:
+        return f'Node(s) deleted, {rows_updated} node(s) updated'
+    else:
+        return f'Node(s) restored, {rows_updated} node(s) updated'
+
+
+def _set_hidden(data: dict, instance: Node, hidden, affect_descendants: bool) -> int:
+    """Установка hidden узлу (и потомкам), узел становится последним из нескрытых соседей"""
+    siblings = {'parent_id': instance.parent_id} if instance.parent_id else {'depth': 1}
+    last_inner_order = Node.objects.filter(
+        project_id=data['project_id'],
+        item_type=data['item_type'],
+        item=data['item'],
+        **siblings
+    ) \
+        .exclude(hidden=True) \
+        .exclude(id=instance.id) \
+        .aggregate(last_inner_order=Max('inner_order'))['last_inner_order']
+    last_position = int(last_inner_order[-10:]) if last_inner_order else 0
+
+    old_position = int(instance.inner_order[-10:])
+    if old_position > last_position:
+        # узел уже после последнего нескрытого соседа: встает сразу за ним, скрытые между ними сдвигаются вниз
+        new_position, first_shifted, last_shifted, shift = last_position + 1, last_position + 1, old_position - 1, 1
+    else:
+        new_position, first_shifted, last_shifted, shift = last_position, old_position + 1, last_position, -1
+
+    return _move_among_siblings(data, instance, new_position, first_shifted, last_shifted, shift,
+                                hidden=hidden, affect_descendants=affect_descendants)
+
+
+def _move_among_siblings(data: dict, instance: Node, new_position: int, first_shifted: int, last_shifted: int,
+                         shift: int, hidden, affect_descendants: bool) -> int:
+    """Выполнение MOVE_AMONG_SIBLINGS_SQL, возвращает число обновленных строк"""
+    parent_path = instance.path[:-10]
+    with connection.cursor() as cursor:
+        prepared_statements.execute(cursor, MOVE_AMONG_SIBLINGS_STATEMENT, {
+            **tree_params(data),
+            'movable_id': instance.id,
+            'movable_path': instance.path,
+            'parent_path': parent_path,
+            'parent_path_length': len(parent_path),
+            'offset': len(instance.inner_order) - 10,
+            'old_position': int(instance.inner_order[-10:]),
+            'new_position': new_position,
+            'new_segment': '0' * (10 - len(str(new_position))) + str(new_position),
+            'first_shifted': first_shifted,
+            'last_shifted': last_shifted,
+            'shift': shift,
+            'hidden': hidden,
+            'affect_descendants': affect_descendants,
+        })
+        return cursor.rowcount
+
+
+@transactions.retry_transaction('change_parent')
 def change_parent_node(data: dict, pk: int):
-    fields_required = ['new_parent_id', ]
-    validate = Validate(data, pk=pk)
-    validate(fields_required=fields_required)
+    """
+    Функция перемещения узла к другому родителю. before_node_id / after_node_id задают место среди детей нового
+    родителя, по умолчанию узел становится последним из нескрытых детей. Сдвиг бывших соседей, сдвиг новых соседей
+    и перезапись path / inner_order поддерева выполняются одним UPDATE
+    """
+
+    data = CHANGE_PARENT_VALIDATION(data, pk)
+
+    if 'before_node_id' in data and 'after_node_id' in data:
+        error = ValidateError.ERR_FIELDS_MUTUALLY_EXCLUSIVE.format(fields='before_node_id, after_node_id')
+        logger.info(f'{error}')
+        raise ValidateError({'errors': [error]}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
 
     try:
         with transaction.atomic():
@@ -537,14 +902,12 @@ def change_parent_node(data: dict, pk: int):
                 .first()
 
             if not movable_instance:
-                logger.info(f'{validate.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=pk)}')
-                raise ValidateError({'error': validate.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=pk)},
+                logger.info(f'{ValidateError.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=pk)}')
+                raise ValidateError({'error': ValidateError.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=pk)},
                                     status=status.HTTP_404_NOT_FOUND)
 
             # проверяем, что новый родитель не является старым родителем
-            old_parent_id = int(movable_instance.path[-20:-10])
-
-            if data['new_parent_id'] == old_parent_id:
+            if data['new_parent_id'] == movable_instance.parent_id:
                 logger.info(f'This parent is already set')
                 raise ValidateError({'error': 'This parent is already set'},
                                     status=status.HTTP_400_BAD_REQUEST)
@@ -555,67 +918,193 @@ def change_parent_node(data: dict, pk: int):
                 raise ValidateError({'error': 'New parent can\'t be movable instance itself'},
                                     status=status.HTTP_400_BAD_REQUEST)
 
-            # проверяем, что новый родитель не является потомком перемещаемого узла
-            descendant_list = Node.objects.filter(
-                path__startswith=movable_instance.path,
+            new_parent = Node.objects.select_for_update().filter(
+                id=data['new_parent_id'],
                 project_id=data['project_id'],
                 item_type=data['item_type'],
                 item=data['item']
             ) \
-                .values_list('id', flat=True)
+                .first()
 
-            if data['new_parent_id'] in descendant_list:
+            # проверяем, что новый родитель не является потомком перемещаемого узла
+            if new_parent and new_parent.path.startswith(movable_instance.path):
                 logger.info(f'New parent can\'t be movable instance\'s descendant')
                 raise ValidateError({'error': 'New parent can\'t be movable instance\'s descendant'},
                                     status=status.HTTP_400_BAD_REQUEST)
 
-            new_parent = Node.objects.select_for_update().filter(
-                id=data['new_parent_id'],
-                project_id=data['project_id'],
-                item_type=data['item_type'],
-                item=data['item']
-            ) \
-                .exclude(hidden=True) \
-                .first()
-
-            if not new_parent:
-                logger.info(f'{validate.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=data.get("new_parent_id"))}')
+            if not new_parent or new_parent.hidden:
+                logger.info(f'{ValidateError.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=data.get("new_parent_id"))}')
                 raise ValidateError(
-                    {'error': validate.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=data.get("new_parent_id"))},
+                    {'error': ValidateError.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=data.get("new_parent_id"))},
                     status=status.HTTP_404_NOT_FOUND)
 
-            new_siblings_quantity = Node.objects.select_for_update().filter(
-                path__startswith=new_parent.path,
+            new_position = _get_new_position(data, new_parent)
+
+            old_parent_path = movable_instance.path[:-10]
+            old_offset = len(movable_instance.inner_order) - 10
+            old_position = int(movable_instance.inner_order[-10:])
+
+            # inner_order нового родителя после сдвига бывших соседей перемещаемого узла
+            new_parent_inner_order = new_parent.inner_order
+            if new_parent.path.startswith(old_parent_path) and \
+                    int(new_parent_inner_order[old_offset:old_offset + 10]) > old_position:
+                new_parent_inner_order = _shift_segment(new_parent_inner_order, old_offset, -1)
+
+            with connection.cursor() as cursor:
+                prepared_statements.execute(cursor, CHANGE_PARENT_STATEMENT, {
+                    **tree_params(data),
+                    'movable_id': movable_instance.id,
+                    'movable_path': movable_instance.path,
+                    'movable_inner_order_length': len(movable_instance.inner_order),
+                    'old_parent_path': old_parent_path,
+                    'old_parent_path_length': len(old_parent_path),
+                    'old_offset': old_offset,
+                    'old_position': old_position,
+                    'new_parent_id': new_parent.id,
+                    'new_parent_path': new_parent.path,
+                    'new_parent_path_length': len(new_parent.path),
+                    'new_offset': len(new_parent.inner_order),
+                    'new_position': new_position,
+                    'new_inner_order': new_parent_inner_order + '0' * (10 - len(str(new_position))) + str(new_position),
+                    'depth_delta': new_parent.depth + 1 - movable_instance.depth,
+                })
+                rows_updated = cursor.rowcount
+
+            tree_changed(data)
+    except DatabaseError as e:
+        if transactions.is_retryable(e):
+            raise
+        logger.error(f'{e}')
+        raise ValidateError({'error': e}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    return f'Node {movable_instance.id} changed it\'s parent to node {new_parent.id}, {rows_updated} node(s) updated'
+
+
+def _get_new_position(data: dict, new_parent: Node) -> int:
+    """Номер места среди детей нового родителя, на которое встает перемещаемый узел"""
+    sibling_id = data.get('before_node_id') or data.get('after_node_id')
+    if not sibling_id:
+        return Node.objects.filter(
+            project_id=data['project_id'],
+            item_type=data['item_type'],
+            item=data['item'],
+            parent_id=new_parent.id,
+        ) \
+            .exclude(hidden=True) \
+            .count() + 1
+
+    sibling = Node.objects.filter(
+        id=sibling_id,
+        project_id=data['project_id'],
+        item_type=data['item_type'],
+        item=data['item'],
+        parent_id=new_parent.id,
+    ) \
+        .exclude(hidden=True) \
+        .first()
+
+    if not sibling:
+        error = ValidateError.ERR_OBJ_NOT_CHILD.format(obj_id=sibling_id, parent_id=new_parent.id)
+        logger.info(f'{error}')
+        raise ValidateError({'error': error}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    position = int(sibling.inner_order[-10:])
+    return position if data.get('before_node_id') else position + 1
+
+
+def _shift_segment(inner_order: str, offset: int, delta: int) -> str:
+    """Сдвиг номера из 10 символов, начинающегося с offset, на delta"""
+    segment = str(int(inner_order[offset:offset + 10]) + delta)
+    return inner_order[:offset] + '0' * (10 - len(segment)) + segment + inner_order[offset + 10:]
+
+
+@transactions.retry_transaction('clone_subtree')
+def clone_subtree(data: dict, pk: int):
+    """
+    Копирование узла со всеми потомками одним INSERT ... SELECT.
+    По умолчанию копия становится последним потомком родителя исходного узла, new_parent_id задает другого
+    родителя, target_project_id, target_item_type, target_item - другое дерево (без new_parent_id копия
+    становится корневым узлом этого дерева). Скрытые узлы и их потомки не копируются
+    """
+
+    data = CLONE_SUBTREE_VALIDATION(data, pk)
+
+    target_fields = [field for field in TARGET_TREE_FIELDS if field in data]
+    if target_fields and len(target_fields) != len(TARGET_TREE_FIELDS):
+        error = ValidateError.ERR_FIELDS_TOGETHER.format(fields=', '.join(TARGET_TREE_FIELDS))
+        logger.info(f'{error}')
+        raise ValidateError({'errors': [error]}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    target = {
+        'project_id': data.get('target_project_id', data['project_id']),
+        'item_type': data.get('target_item_type', data['item_type']),
+        'item': data.get('target_item', data['item']),
+    }
+
+    try:
+        with transaction.atomic():
+            source = Node.objects.select_for_update().filter(
+                id=pk,
                 project_id=data['project_id'],
                 item_type=data['item_type'],
                 item=data['item']
             ) \
-                .annotate(path_len=Length('path')) \
-                .exclude(path=new_parent.path) \
                 .exclude(hidden=True) \
-                .filter(path_len__lt=(len(new_parent.path) + 11)) \
-                .count()
+                .first()
+
+            if not source:
+                logger.info(f'{ValidateError.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=pk)}')
+                raise ValidateError({'error': ValidateError.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=pk)},
+                                    status=status.HTTP_404_NOT_FOUND)
+
+            if 'new_parent_id' in data:
+                new_parent_id = data['new_parent_id']
+            elif target_fields:
+                new_parent_id = None
+            else:
+                new_parent_id = source.parent_id
+
+            new_parent = None
+            if new_parent_id:
+                new_parent = Node.objects.select_for_update().filter(id=new_parent_id, **target) \
+                    .exclude(hidden=True) \
+                    .first()
 
-            new_inner_order = ('0' * (10 - len(str(new_siblings_quantity + 1))) + str(new_siblings_quantity + 1))
+                if not new_parent:
+                    logger.info(f'{ValidateError.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=new_parent_id)}')
+                    raise ValidateError({'error': ValidateError.ERR_DOES_NOT_EXIST_OBJ_ID.format(obj_id=new_parent_id)},
+                                        status=status.HTTP_404_NOT_FOUND)
 
-            # до перемещения помещаем узел в конец, чтобы не ломать сортировку
-            change_inner_order_attr_node(data, pk, internal_use=True)
+            siblings = {'parent_id': new_parent.id} if new_parent else {'depth': 1}
+            amount_nodes = Node.objects.select_for_update().filter(**target, **siblings).count()
+            new_inner_order = ('0' * (10 - len(str(amount_nodes + 1))) + str(amount_nodes + 1))
+            if new_parent:
+                new_inner_order = new_parent.inner_order + new_inner_order
 
             with connection.cursor() as cursor:
-                sql_params = f"""
-UPDATE tree_structure_node
-    SET path = '{new_parent.path}'||RIGHT(path, -LENGTH('{movable_instance.path[:-10]}')),
-        inner_order = '{new_parent.inner_order}'||'{new_inner_order}'
-        ||RIGHT(inner_order, -LENGTH('{movable_instance.inner_order}'))
-    WHERE path LIKE '{movable_instance.path}%'
-    RETURNING *;
-                """
-                cursor.execute(sql_params)
-
-                columns = [col[0] for col in cursor.description]
-                result = [dict(zip(columns, row)) for row in cursor.fetchall()]
+                prepared_statements.execute(cursor, CLONE_SUBTREE_STATEMENT, {
+                    **tree_params(data),
+                    'source_id': source.id,
+                    'source_path': source.path,
+                    'source_parent_path_length': len(source.path) - 10,
+                    'new_parent_id': new_parent.id if new_parent else None,
+                    'new_parent_path': new_parent.path if new_parent else '',
+                    'new_inner_order': new_inner_order,
+                    'depth_delta': (new_parent.depth + 1 if new_parent else 1) - source.depth,
+                    'target_project_id': target['project_id'],
+                    'target_item_type': target['item_type'],
+                    'target_item': target['item'],
+                })
+                clone_id, nodes_cloned = cursor.fetchone()
+
+            clone = Node.objects.get(id=clone_id, project_id=target['project_id'])
+            logger.info(f'Node {source.id} cloned to node {clone.id}, {nodes_cloned} node(s) created')
+
+            tree_changed(target)
     except DatabaseError as e:
+        if transactions.is_retryable(e):
+            raise
         logger.error(f'{e}')
         raise ValidateError({'error': e}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    return f'Node {movable_instance.id} changed it\'s parent to node {new_parent.id}'
+    return serialize_node(clone)
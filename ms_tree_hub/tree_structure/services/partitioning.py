@@ -0,0 +1,150 @@
+"""
+Перевод таблицы tree_structure_node на декларативное секционирование Postgres по хешу project_id.
+
+Порядок переноса существующих данных (команда partition_node_table выполняет шаги по отдельности или все сразу):
+ 1. prepare - создается секционированная таблица tree_structure_node_partitioned с секциями
+    tree_structure_node_p<N>, своя последовательность id и триггер на исходной таблице, который записывает id
+    всех изменяемых узлов в tree_structure_node_partition_log. Сервис продолжает работать.
+ 2. copy - узлы копируются пачками по id без долгих блокировок, шаг можно прерывать и запускать повторно.
+ 3. swap - в одной транзакции под ACCESS EXCLUSIVE блокировкой исходной таблицы переносятся узлы, измененные
+    во время копирования, выставляется последовательность id, исходная таблица удаляется, а секционированная
+    получает ее имя и имена индексов. Перед блокировкой докопируется остаток, поэтому под блокировкой
+    переносятся только изменения из журнала.
+
+Первичный ключ секционированной таблицы - (id, project_id): уникальные ограничения должны включать ключ
+секционирования, поэтому уникальность (path, id) заменена на (path, id, project_id).
+"""
+import logging
+
+from django.db import transaction
+
+logger = logging.getLogger('main_info')
+
+TABLE = 'tree_structure_node'
+PARTITIONED_TABLE = 'tree_structure_node_partitioned'
+LOG_TABLE = 'tree_structure_node_partition_log'
+SEQUENCE = 'tree_structure_node_partitioned_id_seq'
+INDEXES = (
+    # (имя индекса после переноса, поля)
+    ('tree_node_parent_idx', 'project_id, item_type, item, parent_id'),
+    ('tree_node_depth_idx', 'project_id, item_type, item, depth'),
+)
+
+
+def is_partitioned(connection) -> bool:
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [TABLE])
+        row = cursor.fetchone()
+    return bool(row) and row[0] == 'p'
+
+
+def prepare(connection, partitions: int):
+    """Создание секционированной таблицы, секций и журнала изменений исходной таблицы"""
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(f"CREATE SEQUENCE IF NOT EXISTS {SEQUENCE} AS BIGINT")
+        cursor.execute(f"""
+CREATE TABLE IF NOT EXISTS {PARTITIONED_TABLE} (
+    LIKE {TABLE} INCLUDING STORAGE,
+    PRIMARY KEY (id, project_id),
+    UNIQUE (id, project_id, item_type, item),
+    UNIQUE (path, id, project_id)
+) PARTITION BY HASH (project_id)
+        """)
+        cursor.execute(f"ALTER TABLE {PARTITIONED_TABLE} ALTER COLUMN id SET DEFAULT nextval('{SEQUENCE}')")
+        cursor.execute(f"ALTER SEQUENCE {SEQUENCE} OWNED BY {PARTITIONED_TABLE}.id")
+
+        for remainder in range(partitions):
+            cursor.execute(f"""
+CREATE TABLE IF NOT EXISTS {TABLE}_p{remainder} PARTITION OF {PARTITIONED_TABLE}
+    FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})
+            """)
+
+        for name, fields in INDEXES:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {name}_part ON {PARTITIONED_TABLE} ({fields})")
+
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {LOG_TABLE} (id BIGINT NOT NULL)")
+        cursor.execute(f"""
+CREATE OR REPLACE FUNCTION {LOG_TABLE}_trigger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        INSERT INTO {LOG_TABLE} (id) VALUES (OLD.id);
+    ELSE
+        INSERT INTO {LOG_TABLE} (id) VALUES (NEW.id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+        """)
+        cursor.execute(f"DROP TRIGGER IF EXISTS {LOG_TABLE}_trigger ON {TABLE}")
+        cursor.execute(f"""
+CREATE TRIGGER {LOG_TABLE}_trigger AFTER INSERT OR UPDATE OR DELETE ON {TABLE}
+    FOR EACH ROW EXECUTE FUNCTION {LOG_TABLE}_trigger()
+        """)
+
+    logger.info(f'{PARTITIONED_TABLE} prepared with {partitions} partitions')
+
+
+def copy(connection, batch_size: int = 10000) -> int:
+    """Копирование узлов пачками по id, продолжает с максимального уже скопированного id"""
+    copied = 0
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {PARTITIONED_TABLE}")
+        last_id = cursor.fetchone()[0]
+
+        while True:
+            with transaction.atomic(using=connection.alias):
+                cursor.execute(f"""
+INSERT INTO {PARTITIONED_TABLE}
+    SELECT * FROM {TABLE} WHERE id > %s ORDER BY id LIMIT %s
+    ON CONFLICT DO NOTHING
+                """, [last_id, batch_size])
+                if not cursor.rowcount:
+                    break
+                copied += cursor.rowcount
+                cursor.execute(f"SELECT MAX(id) FROM {PARTITIONED_TABLE}")
+                last_id = cursor.fetchone()[0]
+
+    logger.info(f'{copied} nodes copied to {PARTITIONED_TABLE}')
+    return copied
+
+
+def swap(connection, batch_size: int = 10000):
+    """Перенос изменений из журнала и замена исходной таблицы секционированной"""
+    # докопируем то, что не успел забрать шаг copy, чтобы под блокировкой остался только журнал
+    copy(connection, batch_size)
+
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(f"LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE")
+
+        cursor.execute(f"DELETE FROM {PARTITIONED_TABLE} WHERE id IN (SELECT id FROM {LOG_TABLE})")
+        cursor.execute(f"""
+INSERT INTO {PARTITIONED_TABLE}
+    SELECT * FROM {TABLE} WHERE id IN (SELECT id FROM {LOG_TABLE})
+        """)
+
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [TABLE])
+        old_sequence = cursor.fetchone()[0]
+        cursor.execute(f"""
+SELECT setval('{SEQUENCE}', GREATEST(
+    (SELECT COALESCE(MAX(id), 0) FROM {TABLE}),
+    (SELECT last_value FROM {old_sequence})
+) + 1, false)
+        """)
+
+        cursor.execute(f"DROP TABLE {TABLE}")
+        cursor.execute(f"DROP TABLE {LOG_TABLE}")
+        cursor.execute(f"DROP FUNCTION {LOG_TABLE}_trigger()")
+        cursor.execute(f"ALTER TABLE {PARTITIONED_TABLE} RENAME TO {TABLE}")
+        cursor.execute(f"ALTER SEQUENCE {SEQUENCE} RENAME TO {TABLE}_id_seq")
+        for name, fields in INDEXES:
+            cursor.execute(f"ALTER INDEX {name}_part RENAME TO {name}")
+
+    logger.info(f'{TABLE} replaced with the partitioned table')
+
+
+def partition_node_table(connection, partitions: int, batch_size: int = 10000):
+    """Все шаги переноса подряд, ничего не делает, если таблица уже секционирована"""
+    if is_partitioned(connection):
+        return
+    prepare(connection, partitions)
+    swap(connection, batch_size)
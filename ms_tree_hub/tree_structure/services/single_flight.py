@@ -0,0 +1,156 @@
+"""
+Объединение одинаковых одновременных чтений дерева (get_tree, get_descendants).
+
+Внутри воркера первый запрос с данным ключом выполняет чтение, потоки с тем же ключом, пришедшие до его окончания,
+ждут и получают тот же результат, один раз закодированный в PreRenderedJSON (или ту же ошибку): общий список
+потокам не передается. Ключ включает версию дерева из tree_versions, поэтому чтение, начатое после записи в дерево,
+не присоединяется к чтению старой версии. Если версия недоступна, чтение выполняется
+без объединения.
+
+Между воркерами (общий кеш) первый воркер берет короткую блокировку cache.add и кладет в кеш готовый JSON,
+остальные ждут его до TREE_SINGLE_FLIGHT_LOCK_SECONDS и отдают PreRenderedJSON; если результат не появился
+(ошибка, слишком большой ответ для кеша), читают сами.
+
+Настройки в settings:
+    TREE_SINGLE_FLIGHT = True                  # по умолчанию включено, объединение внутри воркера
+    TREE_SINGLE_FLIGHT_SHARED = False          # по умолчанию выключено, объединение между воркерами через кеш
+    TREE_SINGLE_FLIGHT_LOCK_SECONDS = 10       # сколько ждать чтения другого воркера
+"""
+import hashlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from core.renderers import FastJSONRenderer, PreRenderedJSON
+from . import tree_versions
+
+logger = logging.getLogger('main_info')
+
+DEFAULT_LOCK_SECONDS = 10
+# пауза между проверками результата другого воркера
+POLL_INTERVAL = 0.01
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Одно выполнение функции на ключ среди одновременных вызовов в процессе"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, compute, share=None):
+        """
+        Результат compute() для всех вызовов с key, пришедших до окончания первого (или его ошибка). Первый вызов
+        получает результат compute(), остальные - share(результат), вычисленный один раз: ожидающие потоки
+        не должны получать общий изменяемый объект
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            result = compute()
+            with self._lock:
+                # после удаления ключа новые вызовы не присоединяются, waiters больше не меняется
+                del self._calls[key]
+            if call.waiters:
+                call.result = share(result) if share else result
+            return result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+
+
+def _render_once(result):
+    """Общий для ожидающих потоков результат чтения - закодированный JSON"""
+    return result if isinstance(result, PreRenderedJSON) else PreRenderedJSON(FastJSONRenderer().render(result))
+
+
+flights = SingleFlight()
+
+
+def _cache_key(prefix: str, key: tuple) -> str:
+    return prefix + hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+def _shared(key: tuple, compute):
+    """Объединение между воркерами через блокировку в кеше"""
+    lock_seconds = getattr(settings, 'TREE_SINGLE_FLIGHT_LOCK_SECONDS', DEFAULT_LOCK_SECONDS)
+    lock_key = _cache_key('tree-flight-lock:', key)
+    result_key = _cache_key('tree-flight-result:', key)
+    try:
+        leader = cache.add(lock_key, 1, lock_seconds)
+    except Exception as e:
+        logger.error(f'unable to take single flight lock; {e}')
+        return compute()
+
+    if leader:
+        try:
+            result = compute()
+            content = result.content if isinstance(result, PreRenderedJSON) else FastJSONRenderer().render(result)
+            try:
+                cache.set(result_key, content, lock_seconds)
+            except Exception as e:
+                logger.error(f'unable to share tree read; {e}')
+            return result
+        finally:
+            cache.delete(lock_key)
+
+    deadline = time.monotonic() + lock_seconds
+    while time.monotonic() < deadline:
+        content = cache.get(result_key)
+        if content is not None:
+            return PreRenderedJSON(content)
+        if cache.get(lock_key) is None:
+            # первый воркер закончил без результата в кеше
+            content = cache.get(result_key)
+            return PreRenderedJSON(content) if content is not None else compute()
+        time.sleep(POLL_INTERVAL)
+    return compute()
+
+
+def coalesce(name: str, tree: str, data: dict, pk: int, compute):
+    """
+    Результат чтения name дерева tree с параметрами data (и узла pk), общий для одновременных одинаковых чтений.
+    format на результат не влияет и в ключ не входит
+    """
+    if not getattr(settings, 'TREE_SINGLE_FLIGHT', True):
+        return compute()
+
+    version = tree_versions.get_version(tree)
+    if version is None:
+        return compute()
+
+    params = tuple(sorted((field, str(value)) for field, value in data.items() if field not in ('format', 'pk')))
+    key = (name, tree, version, pk, params)
+    if getattr(settings, 'TREE_SINGLE_FLIGHT_SHARED', False):
+        return flights.do(key, lambda: _shared(key, compute), _render_once)
+    return flights.do(key, compute, _render_once)
@@ -0,0 +1,84 @@
+"""
+Готовые ответы get_tree в таблице tree_structure_treesnapshot (модель TreeSnapshot).
+
+Снимок хранит payload вместе с версией дерева из tree_versions, по которой он собран. Запись в дерево таблицу
+снимков не трогает: после коммита увеличивается версия дерева, и снимок старой версии перестает отдаваться.
+Чтение:
+ 1. запоминается текущая версия дерева, снимок этой версии отдается как есть, одной строкой без повторного
+    кодирования JSON;
+ 2. иначе ответ собирается заново или, если с версии снимка менялись только attributes (журнал tree_versions),
+    в старом ответе заменяются attributes измененных узлов;
+ 3. ответ сохраняется с запомненной версией, если в таблице нет снимка более новой версии.
+Версия запоминается до чтения узлов, а увеличивается после коммита записи, поэтому снимок никогда не помечается
+версией новее своих данных: в худшем случае следующее чтение соберет его еще раз.
+
+Подключение в settings:
+    TREE_SNAPSHOTS_ENABLED = True      # по умолчанию выключено
+
+Снимки общие для всех воркеров, поэтому версии деревьев должны храниться в общем кеше (memcached/redis): с
+LocMemCache воркер не видит записей других воркеров и может отдать устаревший снимок. Если кеш недоступен,
+снимки не используются.
+"""
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from core.renderers import FastJSONRenderer, PreRenderedJSON
+from ..models import Node, TreeSnapshot
+from . import tree_versions
+
+SAVE_SQL = """
+INSERT INTO tree_structure_treesnapshot AS snapshot (project_id, item_type, item, sort_by, payload, payload_version)
+    VALUES (%(project_id)s, %(item_type)s, %(item)s, %(sort_by)s, %(payload)s, %(version)s)
+    ON CONFLICT (project_id, item_type, item, sort_by) DO UPDATE
+    SET payload = EXCLUDED.payload, payload_version = EXCLUDED.payload_version
+    WHERE snapshot.payload_version IS NULL OR snapshot.payload_version < EXCLUDED.payload_version;
+"""
+
+
+def _tree_params(data: dict) -> dict:
+    return {'project_id': data['project_id'], 'item_type': data['item_type'], 'item': data['item']}
+
+
+def _snapshot(data: dict, sort_by: str):
+    """(версия, payload) снимка или None"""
+    return TreeSnapshot.objects.filter(**_tree_params(data), sort_by=sort_by) \
+        .values_list('payload_version', 'payload') \
+        .first()
+
+
+def get_tree(key: str, data: dict, sort_by: str, build):
+    """
+    Ответ get_tree из снимка или None, если снимки выключены или версия дерева недоступна. Снимок читается через
+    роутер (с реплики внутри read_from_replica), сборка идет на primary, build() должен читать узлы с primary
+    """
+    if not getattr(settings, 'TREE_SNAPSHOTS_ENABLED', False):
+        return None
+
+    version = tree_versions.get_version(key)
+    if version is None:
+        return None
+
+    payload_version, payload = _snapshot(data, sort_by) or (None, None)
+    if payload is not None and payload_version == version:
+        return PreRenderedJSON(payload.encode())
+
+    nodes = None
+    if payload is not None and payload_version is not None and payload_version < version:
+        changed = tree_versions.attribute_changes(key, payload_version, version)
+        if changed is not None:
+            nodes = PreRenderedJSON(payload.encode()).decode()
+            attributes = dict(
+                Node.objects.using(DEFAULT_DB_ALIAS).filter(**_tree_params(data), id__in=changed)
+                .values_list('id', 'attributes')
+            )
+            for node in nodes:
+                if node['id'] in attributes:
+                    node['attributes'] = attributes[node['id']]
+    if nodes is None:
+        nodes = build()
+
+    content = FastJSONRenderer().render(nodes)
+    with connections[DEFAULT_DB_ALIAS].cursor() as cursor:
+        cursor.execute(SAVE_SQL, {**_tree_params(data), 'sort_by': sort_by, 'payload': content.decode(),
+                                  'version': version})
+    return PreRenderedJSON(content)
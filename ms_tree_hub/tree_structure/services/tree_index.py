@@ -0,0 +1,256 @@
+"""
+Индекс деревьев в памяти воркера для get_tree и get_descendants.
+
+Дерево хранится массивами в порядке inner_order (обход в глубину, соседи по порядку): id, индекс родителя, номер
+среди соседей, уровень, конец поддерева, признак hidden и attributes. Поддерево узла - непрерывный отрезок
+массивов от узла до конца его поддерева, path и inner_order собираются из id и номеров предков при выдаче.
+Без attributes узел занимает около 50 байт.
+
+Индекс сверяется с версией дерева из tree_versions при каждом чтении: если менялись только attributes, в копию
+индекса подгружаются attributes измененных узлов, иначе дерево перечитывается целиком. Дерево читается с primary,
+чтобы отстающая реплика не попала в индекс с новой версией. Деревья, в которых path, inner_order, depth или
+parent_id не согласованы между собой, в индекс не попадают и читаются из БД.
+
+Подключение в settings:
+    TREE_INDEX_ENABLED = True          # по умолчанию выключено
+    TREE_INDEX_MAX_NODES = 1000000     # сколько узлов всех деревьев держит воркер, давно не читавшиеся деревья
+                                       # вытесняются целиком
+"""
+import bisect
+import collections
+import threading
+from array import array
+from operator import itemgetter
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from ..models import Node
+from ..serializers import NODE_FIELDS
+from . import tree_versions
+
+DEFAULT_MAX_NODES = 1000000
+
+
+class TreeIndex:
+    """Массивы одного дерева, построенные по одной версии"""
+
+    __slots__ = ('version', 'project_id', 'item_type', 'item', 'ids', 'parents', 'segments', 'depths', 'ends',
+                 'hidden', 'attributes', 'sorted_ids', 'sorted_positions')
+
+    def __init__(self, version, project_id: str, item_type: str, item: str):
+        self.version = version
+        self.project_id = project_id
+        self.item_type = item_type
+        self.item = item
+        self.ids = array('q')
+        self.parents = array('i')
+        self.segments = array('q')
+        self.depths = array('H')
+        self.ends = array('i')
+        self.hidden = bytearray()
+        self.attributes = []
+        # id по возрастанию и их позиции в обходе - поиск узла бинарным поиском
+        self.sorted_ids = array('q')
+        self.sorted_positions = array('i')
+
+    @property
+    def size(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, version, data: dict, rows, max_nodes: int):
+        """
+        Построение по строкам (id, path, inner_order, depth, parent_id, hidden, attributes) в порядке inner_order.
+        None, если узлов больше max_nodes или поля узлов не согласованы
+        """
+        index = cls(version, str(data['project_id']), data['item_type'], data['item'])
+        ids, parents, segments, depths, ends = index.ids, index.parents, index.segments, index.depths, index.ends
+        # открытые узлы текущей ветки обхода и их path / inner_order
+        stack, paths, orders = [], [], []
+
+        for position, (node_id, path, inner_order, depth, parent_id, hidden, attributes) in enumerate(rows):
+            if position >= max_nodes:
+                return None
+            while len(stack) >= depth:
+                ends[stack.pop()] = position
+                paths.pop()
+                orders.pop()
+            parent = stack[-1] if stack else -1
+            if depth != len(stack) + 1 or parent_id != (ids[parent] if stack else None):
+                return None
+
+            segment = int(inner_order[-10:])
+            node_path = (paths[-1] if stack else '') + f'{node_id:010d}'
+            node_inner_order = (orders[-1] if stack else '') + f'{segment:010d}'
+            if path != node_path or inner_order != node_inner_order:
+                return None
+
+            ids.append(node_id)
+            parents.append(parent)
+            segments.append(segment)
+            depths.append(depth)
+            ends.append(0)
+            index.hidden.append(1 if hidden else 0)
+            index.attributes.append(attributes)
+            stack.append(position)
+            paths.append(node_path)
+            orders.append(node_inner_order)
+
+        for position in stack:
+            ends[position] = len(ids)
+
+        order = sorted(range(len(ids)), key=ids.__getitem__)
+        index.sorted_ids = array('q', (ids[position] for position in order))
+        index.sorted_positions = array('i', order)
+        return index
+
+    def with_attributes(self, version, attributes: dict):
+        """Копия индекса новой версии с обновленными attributes узлов {id: attributes}, массивы общие"""
+        index = TreeIndex(version, self.project_id, self.item_type, self.item)
+        for name in ('ids', 'parents', 'segments', 'depths', 'ends', 'hidden', 'sorted_ids', 'sorted_positions'):
+            setattr(index, name, getattr(self, name))
+        index.attributes = list(self.attributes)
+        for node_id, value in attributes.items():
+            position = self.find(node_id)
+            if position is not None:
+                index.attributes[position] = value
+        return index
+
+    def find(self, node_id: int):
+        """Позиция узла в обходе или None"""
+        i = bisect.bisect_left(self.sorted_ids, node_id)
+        if i < len(self.sorted_ids) and self.sorted_ids[i] == node_id:
+            return self.sorted_positions[i]
+        return None
+
+    def tree(self, sort_by_id: bool = False) -> list:
+        """Все нескрытые узлы дерева, как get_tree"""
+        return self._serialize(0, self.size, 1, None, sort_by_id)
+
+    def descendants(self, node_id: int, depth: int = None, sort_by_id: bool = False):
+        """Нескрытые потомки узла до уровня depth относительно узла, как get_descendants. None, если узла нет"""
+        position = self.find(node_id)
+        if position is None or self.hidden[position]:
+            return None
+        node_depth = self.depths[position]
+        return self._serialize(position + 1, self.ends[position], node_depth + 1,
+                               node_depth + depth if depth else None, sort_by_id)
+
+    def _serialize(self, start: int, stop: int, min_depth: int, max_depth, sort_by_id: bool) -> list:
+        ids, parents, segments, depths, hidden, attributes = \
+            self.ids, self.parents, self.segments, self.depths, self.hidden, self.attributes
+        fields = NODE_FIELDS
+        tree = (self.project_id, self.item_type, self.item)
+
+        # path и inner_order по уровням для текущей ветки, начиная с предков первого узла отрезка
+        paths, orders = [''], ['']
+        ancestors = []
+        position = parents[start] if start < stop else -1
+        while position >= 0:
+            ancestors.append(position)
+            position = parents[position]
+        for position in reversed(ancestors):
+            paths.append(paths[-1] + f'{ids[position]:010d}')
+            orders.append(orders[-1] + f'{segments[position]:010d}')
+
+        result = []
+        for position in range(start, stop):
+            depth = depths[position]
+            if max_depth is not None and depth > max_depth:
+                continue
+            del paths[depth:], orders[depth:]
+            path = paths[depth - 1] + f'{ids[position]:010d}'
+            inner_order = orders[depth - 1] + f'{segments[position]:010d}'
+            paths.append(path)
+            orders.append(inner_order)
+            if hidden[position] or depth < min_depth:
+                continue
+            result.append(dict(zip(fields, (ids[position], path, *tree, inner_order, attributes[position], depth))))
+
+        if sort_by_id:
+            result.sort(key=itemgetter('id'))
+        return result
+
+
+class _Unindexable:
+    """Отметка дерева, которое для этой версии не попадает в индекс"""
+    __slots__ = ('version', )
+    size = 1
+
+    def __init__(self, version):
+        self.version = version
+
+
+class TreeIndexCache:
+    """LRU деревьев, ограниченный суммарным числом узлов"""
+
+    def __init__(self):
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry, max_nodes: int):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous.size
+            self._entries[key] = entry
+            self._size += entry.size
+            while self._size > max_nodes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+indexes = TreeIndexCache()
+
+
+def _tree_nodes(data: dict):
+    return Node.objects.using(DEFAULT_DB_ALIAS).filter(
+        project_id=data['project_id'],
+        item_type=data['item_type'],
+        item=data['item'],
+    )
+
+
+def get_index(key: str, data: dict):
+    """Индекс дерева актуальной версии или None, если индекс выключен или дерево нельзя проиндексировать"""
+    if not getattr(settings, 'TREE_INDEX_ENABLED', False):
+        return None
+
+    version = tree_versions.get_version(key)
+    if version is None:
+        return None
+
+    max_nodes = getattr(settings, 'TREE_INDEX_MAX_NODES', DEFAULT_MAX_NODES)
+    entry = indexes.get(key)
+    if entry is not None and entry.version == version:
+        return entry if isinstance(entry, TreeIndex) else None
+
+    if isinstance(entry, TreeIndex) and entry.version < version:
+        changed = tree_versions.attribute_changes(key, entry.version, version)
+        if changed is not None:
+            attributes = dict(_tree_nodes(data).filter(id__in=changed).values_list('id', 'attributes'))
+            entry = entry.with_attributes(version, attributes)
+            indexes.put(key, entry, max_nodes)
+            return entry
+
+    rows = _tree_nodes(data) \
+        .order_by('inner_order') \
+        .values_list('id', 'path', 'inner_order', 'depth', 'parent_id', 'hidden', 'attributes') \
+        .iterator(chunk_size=10000)
+    entry = TreeIndex.build(version, data, rows, max_nodes)
+    indexes.put(key, entry if entry is not None else _Unindexable(version), max_nodes)
+    return entry
@@ -0,0 +1,91 @@
+"""
+Отметки об изменении деревьев в общем кеше.
+
+Каждое дерево имеет номер версии, который увеличивается после коммита любой записи в дерево (tree_changed).
+Для изменений, затронувших только attributes, версия дополнительно попадает в короткий журнал вместе с id
+измененных узлов - по нему читатели, держащие дерево в памяти, обновляют только attributes. Если в журнале
+нет хотя бы одной версии из нужного диапазона, считается, что изменилось все дерево.
+
+Для нескольких воркеров нужен общий кеш (memcached/redis), с LocMemCache отметки видны в пределах одного процесса.
+"""
+import hashlib
+import logging
+import time
+
+from django.core.cache import cache
+
+logger = logging.getLogger('main_info')
+
+# сколько последних изменений attributes хранится в журнале дерева
+CHANGE_LOG_SIZE = 100
+
+
+def _version_cache_key(key: str) -> str:
+    return 'tree-version:' + hashlib.sha1(key.encode()).hexdigest()
+
+
+def _changes_cache_key(key: str) -> str:
+    return 'tree-changes:' + hashlib.sha1(key.encode()).hexdigest()
+
+
+def _initial_version() -> int:
+    # если отметка вытеснена из кеша, новая нумерация не должна повторить уже выданные версии
+    return time.time_ns()
+
+
+def get_version(key: str):
+    """Текущая версия дерева, None, если кеш недоступен"""
+    version_key = _version_cache_key(key)
+    try:
+        version = cache.get(version_key)
+        if version is None:
+            cache.add(version_key, _initial_version(), None)
+            version = cache.get(version_key)
+    except Exception as e:
+        logger.error(f'unable to get version of tree {key}; {e}')
+        return None
+    return version
+
+
+def bump_version(key: str, changed_attributes: list = None):
+    """
+    Увеличение версии дерева после коммита записи. changed_attributes - id узлов, если изменились только их
+    attributes
+    """
+    version_key = _version_cache_key(key)
+    try:
+        try:
+            version = cache.incr(version_key)
+        except ValueError:
+            cache.add(version_key, _initial_version(), None)
+            version = cache.incr(version_key)
+
+        if changed_attributes:
+            changes_key = _changes_cache_key(key)
+            changes = cache.get(changes_key) or []
+            changes.append((version, tuple(changed_attributes)))
+            cache.set(changes_key, changes[-CHANGE_LOG_SIZE:], None)
+    except Exception as e:
+        logger.error(f'unable to bump version of tree {key}; {e}')
+
+
+def attribute_changes(key: str, since: int, until: int):
+    """
+    id узлов, у которых изменились attributes между версиями since (не включая) и until. None, если между
+    версиями были другие изменения или журнал неполон
+    """
+    try:
+        changes = cache.get(_changes_cache_key(key)) or []
+    except Exception as e:
+        logger.error(f'unable to get changes of tree {key}; {e}')
+        return None
+
+    node_ids = set()
+    versions = 0
+    for version, ids in changes:
+        if since < version <= until:
+            versions += 1
+            node_ids.update(ids)
+    if versions != until - since:
+        return None
+    return node_ids
@@ -1,3 +1,4 @@
+import functools
 import logging
 import json
 import uuid
@@ -20,6 +21,9 @@ class ValidateError(APIException):
                                                 inner_order"
     ERR_OBJ_NOT_BELONG_PARENT = "object id {destination_obj} does not belong to the parent of object id {parent_obj}"
     ERR_FIELD_INTEGER_POSITIVE = "{field} must be positive number"
+    ERR_FIELDS_TOGETHER = "fields {fields} must be passed together"
+    ERR_FIELDS_MUTUALLY_EXCLUSIVE = "only one of fields {fields} can be passed"
+    ERR_OBJ_NOT_CHILD = "object id {obj_id} is not a child of object id {parent_id}"
 
     def __init__(self, detail=None, code=None, status=None):
         if status:
@@ -89,20 +93,7 @@ class Validate(ValidateError):
         """
         Метод сверяет переданные значения project_id, item_type, item со значениями этих полей у родителя,
         """
-
-        errors = []
-        if str(kwargs.get('project_id')) != str(self.request_data['project_id']):
-            errors.append(f"Value 'project_id' must match the parent")
-        if str(kwargs.get('item_type')) != str(self.request_data['item_type']):
-            errors.append(f"Value 'item_type' must match the parent")
-        if str(kwargs.get('item')) != str(self.request_data['item']):
-            errors.append(f"Value 'item' must match the parent")
-        if len(kwargs.get('path')) % 10 != 0:
-            errors.append({'error': f'For object id {kwargs.get("id")} value field "path" not a multiple of 10. '
-                                    f'Field "path" generation error.'})
-        if errors:
-            logger.error(f'{errors}')
-            raise ValidateError({'errors': errors}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        validate_value_fields_for_create_child(self.request_data, **kwargs)
 
     def _validate_fields_format(self):
         """
@@ -191,3 +182,224 @@ class Validate(ValidateError):
                 errors.append(self.ERR_FIELD_REQUEST_NOT_EMPTY.format(field=attr))
 
         return errors
+
+
+def validate_value_fields_for_create_child(request_data: dict, **kwargs):
+    """
+    Функция сверяет переданные значения project_id, item_type, item со значениями этих полей у родителя,
+    """
+
+    errors = []
+    if str(kwargs.get('project_id')) != str(request_data['project_id']):
+        errors.append(f"Value 'project_id' must match the parent")
+    if str(kwargs.get('item_type')) != str(request_data['item_type']):
+        errors.append(f"Value 'item_type' must match the parent")
+    if str(kwargs.get('item')) != str(request_data['item']):
+        errors.append(f"Value 'item' must match the parent")
+    if len(kwargs.get('path')) % 10 != 0:
+        errors.append({'error': f'For object id {kwargs.get("id")} value field "path" not a multiple of 10. '
+                                f'Field "path" generation error.'})
+    if errors:
+        logger.error(f'{errors}')
+        raise ValidateError({'errors': errors}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+
+class ValidatedData(dict):
+    """Проверенные поля запроса. project_id приведен к uuid.UUID, depth - к int,
+    разобранный json из attributes доступен в decoded_attributes.
+    decoded_attributes нужен только для merge patch; при создании узла и замене attributes сохраняется
+    исходная строка attributes, в том виде, в котором ее прислал клиент"""
+    decoded_attributes = None
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_uuid(value) -> uuid.UUID:
+    # один и тот же project_id приходит в каждом запросе к дереву, разбираем его один раз
+    return uuid.UUID(value)
+
+
+def _check_uuid(field):
+    def check(value, cleaned):
+        if isinstance(value, uuid.UUID):
+            return None
+        try:
+            cleaned[field] = _parse_uuid(value)
+        except (AttributeError, ValueError, TypeError):
+            return ValidateError.ERR_WRONG_FORMAT_FIELD.format(field=field, format="uuid")
+    return check
+
+
+def _check_str(field):
+    def check(value, cleaned):
+        if not isinstance(value, str):
+            return ValidateError.ERR_WRONG_FORMAT_FIELD.format(field=field, format="str")
+    return check
+
+
+def _check_optional_str(field):
+    def check(value, cleaned):
+        if value and not isinstance(value, str):
+            return ValidateError.ERR_WRONG_FORMAT_FIELD.format(field=field, format="str")
+    return check
+
+
+def _check_optional_int(field):
+    def check(value, cleaned):
+        if value and not isinstance(value, int):
+            return ValidateError.ERR_WRONG_FORMAT_FIELD.format(field=field, format="int")
+    return check
+
+
+def _check_optional_bool(field):
+    def check(value, cleaned):
+        if value is not None and not isinstance(value, bool):
+            return ValidateError.ERR_WRONG_FORMAT_FIELD.format(field=field, format='bool')
+    return check
+
+
+def _check_optional_true(field):
+    # флаг в параметрах get запроса, как sort_by_id: передается только значение true
+    def check(value, cleaned):
+        if not isinstance(value, str) or value.lower() != 'true':
+            return ValidateError.ERR_WRONG_FORMAT_FIELD.format(field=field, format='true')
+        cleaned[field] = True
+    return check
+
+
+def _check_path(value, cleaned):
+    if not isinstance(value, str) or not value.isdigit() or len(value) % 10:
+        return ValidateError.ERR_WRONG_FORMAT_FIELD.format(field='path', format='path of node')
+
+
+def _check_attributes(value, cleaned):
+    if not value:
+        return None
+    if isinstance(value, str):
+        try:
+            attr_dict = json.loads(value)
+        except json.decoder.JSONDecodeError:
+            attr_dict = None
+        if isinstance(attr_dict, dict):
+            cleaned.decoded_attributes = attr_dict
+            return None
+    return ValidateError.ERR_WRONG_FORMAT_FIELD.format(field="attributes", format="json")
+
+
+def _check_pk(value, cleaned):
+    if not value or not isinstance(value, int):
+        return ValidateError.ERR_WRONG_FORMAT_FIELD.format(field="pk", format="int")
+
+
+def _check_depth(value, cleaned):
+    if value is not None and not isinstance(value, int):
+        try:
+            cleaned['depth'] = int(value)
+        except ValueError:
+            return ValidateError.ERR_WRONG_FORMAT_FIELD.format(field='depth', format='int')
+
+
+def _check_id_list(field):
+    def check(value, cleaned):
+        if not isinstance(value, list) or not all(type(item) is int for item in value):
+            return ValidateError.ERR_WRONG_FORMAT_FIELD.format(field=field, format="list of int")
+        if not value:
+            return ValidateError.ERR_FIELD_REQUEST_NOT_EMPTY.format(field=field)
+        if any(item < 1 for item in value):
+            return ValidateError.ERR_FIELD_INTEGER_POSITIVE.format(field=field)
+        # повторяющиеся id обрабатываются один раз, порядок сохраняется
+        cleaned[field] = list(dict.fromkeys(value))
+    return check
+
+
+# Проверки форматов в порядке, в котором Validate._validate_fields_format выдает ошибки
+FORMAT_CHECKS = (
+    ('project_id', _check_uuid('project_id')),
+    ('item_type', _check_str('item_type')),
+    ('item', _check_str('item')),
+    ('inner_order', _check_optional_str('inner_order')),
+    ('attributes', _check_attributes),
+    ('destination_node_id', _check_optional_int('destination_node_id')),
+    ('new_parent_id', _check_optional_int('new_parent_id')),
+    ('before_node_id', _check_optional_int('before_node_id')),
+    ('after_node_id', _check_optional_int('after_node_id')),
+    ('pk', _check_pk),
+    ('affect_descendants', _check_optional_bool('affect_descendants')),
+    ('depth', _check_depth),
+    ('target_project_id', _check_uuid('target_project_id')),
+    ('target_item_type', _check_str('target_item_type')),
+    ('target_item', _check_str('target_item')),
+    ('node_ids', _check_id_list('node_ids')),
+    ('with_children', _check_optional_true('with_children')),
+    ('merge_patch', _check_optional_bool('merge_patch')),
+    ('path', _check_path),
+)
+
+
+class ValidationPlan:
+    """
+    Правила валидации одного эндпоинта. Создается один раз при импорте модуля, при вызове проверяет запрос
+    за один проход и возвращает ValidatedData. Тексты ошибок и статусы совпадают с Validate
+    """
+
+    def __init__(self, fields_required: list = None, fields_allowed: list = None, with_pk: bool = False):
+        self.fields_required = tuple(Validate.FIELDS_REQUIRED + list(fields_required or []))
+        self.fields_allowed = frozenset(self.fields_required) | frozenset(fields_allowed or []) | \
+            frozenset(['pk'] if with_pk else [])
+        self.with_pk = with_pk
+        # проверки форматов только для полей, разрешенных эндпоинтом: (порядковый номер, проверка)
+        self.format_checks = {
+            field: (position, check) for position, (field, check) in enumerate(FORMAT_CHECKS)
+            if field in self.fields_allowed
+        }
+
+    def __call__(self, request_data: dict, pk: int = None) -> ValidatedData:
+        if type(request_data) is dict:
+            cleaned = ValidatedData(request_data)
+        else:
+            # QueryDict: берем последнее значение каждого ключа, как request_data[key]
+            cleaned = ValidatedData((key, request_data.get(key)) for key in request_data)
+        if self.with_pk:
+            cleaned['pk'] = pk
+
+        presence_errors = [ValidateError.ERR_FIELD_IS_REQUIRED.format(field=field)
+                           for field in self.fields_required if field not in cleaned]
+        format_errors = []
+        value_errors = []
+        fields_allowed = self.fields_allowed
+        format_checks = self.format_checks
+
+        for field, value in cleaned.items():
+            if field not in fields_allowed:
+                presence_errors.append(ValidateError.ERR_NOT_ALLOWED_FIELD.format(field=field))
+                continue
+            if field in format_checks:
+                position, check = format_checks[field]
+                error = check(value, cleaned)
+                if error:
+                    format_errors.append((position, error))
+                value = cleaned[field]
+            if type(value) is int and value < 1:
+                value_errors.append(ValidateError.ERR_FIELD_INTEGER_POSITIVE.format(field=field))
+            elif type(value) is str and not value:
+                value_errors.append(ValidateError.ERR_FIELD_REQUEST_NOT_EMPTY.format(field=field))
+
+        if presence_errors:
+            self._raise(presence_errors)
+        if format_errors:
+            self._raise([error for position, error in sorted(format_errors, key=lambda x: x[0])])
+
+        sort_by_id = cleaned.get('sort_by_id')
+        hidden = cleaned.get('hidden')
+        if hidden is not None and hidden is not True:
+            value_errors.insert(0, 'hidden can be None or True')
+        if sort_by_id is not None and (not isinstance(sort_by_id, str) or sort_by_id.lower() != 'true'):
+            value_errors.insert(0, ValidateError.ERR_WRONG_FORMAT_FIELD.format(field='sort_by_id', format='true'))
+        if value_errors:
+            self._raise(value_errors)
+
+        return cleaned
+
+    @staticmethod
+    def _raise(errors: list):
+        logger.error(f'{errors}')
+        raise ValidateError({'errors': errors}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
@@ -1,3 +1,794 @@
-from django.test import TestCase
+import json
+import threading
+import unittest
+import uuid
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import connection, connections, DatabaseError, DEFAULT_DB_ALIAS, OperationalError, transaction
+from django.test import override_settings, SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+
+from core import db_routers, prepared_statements, transactions
+from core.renderers import as_data, ColumnarJSONRenderer, FastJSONRenderer, MessagePackRenderer, PreRenderedJSON, \
+    decode_columnar, encode_columnar, msgpack, orjson
+from tree_structure.management.seeding import node_rows
+from tree_structure.models import Node, TreeSnapshot
+from tree_structure.serializers import NODE_FIELDS, serialize_node_rows
+from tree_structure.services import methods_model, snapshots
+from tree_structure.services.single_flight import SingleFlight, _render_once
+from tree_structure.services.validate_fields_model import ValidateError
+
+
+class ColumnarFormatTest(SimpleTestCase):
+    def setUp(self):
+        self.nodes = serialize_node_rows(node_rows(250, 'c5d4e5f6-0000-4000-8000-000000000001'))
+
+    def test_round_trip(self):
+        content = ColumnarJSONRenderer().render(self.nodes)
+        self.assertEqual(decode_columnar(json.loads(content)), self.nodes)
+
+    def test_round_trip_keeps_field_order(self):
+        decoded = decode_columnar(json.loads(ColumnarJSONRenderer().render(self.nodes)))
+        self.assertEqual(FastJSONRenderer().render(decoded), FastJSONRenderer().render(self.nodes))
+
+    def test_tree_key_sent_once(self):
+        payload = encode_columnar(self.nodes, ColumnarJSONRenderer.CONSTANT_FIELDS, ColumnarJSONRenderer.DELTA_FIELDS)
+        self.assertEqual(payload['constant'], {
+            'project_id': 'c5d4e5f6-0000-4000-8000-000000000001', 'item_type': 'document', 'item': 'item',
+        })
+        self.assertEqual(set(payload['columns']), {'id', 'attributes', 'level_node'})
+        self.assertEqual(set(payload['delta']), {'path', 'inner_order'})
+
+    def test_paths_relative_to_previous_row(self):
+        payload = encode_columnar(self.nodes, delta_fields=('path', ))
+        self.assertEqual(payload['delta']['path']['keep'][0], 0)
+        self.assertEqual(payload['delta']['path']['suffix'][0], self.nodes[0]['path'])
+        # второй узел - сосед первого: общие все символы, кроме последней цифры id
+        self.assertEqual(payload['delta']['path']['keep'][1], len(self.nodes[1]['path']) - 1)
+
+    def test_mixed_tree_key_goes_to_columns(self):
+        nodes = self.nodes[:2] + [dict(self.nodes[2], item='other')]
+        payload = encode_columnar(nodes, ColumnarJSONRenderer.CONSTANT_FIELDS)
+        self.assertNotIn('item', payload['constant'])
+        self.assertEqual(decode_columnar(payload), nodes)
+
+    def test_empty_list(self):
+        self.assertEqual(decode_columnar(json.loads(ColumnarJSONRenderer().render([]))), [])
+
+    def test_pre_rendered(self):
+        content = ColumnarJSONRenderer().render(PreRenderedJSON(FastJSONRenderer().render(self.nodes)))
+        self.assertEqual(decode_columnar(json.loads(content)), self.nodes)
+
+    def test_not_a_list_rendered_as_json(self):
+        data = {'error': 'Object does not exist'}
+        self.assertEqual(ColumnarJSONRenderer().render(data), FastJSONRenderer().render(data))
+
+
+@unittest.skipUnless(orjson, 'orjson is not installed')
+class FastJSONRendererTest(SimpleTestCase):
+    def test_same_bytes_as_json_renderer(self):
+        nodes = serialize_node_rows(node_rows(50, 'c5d4e5f6-0000-4000-8000-000000000001'))
+        nodes[0]['attributes'] = '{"name": "Узел \\"1\\"", "tags": ["a", "b"]}'
+        nodes[1]['attributes'] = 'line\u2028separator\u2029, tab\t, emoji \U0001f333, control \x01'
+        nodes[2]['attributes'] = None
+        data = [nodes, {'count': 3, 'ok': True, 'nested': {'empty': [], 'none': None, 'negative': -2 ** 40}}]
+        for value in data:
+            with self.subTest(value=type(value).__name__):
+                self.assertEqual(FastJSONRenderer().render(value), JSONRenderer().render(value))
+
+    def test_float_formatting(self):
+        # значения совпадают, различается запись экспоненты
+        data = [0.1, 1.5, 1e16, 1e-7, -2.5e-300]
+        self.assertEqual(FastJSONRenderer().render(data), b'[0.1,1.5,1e16,1e-7,-2.5e-300]')
+        self.assertEqual(JSONRenderer().render(data), b'[0.1,1.5,1e+16,1e-07,-2.5e-300]')
+        self.assertEqual(json.loads(FastJSONRenderer().render(data)), data)
+
+    def test_non_finite_floats(self):
+        self.assertEqual(FastJSONRenderer().render([float('nan'), float('inf')]), b'[null,null]')
+        with self.assertRaises(ValueError):
+            JSONRenderer().render([float('nan')])
+
+    def test_project_id_rendered_as_string(self):
+        row = node_rows(1, uuid.UUID('c5d4e5f6-0000-4000-8000-000000000001'))[0]
+        node = serialize_node_rows([row])[0]
+        self.assertEqual(list(node), list(NODE_FIELDS))
+        self.assertEqual(node['project_id'], 'c5d4e5f6-0000-4000-8000-000000000001')
+
+
+@unittest.skipUnless(msgpack, 'msgpack is not installed')
+class MessagePackFormatTest(SimpleTestCase):
+    def test_round_trip(self):
+        nodes = serialize_node_rows(node_rows(250, 'c5d4e5f6-0000-4000-8000-000000000001'))
+        self.assertEqual(msgpack.unpackb(MessagePackRenderer().render(nodes)), nodes)
+
+    def test_pre_rendered(self):
+        nodes = serialize_node_rows(node_rows(10, 'c5d4e5f6-0000-4000-8000-000000000001'))
+        content = MessagePackRenderer().render(PreRenderedJSON(FastJSONRenderer().render(nodes)))
+        self.assertEqual(msgpack.unpackb(content), nodes)
+
+
+class SingleFlightTest(SimpleTestCase):
+    def run_concurrently(self, flight, compute, followers=3):
+        """Первый вызов и followers вызовов, присоединившихся к нему, до окончания compute"""
+        started, release, outcomes = threading.Event(), threading.Event(), []
+
+        def blocking_compute():
+            started.set()
+            release.wait(5)
+            return compute()
+
+        def call(fn):
+            try:
+                outcomes.append(('result', flight.do('key', fn, _render_once)))
+            except Exception as e:
+                outcomes.append(('error', e))
+
+        threads = [threading.Thread(target=call, args=(blocking_compute,))]
+        threads[0].start()
+        self.assertTrue(started.wait(5))
+        # ожидающие потоки не вызывают compute
+        threads += [threading.Thread(target=call, args=(self.fail,)) for _ in range(followers)]
+        for thread in threads[1:]:
+            thread.start()
+        while flight._calls['key'].waiters < followers:
+            threading.Event().wait(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        return outcomes
+
+    def test_followers_share_one_computation(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return [{'id': 1}]
+
+        outcomes = self.run_concurrently(SingleFlight(), compute)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(outcomes), 4)
+        results = [result for kind, result in outcomes if kind == 'result']
+        self.assertEqual(results.count([{'id': 1}]), 1)
+        shared = [result for result in results if isinstance(result, PreRenderedJSON)]
+        self.assertEqual(len(shared), 3)
+        # закодировано один раз, ожидающие потоки получают один неизменяемый объект
+        self.assertTrue(all(result is shared[0] for result in shared))
+        self.assertEqual(json.loads(shared[0].content), [{'id': 1}])
+
+    def test_followers_get_leader_exception(self):
+        error = ValueError('read failed')
+
+        def compute():
+            raise error
+
+        outcomes = self.run_concurrently(SingleFlight(), compute)
+        self.assertEqual(outcomes, [('error', error)] * 4)
+
+    def test_key_removed_after_error(self):
+        flight = SingleFlight()
+
+        def compute():
+            raise ValueError('read failed')
+
+        with self.assertRaises(ValueError):
+            flight.do('key', compute)
+        self.assertEqual(flight._calls, {})
+        self.assertEqual(flight.do('key', lambda: [1]), [1])
+        self.assertEqual(flight._calls, {})
+
+    def test_sequential_calls_compute_again(self):
+        flight, calls = SingleFlight(), []
+        for _ in range(2):
+            flight.do('key', lambda: calls.append(1) or [])
+        self.assertEqual(len(calls), 2)
+
+    def test_pre_rendered_result_shared_as_is(self):
+        result = PreRenderedJSON(b'[]')
+        self.assertIs(_render_once(result), result)
+
+
+class DriverError(Exception):
+    def __init__(self, pgcode):
+        super().__init__(pgcode)
+        self.pgcode = pgcode
+
+
+def database_error(pgcode):
+    """DatabaseError Django поверх ошибки драйвера с SQLSTATE pgcode"""
+    try:
+        raise DatabaseError('database error') from DriverError(pgcode)
+    except DatabaseError as e:
+        return e
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   TREE_TRANSACTION_ATTEMPTS=3, TREE_TRANSACTION_BACKOFF=0)
+class RetryTransactionTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def write(self, *errors):
+        """Метод записи, который выбрасывает errors по очереди, затем возвращает 'ok'; calls - число вызовов"""
+        calls = []
+
+        @transactions.retry_transaction('test-write')
+        def write():
+            calls.append(1)
+            if len(calls) <= len(errors):
+                raise errors[len(calls) - 1]
+            return 'ok'
+
+        self.addCleanup(transactions.endpoints.remove, 'test-write')
+        return write, calls
+
+    def test_sqlstate_follows_cause(self):
+        self.assertEqual(transactions.sqlstate(database_error('40P01')), '40P01')
+        self.assertIsNone(transactions.sqlstate(DatabaseError('no driver error')))
+
+    def test_retried_on_retryable_sqlstates(self):
+        for pgcode in ('40P01', '40001', '55P03'):
+            with self.subTest(pgcode=pgcode):
+                write, calls = self.write(database_error(pgcode))
+                self.assertEqual(write(), 'ok')
+                self.assertEqual(len(calls), 2)
+
+    def test_other_errors_not_retried(self):
+        error = database_error('23505')
+        write, calls = self.write(error)
+        with self.assertRaises(DatabaseError) as raised:
+            write()
+        self.assertIs(raised.exception, error)
+        self.assertEqual(len(calls), 1)
+
+    def test_not_retried_inside_atomic_block(self):
+        error = database_error('40P01')
+        write, calls = self.write(error)
+        with mock.patch.object(connections[DEFAULT_DB_ALIAS], 'in_atomic_block', True):
+            with self.assertRaises(DatabaseError) as raised:
+                write()
+        self.assertIs(raised.exception, error)
+        self.assertEqual(len(calls), 1)
+
+    def test_conflict_after_last_attempt(self):
+        write, calls = self.write(*[database_error('40001')] * 3)
+        with self.assertRaises(transactions.TransactionConflict):
+            write()
+        self.assertEqual(len(calls), 3)
+
+    def test_counters(self):
+        self.write(database_error('40P01'))[0]()
+        self.assertEqual(transactions.metrics()['test-write'], {'retries': 1, 'give_ups': 0})
+        with self.assertRaises(transactions.TransactionConflict):
+            self.write(*[database_error('55P03')] * 3)[0]()
+        self.assertEqual(transactions.metrics()['test-write'], {'retries': 3, 'give_ups': 1})
+
+
+def replica_connection(available: bool = True, caught_up: bool = True):
+    replica = mock.MagicMock()
+    if not available:
+        replica.ensure_connection.side_effect = OperationalError('connection refused')
+    replica.cursor.return_value.__enter__.return_value.fetchone.return_value = (caught_up,)
+    return replica
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   DATABASE_REPLICAS=['replica1', 'replica2'], REPLICA_RETRY_SECONDS=5)
+class ReplicaRoutingTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.connections = {'replica1': replica_connection(), 'replica2': replica_connection()}
+        for patcher in (mock.patch.object(db_routers, 'connections', self.connections),
+                        mock.patch.dict(db_routers._unavailable_until, clear=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def choose(self, times: int = 20) -> set:
+        with mock.patch.object(db_routers.logger, 'error'):
+            return {db_routers.choose_read_alias('tree') for _ in range(times)}
+
+    def test_random_replica(self):
+        self.assertEqual(self.choose(), {'replica1', 'replica2'})
+
+    def test_unavailable_replica_skipped(self):
+        self.connections['replica1'] = replica_connection(available=False)
+        self.assertEqual(self.choose(), {'replica2'})
+        # недоступность запоминается: к реплике не подключаются на каждом чтении
+        self.assertEqual(self.connections['replica1'].ensure_connection.call_count, 1)
+
+    def test_all_replicas_unavailable(self):
+        self.connections['replica1'] = replica_connection(available=False)
+        self.connections['replica2'] = replica_connection(available=False)
+        self.assertEqual(self.choose(), {DEFAULT_DB_ALIAS})
+
+    def test_unavailable_replica_retried(self):
+        self.connections['replica1'] = replica_connection(available=False)
+        self.connections['replica2'] = replica_connection(available=False)
+        self.choose(1)
+        self.connections['replica1'] = replica_connection()
+        self.assertEqual(self.choose(), {DEFAULT_DB_ALIAS})
+        with mock.patch.object(db_routers.time, 'monotonic', return_value=db_routers.time.monotonic() + 6):
+            self.assertEqual(self.choose(), {'replica1'})
+
+    def test_lagging_replica(self):
+        self.connections['replica1'] = replica_connection(caught_up=False)
+        self.connections['replica2'] = replica_connection(caught_up=False)
+        cache.set(db_routers._pin_cache_key('tree'), '0/1000000')
+        self.assertEqual(self.choose(), {DEFAULT_DB_ALIAS})
+
+    def test_connection_lost_while_reading(self):
+        with mock.patch.object(db_routers, 'choose_read_alias', return_value='replica1'), \
+                mock.patch.object(db_routers.logger, 'error'):
+            with self.assertRaises(OperationalError):
+                with db_routers.read_from_replica('tree'):
+                    raise OperationalError('server closed the connection unexpectedly')
+        self.assertEqual(self.choose(), {'replica2'})
+
+
+# RFC 7386, Appendix A: (target, patch, result)
+MERGE_PATCH_EXAMPLES = [
+    ({'a': 'b'}, {'a': 'c'}, {'a': 'c'}),
+    ({'a': 'b'}, {'b': 'c'}, {'a': 'b', 'b': 'c'}),
+    ({'a': 'b'}, {'a': None}, {}),
+    ({'a': 'b', 'b': 'c'}, {'a': None}, {'b': 'c'}),
+    ({'a': ['b']}, {'a': 'c'}, {'a': 'c'}),
+    ({'a': 'c'}, {'a': ['b']}, {'a': ['b']}),
+    ({'a': {'b': 'c'}}, {'a': {'b': 'd', 'c': None}}, {'a': {'b': 'd'}}),
+    ({'a': [{'b': 'c'}]}, {'a': [1]}, {'a': [1]}),
+    (['a', 'b'], ['c', 'd'], ['c', 'd']),
+    ({'a': 'b'}, ['c'], ['c']),
+    ({'a': 'foo'}, None, None),
+    ({'a': 'foo'}, 'bar', 'bar'),
+    ({'e': None}, {'a': 1}, {'e': None, 'a': 1}),
+    ([1, 2], {'a': 'b', 'c': None}, {'a': 'b'}),
+    ({}, {'a': {'bb': {'ccc': None}}}, {'a': {'bb': {}}}),
+]
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'jsonb_merge_patch is a PostgreSQL function')
+class JsonbMergePatchTest(TestCase):
+    def test_rfc_7386_examples(self):
+        with connection.cursor() as cursor:
+            for target, patch, result in MERGE_PATCH_EXAMPLES:
+                with self.subTest(target=target, patch=patch):
+                    cursor.execute('SELECT jsonb_merge_patch(%s::jsonb, %s::jsonb)::text',
+                                   [json.dumps(target), json.dumps(patch)])
+                    self.assertEqual(json.loads(cursor.fetchone()[0]), result)
+
+
+def segment(value: int) -> str:
+    return '0' * (10 - len(str(value))) + str(value)
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'tree writes use PostgreSQL SQL')
+class TreeTestCase(TestCase):
+    """Дерево для тестов записи и проверка его согласованности"""
+    tree = {'project_id': 'c5d4e5f6-0000-4000-8000-000000000002', 'item_type': 'document', 'item': 'test'}
+
+    def create(self, parent_id: int = None, tree: dict = None) -> int:
+        return methods_model.create_node(dict(tree or self.tree), parent_id)['id']
+
+    def nodes(self, tree: dict = None) -> dict:
+        return {node.id: node for node in Node.objects.filter(**(tree or self.tree))}
+
+    def children(self, parent_id: int, tree: dict = None) -> list:
+        """id детей parent_id (корневых узлов, если None) в порядке inner_order"""
+        siblings = {'parent_id': parent_id} if parent_id else {'depth': 1}
+        return list(Node.objects.filter(**(tree or self.tree), **siblings).order_by('inner_order')
+                    .values_list('id', flat=True))
+
+    def assert_error(self, status_code: int, fn, *args, **kwargs):
+        with self.assertRaises(ValidateError) as raised:
+            fn(*args, **kwargs)
+        self.assertEqual(raised.exception.status_code, status_code)
+
+    def assert_consistent(self, tree: dict = None) -> dict:
+        """path, depth и inner_order согласованы с parent_id, номера соседей идут подряд с 1"""
+        nodes = self.nodes(tree)
+        positions = {}
+        for node in nodes.values():
+            parent = nodes.get(node.parent_id)
+            self.assertEqual(node.path, (parent.path if parent else '') + segment(node.id))
+            self.assertEqual(node.depth, parent.depth + 1 if parent else 1)
+            self.assertEqual(node.inner_order[:-10], parent.inner_order if parent else '')
+            positions.setdefault(node.parent_id, []).append(int(node.inner_order[-10:]))
+        for parent_id, numbers in positions.items():
+            self.assertEqual(sorted(numbers), list(range(1, len(numbers) + 1)), f'children of {parent_id}')
+        return nodes
+
+
+class CloneSubtreeTest(TreeTestCase):
+    def setUp(self):
+        # root - parent - a, b (b с потомками b1, b2), другой корень - other
+        self.root = self.create()
+        self.parent = self.create(self.root)
+        self.a = self.create(self.parent)
+        self.b = self.create(self.parent)
+        self.b1 = self.create(self.b)
+        self.b2 = self.create(self.b)
+        self.other = self.create()
+
+    def assert_copy(self, clone_id: int, source_id: int, tree: dict = None):
+        """Копия повторяет нескрытую часть поддерева source_id с тем же порядком детей"""
+        nodes = self.nodes(tree)
+        source_nodes = nodes if tree is None else self.nodes()
+        source_children = [node_id for node_id in self.children(source_id) if not source_nodes[node_id].hidden]
+        clone_children = self.children(clone_id, tree)
+        self.assertEqual(len(clone_children), len(source_children))
+        for clone_child, source_child in zip(clone_children, source_children):
+            self.assertEqual(nodes[clone_child].parent_id, clone_id)
+            self.assertTrue(nodes[clone_child].path.startswith(nodes[clone_id].path))
+            self.assert_copy(clone_child, source_child, tree)
+
+    def test_clone_next_to_source(self):
+        clone = methods_model.clone_subtree(dict(self.tree), self.parent)
+        nodes = self.assert_consistent()
+        self.assertEqual(nodes[clone['id']].parent_id, self.root)
+        self.assertEqual(self.children(self.root), [self.parent, clone['id']])
+        self.assertEqual(nodes[clone['id']].depth, 2)
+        self.assert_copy(clone['id'], self.parent)
+
+    def test_clone_with_hidden_children(self):
+        methods_model.change_hidden_attr_node(dict(self.tree, hidden=True), self.a)
+        self.create(self.parent)
+        clone = methods_model.clone_subtree(dict(self.tree), self.parent)
+        nodes = self.assert_consistent()
+        self.assertEqual([nodes[node_id].inner_order[-10:] for node_id in self.children(clone['id'])],
+                         [segment(1), segment(2)])
+        self.assert_copy(clone['id'], self.parent)
+        self.assertEqual(Node.objects.filter(**self.tree, path__startswith=nodes[clone['id']].path).count(), 5)
+
+        # новый узел под копией встает после скопированных детей
+        child = self.create(clone['id'])
+        nodes = self.assert_consistent()
+        self.assertEqual(self.children(clone['id'])[-1], child)
+        self.assertEqual(nodes[child].inner_order, nodes[clone['id']].inner_order + segment(3))
+
+    def test_clone_into_other_parent(self):
+        clone = methods_model.clone_subtree(dict(self.tree, new_parent_id=self.other), self.b)
+        nodes = self.assert_consistent()
+        self.assertEqual(nodes[clone['id']].parent_id, self.other)
+        self.assertEqual(nodes[clone['id']].path, segment(self.other) + segment(clone['id']))
+        self.assertEqual(nodes[clone['id']].inner_order, nodes[self.other].inner_order + segment(1))
+        self.assertEqual(nodes[clone['id']].depth, 2)
+        self.assert_copy(clone['id'], self.b)
+        for child in self.children(clone['id']):
+            self.assertEqual(nodes[child].depth, 3)
+
+    def test_clone_into_other_tree(self):
+        target = {'project_id': 'c5d4e5f6-0000-4000-8000-000000000003', 'item_type': 'document', 'item': 'copy'}
+        existing = self.create(tree=target)
+        clone = methods_model.clone_subtree(dict(self.tree, **{f'target_{field}': value
+                                                               for field, value in target.items()}), self.parent)
+        nodes = self.assert_consistent(target)
+        self.assertEqual(self.children(None, target), [existing, clone['id']])
+        self.assertIsNone(nodes[clone['id']].parent_id)
+        self.assertEqual(nodes[clone['id']].path, segment(clone['id']))
+        self.assertEqual(nodes[clone['id']].inner_order, segment(2))
+        self.assert_copy(clone['id'], self.parent, target)
+        self.assertEqual(len(nodes), 6)
+        # исходное дерево не изменилось
+        self.assertEqual(len(self.assert_consistent()), 7)
+
+
+class ChangeParentTest(TreeTestCase):
+    def setUp(self):
+        # old - a, b (b с потомками b1 - b11), c; new - x, y
+        self.old = self.create()
+        self.a = self.create(self.old)
+        self.b = self.create(self.old)
+        self.b1 = self.create(self.b)
+        self.b11 = self.create(self.b1)
+        self.c = self.create(self.old)
+        self.new = self.create()
+        self.x = self.create(self.new)
+        self.y = self.create(self.new)
+
+    def move(self, **fields):
+        return methods_model.change_parent_node(dict(self.tree, new_parent_id=self.new, **fields), self.b)
+
+    def assert_subtree_moved(self):
+        nodes = self.assert_consistent()
+        self.assertEqual(nodes[self.b].parent_id, self.new)
+        self.assertEqual(nodes[self.b11].path, ''.join(segment(node_id)
+                                                       for node_id in (self.new, self.b, self.b1, self.b11)))
+        self.assertEqual([nodes[node_id].depth for node_id in (self.b, self.b1, self.b11)], [2, 3, 4])
+        self.assertTrue(nodes[self.b11].inner_order.startswith(nodes[self.b].inner_order))
+        self.assertEqual(nodes[self.b1].parent_id, self.b)
+        # бывшие соседи сдвинуты без пропуска
+        self.assertEqual(self.children(self.old), [self.a, self.c])
+        self.assertEqual(nodes[self.c].inner_order, nodes[self.old].inner_order + segment(2))
+        return nodes
+
+    def test_append_by_default(self):
+        self.move()
+        self.assert_subtree_moved()
+        self.assertEqual(self.children(self.new), [self.x, self.y, self.b])
+
+    def test_before_node(self):
+        self.move(before_node_id=self.y)
+        self.assert_subtree_moved()
+        self.assertEqual(self.children(self.new), [self.x, self.b, self.y])
+
+    def test_after_node(self):
+        self.move(after_node_id=self.x)
+        self.assert_subtree_moved()
+        self.assertEqual(self.children(self.new), [self.x, self.b, self.y])
+
+    def test_before_first_node(self):
+        self.move(before_node_id=self.x)
+        nodes = self.assert_subtree_moved()
+        self.assertEqual(self.children(self.new), [self.b, self.x, self.y])
+        self.assertEqual(nodes[self.b1].inner_order, nodes[self.new].inner_order + segment(1) + segment(1))
+
+    def test_append_before_hidden_children(self):
+        methods_model.change_hidden_attr_node(dict(self.tree, hidden=True), self.x)
+        self.move()
+        self.assert_subtree_moved()
+        self.assertEqual(self.children(self.new), [self.y, self.b, self.x])
+
+    def test_into_former_sibling(self):
+        # новый родитель среди бывших соседей после узла: его inner_order сдвигается вместе с ними
+        methods_model.change_parent_node(dict(self.tree, new_parent_id=self.c), self.b)
+        nodes = self.assert_consistent()
+        self.assertEqual(self.children(self.old), [self.a, self.c])
+        self.assertEqual(nodes[self.b11].inner_order,
+                         nodes[self.old].inner_order + segment(2) + segment(1) + segment(1) + segment(1))
+
+    def test_rejected(self):
+        self.assert_error(400, methods_model.change_parent_node, dict(self.tree, new_parent_id=self.b11), self.b)
+        self.assert_error(400, methods_model.change_parent_node, dict(self.tree, new_parent_id=self.old), self.b)
+        self.assert_error(400, methods_model.change_parent_node, dict(self.tree, new_parent_id=self.b), self.b)
+        self.assert_error(422, self.move, before_node_id=self.x, after_node_id=self.y)
+        self.assert_error(422, self.move, before_node_id=self.a)
+        self.assertEqual(self.children(self.old), [self.a, self.b, self.c])
+        self.assert_consistent()
+
+
+class ChangeHiddenTest(TreeTestCase):
+    def setUp(self):
+        # root - a, b (b с потомками b1, b2), c
+        self.root = self.create()
+        self.a = self.create(self.root)
+        self.b = self.create(self.root)
+        self.b1 = self.create(self.b)
+        self.b2 = self.create(self.b)
+        self.c = self.create(self.root)
+
+    def set_hidden(self, node_id: int, hidden: bool, **fields):
+        return methods_model.change_hidden_attr_node(dict(self.tree, hidden=hidden, **fields), node_id)
+
+    def hidden(self) -> set:
+        return {node.id for node in self.nodes().values() if node.hidden}
+
+    def test_hide_with_descendants(self):
+        self.set_hidden(self.b, True)
+        self.assert_consistent()
+        self.assertEqual(self.hidden(), {self.b, self.b1, self.b2})
+        self.assertEqual(self.children(self.root), [self.a, self.c, self.b])
+        self.assertEqual(self.children(self.b), [self.b1, self.b2])
+
+    def test_hide_without_descendants(self):
+        self.set_hidden(self.b, True, affect_descendants=False)
+        self.assert_consistent()
+        self.assertEqual(self.hidden(), {self.b})
+
+    def test_restore(self):
+        self.set_hidden(self.b, True)
+        self.set_hidden(self.b, None)
+        nodes = self.assert_consistent()
+        self.assertEqual(self.hidden(), set())
+        # восстановленный узел - последний из нескрытых соседей
+        self.assertEqual(self.children(self.root), [self.a, self.c, self.b])
+        self.assertEqual(nodes[self.b2].inner_order, nodes[self.root].inner_order + segment(3) + segment(2))
+
+    def test_restore_without_descendants(self):
+        self.set_hidden(self.b, True)
+        self.set_hidden(self.b, None, affect_descendants=False)
+        self.assert_consistent()
+        self.assertEqual(self.hidden(), {self.b1, self.b2})
+
+    def test_restore_moves_before_hidden_siblings(self):
+        self.set_hidden(self.a, True)
+        self.set_hidden(self.b, True)
+        self.assertEqual(self.children(self.root), [self.c, self.b, self.a])
+        self.set_hidden(self.a, None)
+        self.assert_consistent()
+        self.assertEqual(self.children(self.root), [self.c, self.a, self.b])
+
+    def test_already_hidden_descendant(self):
+        self.set_hidden(self.b1, True)
+        self.assertEqual(self.children(self.b), [self.b2, self.b1])
+        self.set_hidden(self.b, True)
+        self.assert_consistent()
+        self.assertEqual(self.hidden(), {self.b, self.b1, self.b2})
+        self.assertEqual(self.children(self.b), [self.b2, self.b1])
+
+    def test_same_value_rejected(self):
+        self.assert_error(422, self.set_hidden, self.b, None)
+        self.assert_error(404, self.set_hidden, self.c + 1000, True)
+
+    def test_batch(self):
+        # b1 скрывается вместе с b раньше своей очереди и пропускается. Обновлены a и сдвинутые b (с потомками), c,
+        # затем b с потомками и сдвинутый c
+        result = methods_model.change_hidden_attr_nodes(dict(self.tree, node_ids=[self.a, self.b, self.b1],
+                                                              hidden=True))
+        self.assertEqual(result, 'Node(s) deleted, 9 node(s) updated')
+        self.assert_consistent()
+        self.assertEqual(self.hidden(), {self.a, self.b, self.b1, self.b2})
+        self.assertEqual(self.children(self.root), [self.c, self.b, self.a])
+
+        # узлы восстанавливаются в порядке node_ids, каждый встает после нескрытых соседей
+        methods_model.change_hidden_attr_nodes(dict(self.tree, node_ids=[self.a, self.b], hidden=None))
+        self.assert_consistent()
+        self.assertEqual(self.hidden(), set())
+        self.assertEqual(self.children(self.root), [self.c, self.a, self.b])
+
+    def test_batch_is_one_transaction(self):
+        self.assert_error(404, methods_model.change_hidden_attr_nodes,
+                          dict(self.tree, node_ids=[self.a, self.c + 1000], hidden=True))
+        self.assertEqual(self.hidden(), set())
+        self.assertEqual(self.children(self.root), [self.a, self.b, self.c])
+
+
+class ChangeInnerOrderTest(TreeTestCase):
+    def setUp(self):
+        # root - a, b, c, d; у b и d есть потомки
+        self.root = self.create()
+        self.a, self.b, self.c, self.d = [self.create(self.root) for _ in range(4)]
+        self.b1 = self.create(self.b)
+        self.d1 = self.create(self.d)
+
+    def move(self, node_id: int, destination_id: int):
+        return methods_model.change_inner_order_attr_node(dict(self.tree, destination_node_id=destination_id), node_id)
+
+    def assert_order(self, order: list):
+        nodes = self.assert_consistent()
+        self.assertEqual(self.children(self.root), order)
+        # потомки переставленных узлов следуют за ними
+        self.assertEqual(nodes[self.b1].inner_order[:-10], nodes[self.b].inner_order)
+        self.assertEqual(nodes[self.d1].inner_order[:-10], nodes[self.d].inner_order)
+
+    def test_move_down(self):
+        self.move(self.b, self.d)
+        self.assert_order([self.a, self.c, self.d, self.b])
+
+    def test_move_up(self):
+        self.move(self.d, self.b)
+        self.assert_order([self.a, self.d, self.b, self.c])
+
+    def test_move_to_first(self):
+        self.move(self.c, self.a)
+        self.assert_order([self.c, self.a, self.b, self.d])
+
+    def test_rejected(self):
+        self.assert_error(400, self.move, self.b, self.b)
+        self.assert_error(422, self.move, self.b1, self.d1)
+        self.assert_order([self.a, self.b, self.c, self.d])
+
+    @override_settings(TREE_PREPARED_STATEMENTS=False)
+    def test_without_prepared_statements(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.move(self.d, self.a)
+        self.assertFalse([query for query in queries.captured_queries
+                          if query['sql'].startswith(('PREPARE', 'EXECUTE'))])
+        self.assert_order([self.d, self.a, self.b, self.c])
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'PREPARE / EXECUTE are PostgreSQL statements')
+class PreparedStatementsTest(TestCase):
+    statement = prepared_statements.PreparedStatement('tree_test_divide', 'SELECT 10 / %(divisor)s, %(divisor)s')
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DEALLOCATE ALL')
+        connection.prepared_statements = set()
+
+    def execute(self, divisor: int):
+        with connection.cursor() as cursor:
+            prepared_statements.execute(cursor, self.statement, {'divisor': divisor})
+            return cursor.fetchone()
+
+    def executed(self, queries) -> list:
+        """Команды и имена запросов без параметров"""
+        return [' '.join(query['sql'].split('(')[0].split()[:2]) for query in queries.captured_queries]
+
+    def test_prepared_once_per_connection(self):
+        self.assertEqual(self.statement.execute_sql, 'EXECUTE tree_test_divide(%s)')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.execute(2), (5, 2))
+            self.assertEqual(self.execute(5), (2, 5))
+        self.assertEqual(self.executed(queries), ['PREPARE tree_test_divide', 'EXECUTE tree_test_divide',
+                                                  'EXECUTE tree_test_divide'])
+
+    def test_reuse_after_error(self):
+        self.execute(2)
+        with self.assertRaises(DatabaseError):
+            with transaction.atomic():
+                self.execute(0)
+        self.assertIsNone(connection.prepared_statements)
+
+        # PREPARE не откатывается вместе с транзакцией: кеш сбрасывается на сервере и заполняется заново
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.execute(2), (5, 2))
+        self.assertEqual(self.executed(queries), ['DEALLOCATE ALL', 'PREPARE tree_test_divide',
+                                                  'EXECUTE tree_test_divide'])
+        self.assertEqual(connection.prepared_statements, {'tree_test_divide'})
+
+    @override_settings(TREE_PREPARED_STATEMENTS=False)
+    def test_disabled(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.execute(2), (5, 2))
+        self.assertEqual(len(queries.captured_queries), 1)
+        self.assertTrue(queries.captured_queries[0]['sql'].startswith('SELECT 10 / 2'))
+        self.assertEqual(connection.prepared_statements, set())
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   TREE_SNAPSHOTS_ENABLED=True)
+class SnapshotTest(TreeTestCase):
+    def setUp(self):
+        cache.clear()
+        self.root = self.create()
+        self.a = self.create(self.root)
+
+    def write(self, fn, *args):
+        # версия дерева увеличивается после коммита записи
+        with self.captureOnCommitCallbacks(execute=True):
+            return fn(*args)
+
+    def get_tree(self) -> list:
+        return as_data(methods_model.get_tree(dict(self.tree)))
+
+    def from_snapshot(self) -> list:
+        """Ответ снимка, который не собирается заново"""
+        return snapshots.get_tree(methods_model.tree_key(self.tree), self.tree, 'inner_order', self.fail).decode()
+
+    def test_fresh_snapshot_served(self):
+        nodes = self.get_tree()
+        self.assertEqual(self.from_snapshot(), nodes)
+        self.assertEqual([node['id'] for node in nodes], [self.root, self.a])
+
+    def test_stale_after_write(self):
+        self.get_tree()
+        child = self.write(methods_model.create_node, dict(self.tree), self.a)['id']
+        self.assertEqual([node['id'] for node in self.get_tree()], [self.root, self.a, child])
+        self.assertEqual([node['id'] for node in self.from_snapshot()], [self.root, self.a, child])
+
+    def test_attribute_patch(self):
+        self.get_tree()
+        self.write(methods_model.change_attributes_attr_node, dict(self.tree, attributes='{"name": "a"}'), self.a)
+        # менялись только attributes: старый снимок патчится без сборки дерева
+        nodes = snapshots.get_tree(methods_model.tree_key(self.tree), self.tree, 'inner_order', self.fail).decode()
+        self.assertEqual({node['id']: node['attributes'] for node in nodes}, {self.root: None, self.a: '{"name": "a"}'})
+        self.assertEqual(self.get_tree(), nodes)
+
+    def test_merge_patch(self):
+        self.write(methods_model.change_attributes_attr_node, dict(self.tree, attributes='{"a": 1, "b": 2}'), self.a)
+        self.get_tree()
+        self.write(methods_model.change_attributes_attr_node,
+                   dict(self.tree, attributes='{"b": null}', merge_patch=True), self.a)
+        nodes = self.from_snapshot()
+        self.assertEqual(json.loads(nodes[1]['attributes']), {'a': 1})
+
+    def test_writes_do_not_touch_snapshots(self):
+        self.get_tree()
+        with CaptureQueriesContext(connection) as queries:
+            self.write(methods_model.create_node, dict(self.tree), self.a)
+        self.assertFalse([query for query in queries.captured_queries if 'treesnapshot' in query['sql']])
+
+    def test_write_while_disabled(self):
+        self.get_tree()
+        with override_settings(TREE_SNAPSHOTS_ENABLED=False):
+            child = self.write(methods_model.create_node, dict(self.tree), self.root)['id']
+        self.assertEqual([node['id'] for node in self.get_tree()], [self.root, self.a, child])
+
+    def test_older_version_not_saved_over_newer(self):
+        self.get_tree()
+        key = methods_model.tree_key(self.tree)
+        version = TreeSnapshot.objects.get(**self.tree, sort_by='inner_order').payload_version
+        with mock.patch.object(snapshots.tree_versions, 'get_version', return_value=version - 1):
+            snapshots.get_tree(key, self.tree, 'inner_order', lambda: [])
+        self.assertEqual(TreeSnapshot.objects.get(**self.tree, sort_by='inner_order').payload_version, version)
+        self.assertEqual(len(self.from_snapshot()), 2)
@@ -1,18 +1,24 @@
 from django.urls import path, re_path
 
+from core.compression import compress_response
 from .views import NodeApiView, \
     NodesApiView, \
     DeleteRestoreNodeApiView, \
+    DeleteRestoreNodesApiView, \
     ChangeAttributesNodeApiView, \
+    ChangeAttributesNodesApiView, \
     ChangeInnerOrderNodeApiView, \
     ChangeParentNodeApiView, \
-    test_server
+    CloneNodeApiView, \
+    JobApiView, \
+    test_server, \
+    transaction_metrics
 
 urlpatterns = [
     # get_tree
-    path('v1/nodes/', NodesApiView.as_view()),
+    path('v1/nodes/', compress_response(NodesApiView.as_view())),
     # get_children
-    path('v1/nodes/<int:pk>/', NodesApiView.as_view()),
+    path('v1/nodes/<int:pk>/', compress_response(NodesApiView.as_view())),
     # create_node_root
     # path('v1/node/', NodeApiView.as_view()),
     re_path(r'v1/node/?$', NodeApiView.as_view()),
@@ -24,15 +30,28 @@ urlpatterns = [
     # put attributes
     path('v1/node/<int:pk>/attributes/', ChangeAttributesNodeApiView.as_view()),
 
+    # put attributes of many nodes
+    path('v1/nodes/attributes/', ChangeAttributesNodesApiView.as_view()),
+
     # put inner_order
     path('v1/node/<int:pk>/order/', ChangeInnerOrderNodeApiView.as_view()),
 
     # delete_node, restore_node
     path('v1/node/<int:pk>/hidden/', DeleteRestoreNodeApiView.as_view()),
 
+    # delete_nodes, restore_nodes
+    path('v1/nodes/hidden/', DeleteRestoreNodesApiView.as_view()),
+
     # change_parent
     path('v1/node/<int:pk>/parent/', ChangeParentNodeApiView.as_view()),
 
+    # clone_subtree
+    path('v1/node/<int:pk>/clone/', CloneNodeApiView.as_view()),
+
+    # background job status
+    path('v1/jobs/<int:pk>/', JobApiView.as_view()),
+
     # for devops
     path('healthcheck/', test_server),
+    path('metrics/transactions/', transaction_metrics),
 ]
@@ -3,11 +3,14 @@ from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from core import transactions
 from core.decorators import custom_exception_handler
-from .services import methods_model
+from core.renderers import NODE_RENDERER_CLASSES, NODE_LIST_RENDERER_CLASSES, json_response
+from .services import jobs, methods_model
 
 
 class NodeApiView(APIView):
+    renderer_classes = NODE_RENDERER_CLASSES
 
     # v1/node/<int:pk>/
     @custom_exception_handler
@@ -19,6 +22,8 @@ class NodeApiView(APIView):
         project_id: uuid проекта, обязательный параметр
         item_type: обязательный параметр
         item: обязательный параметр
+        with_children: опциональный параметр, принимает значение true, добавляет узлу has_children и child_count
+        (число нескрытых детей)
         :return: объект
         """
 
@@ -46,6 +51,7 @@ class NodeApiView(APIView):
 
 
 class NodesApiView(APIView):
+    renderer_classes = NODE_LIST_RENDERER_CLASSES
 
     # v1/nodes/
     @custom_exception_handler
@@ -62,14 +68,19 @@ class NodesApiView(APIView):
         сортировка идет по полю inner_order), принимает значение true
         depth: опциональный параметр, задается для выдачи детей определенного уровня вложенности по отношению
         к исходному узлу(параметр актуален только для метода get_descendants)
+        with_children: опциональный параметр, принимает значение true, добавляет узлам has_children и child_count
+        (число нескрытых детей)
+        format: опциональный параметр, format=columnar - список в колоночном виде (см. core.renderers.encode_columnar),
+        format=msgpack или заголовок Accept: application/msgpack - MessagePack
         :return: список объектов
         """
 
         result = methods_model.get_nodes(request.GET, pk)
-        return Response(result, status=status.HTTP_200_OK)
+        return json_response(request, result, status.HTTP_200_OK)
 
 
 class ChangeAttributesNodeApiView(APIView):
+    renderer_classes = NODE_RENDERER_CLASSES
 
     # v1/node/<int:pk>/attributes/
     @custom_exception_handler
@@ -84,6 +95,8 @@ class ChangeAttributesNodeApiView(APIView):
         item_type: обязательный параметр
         item: обязательный параметр
         attributes: json
+        merge_patch: опциональный параметр, при true attributes применяется к текущему значению как JSON merge patch
+        (RFC 7386): ключи со значением null удаляются, вложенные объекты сливаются
         :return: объект
         """
 
@@ -91,7 +104,36 @@ class ChangeAttributesNodeApiView(APIView):
         return Response(result, status=status.HTTP_201_CREATED)
 
 
+class ChangeAttributesNodesApiView(APIView):
+    renderer_classes = NODE_RENDERER_CLASSES
+
+    # v1/nodes/attributes/
+    @custom_exception_handler
+    def patch(self, request):
+        """
+        Применить JSON merge patch (RFC 7386) к attributes нескольких узлов одним запросом
+        :param request: в теле запроса принимает следующие параметры:
+        project_id: uuid проекта, обязательный параметр
+        item_type: обязательный параметр
+        item: обязательный параметр
+        attributes: обязательный параметр, json патча
+        node_ids: список id узлов или
+        path: path узла, патч применяется к узлу и всем его потомкам (передается один из node_ids и path)
+        Скрытые узлы не изменяются
+        run_async: опциональный параметр, при true операция ставится в очередь фоновых заданий, ответ 202 с job_id,
+        статус задания - GET v1/jobs/<job_id>/
+        :return: {'changed_ids': id узлов, у которых изменились attributes}
+        """
+
+        if jobs.run_async_requested(request.data):
+            return Response(jobs.submit('change_attributes_batch', request.data), status=status.HTTP_202_ACCEPTED)
+
+        result = methods_model.change_attributes_attr_nodes(jobs.without_run_async(request.data))
+        return Response(result, status=status.HTTP_200_OK)
+
+
 class ChangeInnerOrderNodeApiView(APIView):
+    renderer_classes = NODE_RENDERER_CLASSES
 
     # v1/node/<int:pk>/order/
     @custom_exception_handler
@@ -113,6 +155,7 @@ class ChangeInnerOrderNodeApiView(APIView):
 
 
 class DeleteRestoreNodeApiView(APIView):
+    renderer_classes = NODE_RENDERER_CLASSES
 
     # v1/node/<int:pk>/hidden/
     @custom_exception_handler
@@ -128,15 +171,50 @@ class DeleteRestoreNodeApiView(APIView):
         True, для восстановления - None)
         affect_descendants: опциональный параметр, необходимость удалять/восстанавливать всех потомков, принимает
         значения True или False, по дефолту установлено True
+        run_async: опциональный параметр, при true операция ставится в очередь фоновых заданий, ответ 202 с job_id,
+        статус задания - GET v1/jobs/<job_id>/
         :return: при восстановлении - восстановленный объект, при удалении - строка с результатом
         .
         """
 
-        result = methods_model.change_hidden_attr_node(request.data, pk)
+        if jobs.run_async_requested(request.data):
+            return Response(jobs.submit('change_hidden', request.data, pk), status=status.HTTP_202_ACCEPTED)
+
+        result = methods_model.change_hidden_attr_node(jobs.without_run_async(request.data), pk)
+        return Response(result, status=status.HTTP_200_OK)
+
+
+class DeleteRestoreNodesApiView(APIView):
+    renderer_classes = NODE_RENDERER_CLASSES
+
+    # v1/nodes/hidden/
+    @custom_exception_handler
+    def patch(self, request):
+        """
+        Скрыть или восстановить несколько узлов в одной транзакции
+        :param request: в теле запроса принимает следующие параметры:
+        project_id: uuid проекта, обязательный параметр
+        item_type: обязательный параметр
+        item: обязательный параметр
+        node_ids: обязательный параметр, список id узлов
+        hidden: обязательный параметр, принимает возможные значения True или None (для удаления необходимо передать
+        True, для восстановления - None)
+        affect_descendants: опциональный параметр, необходимость удалять/восстанавливать всех потомков, принимает
+        значения True или False, по дефолту установлено True
+        run_async: опциональный параметр, при true операция ставится в очередь фоновых заданий, ответ 202 с job_id,
+        статус задания - GET v1/jobs/<job_id>/
+        :return: строка с результатом
+        """
+
+        if jobs.run_async_requested(request.data):
+            return Response(jobs.submit('change_hidden_batch', request.data), status=status.HTTP_202_ACCEPTED)
+
+        result = methods_model.change_hidden_attr_nodes(jobs.without_run_async(request.data))
         return Response(result, status=status.HTTP_200_OK)
 
 
 class ChangeParentNodeApiView(APIView):
+    renderer_classes = NODE_RENDERER_CLASSES
 
     # v1/node/<int:pk>/parent/
     @custom_exception_handler
@@ -149,12 +227,66 @@ class ChangeParentNodeApiView(APIView):
         project_id: uuid проекта, обязательный параметр
         item_type: обязательный параметр
         item: обязательный параметр
+        run_async: опциональный параметр, при true операция ставится в очередь фоновых заданий, ответ 202 с job_id,
+        статус задания - GET v1/jobs/<job_id>/
         :return: перемещаемый объект
         """
-        result = methods_model.change_parent_node(request.data, pk)
+        if jobs.run_async_requested(request.data):
+            return Response(jobs.submit('change_parent', request.data, pk), status=status.HTTP_202_ACCEPTED)
+
+        result = methods_model.change_parent_node(jobs.without_run_async(request.data), pk)
+        return Response(result, status=status.HTTP_201_CREATED)
+
+
+class CloneNodeApiView(APIView):
+    renderer_classes = NODE_RENDERER_CLASSES
+
+    # v1/node/<int:pk>/clone/
+    @custom_exception_handler
+    def post(self, request, pk: int = None):
+        """
+        Скопировать узел вместе со всеми потомками. Скрытые узлы и их потомки не копируются.
+        :param pk: id копируемого узла
+        :param request: в теле запроса принимает следующие параметры:
+        project_id: uuid проекта, обязательный параметр
+        item_type: обязательный параметр
+        item: обязательный параметр
+        new_parent_id: опциональный параметр, id родителя копии (по умолчанию - родитель копируемого узла)
+        target_project_id, target_item_type, target_item: опциональные параметры, передаются вместе, дерево,
+        в которое копируется поддерево (без new_parent_id копия становится корневым узлом)
+        run_async: опциональный параметр, при true операция ставится в очередь фоновых заданий, ответ 202 с job_id,
+        статус задания - GET v1/jobs/<job_id>/
+        :return: корневой узел копии
+        """
+        if jobs.run_async_requested(request.data):
+            return Response(jobs.submit('clone_subtree', request.data, pk), status=status.HTTP_202_ACCEPTED)
+
+        result = methods_model.clone_subtree(jobs.without_run_async(request.data), pk)
         return Response(result, status=status.HTTP_201_CREATED)
 
 
+class JobApiView(APIView):
+    renderer_classes = NODE_RENDERER_CLASSES
+
+    # v1/jobs/<int:pk>/
+    @custom_exception_handler
+    def get(self, request, pk: int = None):
+        """
+        Статус фонового задания
+        :param pk: id задания
+        :return: статус (queued, running, done, failed), число затронутых строк и запросов, результат или ошибка,
+        длительность выполнения в секундах
+        """
+        result = jobs.get_job(pk)
+        return Response(result, status=status.HTTP_200_OK)
+
+
 @api_view(['GET'])
 def test_server(request):
     return Response('mxnzEgBjbUQSNE9i8dfk')
+
+
+@api_view(['GET'])
+def transaction_metrics(request):
+    """Число повторов пишущих транзакций и отказов после всех попыток по эндпоинтам (см. core/transactions.py)"""
+    return Response(transactions.metrics())